@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import (
+    configure_environment, reset_schema, QueryCounter, summarize, metadata,
+    write_results, compare, print_table
+)
+
+SEED_BATCH = 1000
+OS_IMAGES = ("ubuntu-22.04", "debian-12", "centos-stream-9")
+LOG_TYPES = ("deployment", "terraform", "ansible")
+
+
+def seed(engine, labs: int, vms: int, logs: int, rng: random.Random) -> list:
+    """Insère le jeu de données synthétique par lots ; retourne les identifiants des labs."""
+    from models import Lab, VM, DeploymentLog
+
+    lab_ids = [uuid.uuid4() for _ in range(labs)]
+    lab_rows = [
+        {'id': lab_id, 'name': f"bench-lab-{i}", 'description': f"Lab de benchmark {i}",
+         'status': rng.choice(("created", "deployed", "deployed", "error"))}
+        for i, lab_id in enumerate(lab_ids)
+    ]
+    vm_rows = []
+    log_rows = []
+    port = 0
+    for lab_id, lab in zip(lab_ids, lab_rows):
+        for j in range(vms):
+            vm_rows.append({
+                'id': uuid.uuid4(), 'lab_id': lab_id, 'name': f"vm-{j}",
+                'vcpu': rng.randint(1, 4), 'ram_mb': rng.choice((1024, 2048, 4096)), 'disk_gb': 20,
+                'os_image': rng.choice(OS_IMAGES),
+                'status': "running" if lab['status'] == "deployed" else "pending",
+                'ssh_port': 22000 + port, 'vnc_port': 5900 + port,
+                'domain_name': f"lab_{str(lab_id).replace('-', '_')}_vm_{j}",
+            })
+            port += 1
+        for k in range(logs):
+            log_rows.append({
+                'id': uuid.uuid4(), 'lab_id': lab_id, 'log_type': LOG_TYPES[k % len(LOG_TYPES)],
+                'content': f"[{k}] " + "x" * rng.randint(40, 400),
+            })
+
+    with engine.begin() as conn:
+        for table, rows in ((Lab.__table__, lab_rows), (VM.__table__, vm_rows), (DeploymentLog.__table__, log_rows)):
+            for start in range(0, len(rows), SEED_BATCH):
+                conn.execute(table.insert(), rows[start:start + SEED_BATCH])
+    return lab_ids
+
+
+def scenarios(lab_ids: list, vms: int, rng: random.Random) -> dict:
+    """Requêtes mesurées : nom -> fabrique de (méthode, chemin, corps)."""
+    created = iter(range(10 ** 9))
+
+    def create_lab():
+        n = next(created)
+        return "POST", "/api/v1/labs", {
+            'name': f"bench-created-{n}",
+            'vms': [{'name': f"vm-{j}", 'vcpu': 1, 'ram_mb': 1024, 'disk_gb': 20, 'os_image': "ubuntu-22.04"}
+                    for j in range(vms)]
+        }
+
+    return {
+        'list_labs': lambda: ("GET", "/api/v1/labs", None),
+        'get_lab': lambda: ("GET", f"/api/v1/labs/{rng.choice(lab_ids)}", None),
+        'list_vms': lambda: ("GET", "/api/v1/vms", None),
+        'list_vms_by_lab': lambda: ("GET", f"/api/v1/vms?lab_id={rng.choice(lab_ids)}", None),
+        'get_lab_logs': lambda: ("GET", f"/api/v1/labs/{rng.choice(lab_ids)}/logs", None),
+        'create_lab': create_lab,
+    }
+
+
+async def run(args) -> dict:
+    import httpx
+    from database import engine
+    from main import app
+
+    rng = random.Random(args.seed)
+    reset_schema(engine, args.allow_reset)
+    started = time.perf_counter()
+    lab_ids = seed(engine, args.labs, args.vms, args.logs, rng)
+    seed_seconds = time.perf_counter() - started
+
+    counter = QueryCounter(engine)
+    selected = args.only.split(",") if args.only else None
+    results = {}
+    # Application appelée en mémoire (ASGI) : ni réseau ni cycle de vie (tâches de fond)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name, make_request in scenarios(lab_ids, args.vms, rng).items():
+            if selected and name not in selected:
+                continue
+            for _ in range(args.warmup):
+                method, path, body = make_request()
+                await client.request(method, path, json=body)
+
+            latencies, queries, sizes = [], [], []
+            for _ in range(args.requests):
+                method, path, body = make_request()
+                counter.reset()
+                start = time.perf_counter()
+                response = await client.request(method, path, json=body)
+                latencies.append(time.perf_counter() - start)
+                queries.append(counter.reset())
+                sizes.append(len(response.content))
+                if response.status_code >= 400:
+                    raise SystemExit(f"{name}: {method} {path} -> {response.status_code} {response.text[:200]}")
+            results[name] = summarize(latencies, queries=queries, response_bytes=sizes)
+
+    return {
+        'meta': metadata(engine, labs=args.labs, vms=args.vms, logs=args.logs,
+                         requests=args.requests, seed=args.seed, seed_seconds=round(seed_seconds, 3)),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark des endpoints de l'API sur un jeu de données synthétique "
+                    "(latences par percentile et requêtes SQL par appel)."
+    )
+    parser.add_argument("--labs", type=int, default=100, help="nombre de labs (N)")
+    parser.add_argument("--vms", type=int, default=5, help="VMs par lab (M)")
+    parser.add_argument("--logs", type=int, default=20, help="logs de déploiement par lab (K)")
+    parser.add_argument("--requests", type=int, default=100, help="requêtes mesurées par endpoint")
+    parser.add_argument("--warmup", type=int, default=5, help="requêtes d'échauffement par endpoint")
+    parser.add_argument("--seed", type=int, default=1, help="graine du générateur aléatoire")
+    parser.add_argument("--only", help="endpoints à mesurer, séparés par des virgules")
+    parser.add_argument("--database-url", help="base cible (défaut : fichier SQLite temporaire)")
+    parser.add_argument("--allow-reset", action="store_true",
+                        help="autorise la suppression des tables d'une base autre que SQLite")
+    parser.add_argument("--output", help="fichier de résultats JSON (défaut : sortie standard)")
+    parser.add_argument("--baseline", help="résultats précédents : code de sortie 1 en cas de régression")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="hausse de p95 tolérée par rapport à la référence (0.25 = 25 %%)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_environment(args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        payload = asyncio.run(run(args))
+
+    # Sans --output, le JSON part sur la sortie standard : le tableau passe sur la sortie d'erreur
+    print_table(payload['results'], ("p50_ms", "p95_ms", "p99_ms", "queries_mean", "response_bytes_mean"), file=None if args.output else sys.stderr)
+    write_results(args.output, payload)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(payload['results'], baseline, args.tolerance)
+        for regression in regressions:
+            print(f"RÉGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Dict, List, Optional, Sequence
+
+# Sans dépendance à `database` : importable avant configure_environment
+from services.stats import percentile
+
+# Tâches de fond désactivées : elles fausseraient les mesures et n'ont pas d'hyperviseur.
+# Hyperviseur et outils externes (terraform, ansible-playbook, virsh, nc) sont simulés.
+BACKGROUND_DISABLED = {
+    "VIRT_BACKEND": "fake",
+    "COMMAND_EXECUTOR": "fake",
+    "VM_RECONCILE_INTERVAL": "0",
+    "VM_METRICS_INTERVAL": "0",
+    "ORPHAN_GC_INTERVAL": "0",
+    "HIBERNATE_CHECK_INTERVAL": "0",
+}
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def configure_environment(database_url: str):
+    """À appeler avant tout import de `database` ou `main` : l'engine est créé à l'import."""
+    os.environ["DATABASE_URL"] = database_url
+    for name, value in BACKGROUND_DISABLED.items():
+        os.environ.setdefault(name, value)
+
+
+def reset_schema(engine, allow_reset: bool):
+    """Recrée toutes les tables. Refusé hors SQLite sans autorisation explicite."""
+    from database import Base
+
+    if engine.dialect.name != "sqlite" and not allow_reset:
+        raise SystemExit(
+            f"Base {engine.dialect.name} : les tables seront supprimées, relancer avec --allow-reset"
+        )
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+
+class QueryCounter:
+    """Compte les requêtes SQL et les commits émis par un engine (connexions de tous les threads)."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        self.commits = 0
+        self.statements: Dict[str, int] = {}
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+        self.statements[verb] = self.statements.get(verb, 0) + 1
+
+    def _on_commit(self, conn):
+        self.commits += 1
+
+    def reset(self) -> int:
+        count, self.count = self.count, 0
+        return count
+
+
+def summarize(latencies: List[float], **counts: List[float]) -> dict:
+    """Statistiques d'une série de latences (secondes, rendues en ms) et de compteurs par requête."""
+    ordered = sorted(latencies)
+    summary = {
+        'count': len(ordered),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+        'min_ms': round(ordered[0] * 1000, 3) if ordered else 0.0,
+        'max_ms': round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = round(percentile(ordered, p) * 1000, 3)
+    for name, values in counts.items():
+        summary[f'{name}_mean'] = round(sum(values) / len(values), 2) if values else 0.0
+        summary[f'{name}_max'] = max(values) if values else 0
+    return summary
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(engine, **parameters) -> dict:
+    import sqlalchemy
+
+    return {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'database': engine.dialect.name,
+        'parameters': parameters,
+    }
+
+
+def write_results(path: Optional[str], payload: dict):
+    text = json.dumps(payload, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+def compare(current: Dict[str, dict], baseline: Dict[str, dict], latency_tolerance: float,
+            latency_key: str = 'p95_ms', exact_keys: Sequence[str] = ('queries_mean',)) -> List[str]:
+    """
+    Régressions par rapport à des résultats précédents : toute hausse des compteurs exacts
+    (requêtes par appel, déterministes) et les hausses de latence au-delà de la tolérance.
+    """
+    regressions = []
+    for name, result in current.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for key in exact_keys:
+            if key in result and key in before and result[key] > before[key]:
+                regressions.append(f"{name}: {key} {before[key]} -> {result[key]}")
+        if before.get(latency_key) and result[latency_key] > before[latency_key] * (1 + latency_tolerance):
+            regressions.append(f"{name}: {latency_key} {before[latency_key]} -> {result[latency_key]}")
+    return regressions
+
+
+def print_table(results: Dict[str, dict], columns: Sequence[str], file=None):
+    width = max(len(name) for name in results) if results else 10
+    print(f"{'':<{width}}  " + "  ".join(f"{column:>14}" for column in columns), file=file)
+    for name, result in results.items():
+        print(f"{name:<{width}}  " + "  ".join(f"{result.get(column, ''):>14}" for column in columns), file=file)
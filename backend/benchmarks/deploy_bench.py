@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import (
+    configure_environment, reset_schema, QueryCounter, summarize, metadata,
+    write_results, compare, print_table
+)
+
+PLAYBOOK = """- hosts: all
+  tasks:
+    - name: Paquets de base
+      apt:
+        name: [git, curl]
+"""
+
+
+def seed(engine, labs: int, vms: int, ansible_ratio: float, rng: random.Random) -> list:
+    """Crée les labs à déployer (statut "created") ; retourne leurs identifiants."""
+    from models import Lab, VM
+
+    lab_ids = [uuid.uuid4() for _ in range(labs)]
+    lab_rows = [{'id': lab_id, 'name': f"deploy-bench-{i}", 'status': "created"}
+                for i, lab_id in enumerate(lab_ids)]
+    vm_rows = []
+    for lab_id in lab_ids:
+        playbook = PLAYBOOK if rng.random() < ansible_ratio else None
+        for j in range(vms):
+            vm_rows.append({
+                'id': uuid.uuid4(), 'lab_id': lab_id, 'name': f"vm-{j}", 'vcpu': 1, 'ram_mb': 1024,
+                'disk_gb': 20, 'os_image': "ubuntu-22.04", 'status': "pending",
+                'ansible_config_yaml': playbook if j == 0 else None,
+            })
+    with engine.begin() as conn:
+        conn.execute(Lab.__table__.insert(), lab_rows)
+        conn.execute(VM.__table__.insert(), vm_rows)
+    return lab_ids
+
+
+def outcome(engine, lab_ids: list) -> dict:
+    """Statuts finaux des labs et volume des journaux de déploiement écrits."""
+    from sqlalchemy import func
+    from sqlalchemy.orm import Session
+    from models import Lab, DeploymentLog
+
+    with Session(engine) as db:
+        statuses = dict(db.query(Lab.status, func.count()).group_by(Lab.status).all())
+        logs, log_bytes = db.query(func.count(), func.coalesce(func.sum(func.length(DeploymentLog.content)), 0)).one()
+    return {'statuses': statuses, 'logs': logs, 'log_bytes': int(log_bytes)}
+
+
+async def run(args) -> dict:
+    from database import engine, SessionLocal
+    from services.deployment import deploy_lab
+    from services.executors import command_executor
+    from services.ansible_farm import ansible_farm
+    from services.teardown import workspace_dirs
+
+    rng = random.Random(args.seed)
+    reset_schema(engine, args.allow_reset)
+    lab_ids = seed(engine, args.labs, args.vms, args.ansible_ratio, rng)
+
+    command_executor.time_scale = args.time_scale
+    command_executor.failure_rate = args.failure_rate
+    command_executor.rng = random.Random(args.seed)
+    command_executor.reset()
+    counter = QueryCounter(engine)
+    semaphore = asyncio.Semaphore(args.concurrency or len(lab_ids))
+    latencies = []
+
+    async def deploy(lab_id):
+        async with semaphore:
+            db = SessionLocal()
+            try:
+                start = time.perf_counter()
+                await deploy_lab(lab_id, db)
+                latencies.append(time.perf_counter() - start)
+            finally:
+                db.close()
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(deploy(lab_id) for lab_id in lab_ids))
+    finally:
+        elapsed = time.perf_counter() - started
+        await ansible_farm.stop()
+        for lab_id in lab_ids:
+            for path in workspace_dirs(lab_id):
+                shutil.rmtree(path, ignore_errors=True)
+
+    statements = dict(counter.statements)
+    result = outcome(engine, lab_ids)
+    writes = sum(statements.get(verb, 0) for verb in ("INSERT", "UPDATE", "DELETE"))
+    deployed = result['statuses'].get("deployed", 0)
+
+    stages = {key: summarize(timings) for key, timings in command_executor.timings.items()}
+    results = dict(stages, deploy_lab=dict(
+        summarize(latencies),
+        throughput_labs_per_s=round(len(lab_ids) / elapsed, 2),
+        deployed=deployed,
+        failed=result['statuses'].get("error", 0),
+        statements=statements,
+        statements_per_lab=round(counter.count / len(lab_ids), 2),
+        writes_per_lab=round(writes / len(lab_ids), 2),
+        writes_per_vm=round(writes / (len(lab_ids) * args.vms), 2),
+        commits_per_lab=round(counter.commits / len(lab_ids), 2),
+        log_rows_per_lab=round(result['logs'] / len(lab_ids), 2),
+        log_bytes_per_lab=round(result['log_bytes'] / len(lab_ids)),
+        simulated_output_bytes=command_executor.stats['output_bytes'],
+        simulated_failures=command_executor.stats['failures'],
+    ))
+    return {
+        'meta': metadata(engine, labs=args.labs, vms=args.vms, ansible_ratio=args.ansible_ratio,
+                         concurrency=args.concurrency, time_scale=args.time_scale,
+                         failure_rate=args.failure_rate, seed=args.seed, elapsed_s=round(elapsed, 3)),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark de bout en bout de deploy_lab sur une chaîne d'outils simulée "
+                    "(débit, latence par étape et écritures en base par lab)."
+    )
+    parser.add_argument("--labs", type=int, default=200, help="labs déployés")
+    parser.add_argument("--vms", type=int, default=3, help="VMs par lab")
+    parser.add_argument("--ansible-ratio", type=float, default=0.5,
+                        help="part des labs configurés par un playbook Ansible")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="déploiements simultanés (0 = tous les labs à la fois)")
+    parser.add_argument("--time-scale", type=float, default=0.01,
+                        help="facteur appliqué aux latences simulées (1 = durées réalistes)")
+    parser.add_argument("--failure-rate", type=float,
+                        help="taux d'échec de toutes les commandes (défaut : taux des profils)")
+    parser.add_argument("--seed", type=int, default=1, help="graine du générateur aléatoire")
+    parser.add_argument("--database-url", help="base cible (défaut : fichier SQLite temporaire)")
+    parser.add_argument("--allow-reset", action="store_true",
+                        help="autorise la suppression des tables d'une base autre que SQLite")
+    parser.add_argument("--output", help="fichier de résultats JSON (défaut : sortie standard)")
+    parser.add_argument("--baseline", help="résultats précédents : code de sortie 1 en cas de régression")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="hausse de p95 tolérée par rapport à la référence (0.25 = 25 %%)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_environment(args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        payload = asyncio.run(run(args))
+
+    # Sans --output, le JSON part sur la sortie standard : le tableau passe sur la sortie d'erreur
+    print_table(payload['results'], ("count", "p50_ms", "p95_ms", "max_ms", "writes_per_lab", "throughput_labs_per_s"), file=None if args.output else sys.stderr)
+    write_results(args.output, payload)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        # Sans échecs simulés, les écritures par lab sont déterministes
+        exact_keys = ('writes_per_lab', 'commits_per_lab') if args.failure_rate == 0 else ()
+        regressions = compare(payload['results'], baseline, args.tolerance, exact_keys=exact_keys)
+        for regression in regressions:
+            print(f"RÉGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.common import (
+    configure_environment, reset_schema, summarize, metadata, write_results, compare, print_table
+)
+
+SCENARIOS = ("ssh-echo", "vnc-echo", "ssh-firehose", "vnc-firehose")
+SEED_BATCH = 1000
+FIREHOSE_CHUNK = 16 * 1024
+
+
+def seed(engine, vms: int, port_base: int) -> list:
+    """
+    Crée des VMs « running » dont les ports SSH et VNC sont ceux des serveurs locaux :
+    SSH sur port_base + i, VNC sur port_base + vms + i. Retourne les identifiants des VMs.
+    """
+    from models import Lab, VM
+
+    lab_id = uuid.uuid4()
+    vm_ids = [uuid.uuid4() for _ in range(vms)]
+    vm_rows = [{
+        'id': vm_id, 'lab_id': lab_id, 'name': f"vm-{i}", 'vcpu': 1, 'ram_mb': 1024, 'disk_gb': 20,
+        'os_image': "ubuntu-22.04", 'status': "running",
+        'ssh_port': port_base + i, 'vnc_port': port_base + vms + i,
+        'domain_name': f"ws_bench_vm_{i}",
+    } for i, vm_id in enumerate(vm_ids)]
+    with engine.begin() as conn:
+        conn.execute(Lab.__table__.insert(), [{'id': lab_id, 'name': "ws-bench", 'status': "deployed"}])
+        for start in range(0, len(vm_rows), SEED_BATCH):
+            conn.execute(VM.__table__.insert(), vm_rows[start:start + SEED_BATCH])
+    return vm_ids
+
+
+async def _echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(64 * 1024)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def _firehose(rate: int):
+    """Serveur qui émet en continu (débit par connexion borné par `rate` octets/s, 0 = libre)."""
+    chunk = os.urandom(FIREHOSE_CHUNK)
+
+    async def handler(reader, writer):
+        # Les entrées du client (événements clavier/souris VNC) sont lues et ignorées
+        drain_input = asyncio.ensure_future(reader.read(-1))
+        try:
+            while not drain_input.done():
+                writer.write(chunk)
+                await writer.drain()
+                if rate:
+                    await asyncio.sleep(FIREHOSE_CHUNK / rate)
+        except ConnectionError:
+            pass
+        finally:
+            drain_input.cancel()
+            writer.close()
+
+    return handler
+
+
+async def start_servers(vms: int, port_base: int, server: str, rate: int) -> list:
+    """Serveurs TCP locaux tenant lieu des ports SSH et VNC des VMs."""
+    handler = _echo if server == "echo" else _firehose(rate)
+    return [await asyncio.start_server(handler, "127.0.0.1", port, backlog=1024)
+            for port in range(port_base, port_base + 2 * vms)]
+
+
+class ProcessSampler:
+    """Mémoire résidente et temps CPU d'un processus, lus dans /proc (Linux)."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK")
+
+    def rss_bytes(self) -> int:
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def cpu_seconds(self) -> float:
+        with open(f"/proc/{self.pid}/stat") as f:
+            # Le nom du processus peut contenir des espaces : les champs suivent la parenthèse
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_worker(port: int, log_path: str) -> subprocess.Popen:
+    """Lance un worker uvicorn sur la base du benchmark et attend qu'il réponde."""
+    import httpx
+
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--log-level", "warning", "--backlog", "4096", "--ws-per-message-deflate", "false"],
+            cwd=BACKEND_DIR, stdout=log, stderr=subprocess.STDOUT
+        )
+    async with httpx.AsyncClient() as client:
+        for _ in range(300):
+            if process.poll() is not None:
+                raise SystemExit(f"Le worker s'est arrêté (code {process.returncode}), voir {log_path}")
+            try:
+                if (await client.get(f"http://127.0.0.1:{port}/health")).status_code == 200:
+                    return process
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise SystemExit(f"Le worker ne répond pas, voir {log_path}")
+
+
+class Phase:
+    """Fenêtre de mesure partagée par les clients : seules les mesures prises pendant comptent."""
+
+    def __init__(self):
+        self.measuring = False
+        self.latencies = []
+        self.bytes = 0
+        self.frames = 0
+        self.errors = 0
+
+
+async def _client(url: str, phase: Phase, echo: bool, payload: bytes, interval: float,
+                  ready: asyncio.Future, stop: asyncio.Event):
+    import websockets
+
+    started = time.perf_counter()
+    try:
+        async with websockets.connect(url, max_size=None, compression=None, open_timeout=60,
+                                      close_timeout=5, ping_interval=None) as ws:
+            ready.set_result(time.perf_counter() - started)
+            # Décalage initial : les clients n'émettent pas tous au même instant
+            await asyncio.sleep(random.uniform(0, interval) if echo else 0)
+            while not stop.is_set():
+                if echo:
+                    sent = time.perf_counter()
+                    await ws.send(payload)
+                    received = 0
+                    while received < len(payload):
+                        message = await ws.recv()
+                        if isinstance(message, str):
+                            raise RuntimeError(message)
+                        received += len(message)
+                    if phase.measuring:
+                        phase.latencies.append(time.perf_counter() - sent)
+                        phase.bytes += received
+                        phase.frames += 1
+                    await asyncio.sleep(interval)
+                else:
+                    message = await ws.recv()
+                    if isinstance(message, str):
+                        raise RuntimeError(message)
+                    if phase.measuring:
+                        phase.bytes += len(message)
+                        phase.frames += 1
+    except Exception as e:
+        if not stop.is_set():
+            phase.errors += 1
+            if phase.errors <= 3:
+                print(f"Client en échec: {type(e).__name__}: {e}", file=sys.stderr)
+        if not ready.done():
+            ready.set_result(None)
+
+
+async def run_scenario(name: str, args, base_url: str, vm_ids: list, sampler, rss_idle: int) -> dict:
+    channel, server = name.split("-")
+    servers = await start_servers(len(vm_ids), args.port_base, server, args.rate)
+    phase = Phase()
+    stop = asyncio.Event()
+    payload = os.urandom(args.message_size)
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def client(index: int):
+        url = f"{base_url}/api/v1/ws/{channel}/{vm_ids[index % len(vm_ids)]}"
+        async with semaphore:
+            ready = asyncio.get_running_loop().create_future()
+            task = asyncio.ensure_future(_client(url, phase, server == "echo", payload, args.interval,
+                                                 ready, stop))
+            # Le créneau de connexion est rendu une fois la poignée de main terminée
+            connect_time = await ready
+        return task, connect_time
+
+    ramp_started = time.perf_counter()
+    opened = await asyncio.gather(*(client(i) for i in range(args.clients)))
+    ramp = time.perf_counter() - ramp_started
+    tasks = [task for task, _ in opened]
+    connect_times = [t for _, t in opened if t is not None]
+
+    # Stabilisation (premiers échanges, ouverture des connexions vers les serveurs locaux)
+    await asyncio.sleep(args.settle)
+    rss_loaded = sampler.rss_bytes() if sampler else 0
+    server_cpu = sampler.cpu_seconds() if sampler else 0.0
+    client_cpu = time.process_time()
+    started = time.perf_counter()
+    phase.measuring = True
+    await asyncio.sleep(args.duration)
+    phase.measuring = False
+    elapsed = time.perf_counter() - started
+    server_cpu = (sampler.cpu_seconds() - server_cpu) if sampler else None
+    client_cpu = time.process_time() - client_cpu
+
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for tcp_server in servers:
+        tcp_server.close()
+    await asyncio.gather(*(tcp_server.wait_closed() for tcp_server in servers))
+    # Laisser le worker libérer les connexions avant le scénario suivant
+    await asyncio.sleep(1)
+
+    result = summarize(phase.latencies) if server == "echo" else {}
+    result.update(
+        clients=args.clients,
+        connected=len(connect_times),
+        errors=phase.errors,
+        connect_p99_ms=summarize(connect_times)['p99_ms'],
+        ramp_s=round(ramp, 3),
+        messages_per_s=round(phase.frames / elapsed, 1),
+        throughput_mb_s=round(phase.bytes / elapsed / 1e6, 3),
+        client_cpu_percent=round(client_cpu / elapsed * 100, 1),
+    )
+    if sampler:
+        result.update(
+            server_cpu_percent=round(server_cpu / elapsed * 100, 1),
+            server_rss_mb=round(rss_loaded / 2 ** 20, 1),
+            memory_per_connection_kb=round((rss_loaded - rss_idle) / max(len(connect_times), 1) / 1024, 1),
+        )
+    return result
+
+
+async def run(args) -> dict:
+    from database import engine
+    import models  # tables à recréer par reset_schema
+
+    reset_schema(engine, args.allow_reset)
+    vm_ids = seed(engine, args.vms, args.port_base)
+
+    worker = None
+    pid = args.pid
+    base_url = args.url.rstrip("/") if args.url else None
+    with tempfile.NamedTemporaryFile(prefix="ws_bench_worker_", suffix=".log", delete=False) as log:
+        log_path = log.name
+    try:
+        if base_url is None:
+            port = _free_port()
+            worker = await start_worker(port, log_path)
+            base_url = f"ws://127.0.0.1:{port}"
+            pid = worker.pid
+        sampler = ProcessSampler(pid) if pid and os.path.exists(f"/proc/{pid}") else None
+        # Mémoire du worker au repos : la mémoire par connexion est mesurée par rapport à elle
+        rss_idle = sampler.rss_bytes() if sampler else 0
+
+        results = {}
+        for name in args.scenarios.split(","):
+            if name not in SCENARIOS:
+                raise SystemExit(f"Scénario inconnu: {name} (choix : {', '.join(SCENARIOS)})")
+            results[name] = await run_scenario(name, args, base_url, vm_ids, sampler, rss_idle)
+    finally:
+        if worker is not None:
+            worker.terminate()
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+    if not args.keep_log:
+        os.unlink(log_path)
+
+    return {
+        'meta': metadata(engine, clients=args.clients, vms=args.vms, duration=args.duration,
+                         interval=args.interval, message_size=args.message_size, rate=args.rate,
+                         scenarios=args.scenarios, cpus=os.cpu_count(), external_worker=bool(args.url)),
+        'results': results,
+    }
+
+
+def _raise_fd_limit(clients: int):
+    # Par connexion : le WebSocket client et la socket acceptée par le serveur local (et
+    # deux de plus côté worker s'il est lancé par le benchmark, qui hérite de la limite)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, max(soft, 4 * clients + 1024)) if hard != resource.RLIM_INFINITY else 4 * clients + 1024
+    if wanted > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    if wanted < 2 * clients + 256:
+        print(f"Limite de descripteurs ({wanted}) trop basse pour {clients} clients", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Test de charge du proxy WebSocket SSH/VNC : des serveurs TCP locaux tiennent "
+                    "lieu des VMs, des milliers de clients relaient leur trafic via un worker."
+    )
+    parser.add_argument("--clients", type=int, default=1000, help="connexions WebSocket simultanées")
+    parser.add_argument("--vms", type=int, default=100, help="VMs (ports SSH et VNC locaux) entre lesquelles les répartir")
+    parser.add_argument("--scenarios", default="ssh-echo,vnc-firehose",
+                        help=f"scénarios séparés par des virgules ({', '.join(SCENARIOS)})")
+    parser.add_argument("--duration", type=float, default=10.0, help="durée de la fenêtre de mesure (s)")
+    parser.add_argument("--settle", type=float, default=2.0, help="stabilisation avant la mesure (s)")
+    parser.add_argument("--interval", type=float, default=0.1,
+                        help="écho : intervalle entre deux messages d'un client (s, frappe au clavier)")
+    parser.add_argument("--message-size", type=int, default=64, help="écho : taille des messages (octets)")
+    parser.add_argument("--rate", type=int, default=0,
+                        help="flux continu : débit par connexion en octets/s (0 = sans limite)")
+    parser.add_argument("--connect-concurrency", type=int, default=100, help="poignées de main simultanées")
+    parser.add_argument("--port-base", type=int, default=41000, help="premier port des serveurs locaux")
+    parser.add_argument("--url", help="worker existant (ws://hôte:port), sur la même base que --database-url")
+    parser.add_argument("--pid", type=int, help="processus du worker existant, pour la mémoire et le CPU")
+    parser.add_argument("--keep-log", action="store_true", help="conserve le journal du worker lancé")
+    parser.add_argument("--database-url", help="base cible (défaut : fichier SQLite temporaire)")
+    parser.add_argument("--allow-reset", action="store_true",
+                        help="autorise la suppression des tables d'une base autre que SQLite")
+    parser.add_argument("--output", help="fichier de résultats JSON (défaut : sortie standard)")
+    parser.add_argument("--baseline", help="résultats précédents : code de sortie 1 en cas de régression")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="hausse de p99 tolérée par rapport à la référence (0.25 = 25 %%)")
+    args = parser.parse_args(argv)
+
+    _raise_fd_limit(args.clients)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Le worker lancé hérite de l'environnement : même base, tâches de fond désactivées
+        configure_environment(args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        payload = asyncio.run(run(args))
+
+    # Sans --output, le JSON part sur la sortie standard : le tableau passe sur la sortie d'erreur
+    print_table(payload['results'], ("connected", "p50_ms", "p99_ms", "throughput_mb_s",
+                                     "server_cpu_percent", "memory_per_connection_kb"),
+                file=None if args.output else sys.stderr)
+    write_results(args.output, payload)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(payload['results'], baseline, args.tolerance,
+                              latency_key='p99_ms', exact_keys=())
+        for regression in regressions:
+            print(f"RÉGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
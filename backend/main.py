@@ -1,17 +1,54 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import uvicorn
 
 from database import engine, Base
-from routers import labs, vms, websocket
+from routers import labs, vms, websocket, recordings, capacity, admin
+from services.ansible_farm import ansible_farm
+from services.ssh_pool import ssh_transport_pool
+from services.websocket_service import websocket_proxy_service
+from services.virt_backend import virt_backend
+from services.vm_reconciler import vm_reconciler
+from services.vm_metrics import vm_metrics_collector
+from services.teardown import orphan_collector
+from services.capacity import capacity_ledger
+from services.hibernation import hibernation_manager
+from services.deployment import deploy_queued_labs
+from services.telemetry import metrics_registry, instrument_engine, MetricsMiddleware, CONTENT_TYPE
+from services.profiler import sampling_profiler, SlowRequestMiddleware
+
+# Durée des requêtes SQL et détention des connexions du pool
+instrument_engine(engine)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Créer les tables de base de données au démarrage
     Base.metadata.create_all(bind=engine)
+    # Relever la capacité des hyperviseurs, puis reprendre les déploiements en attente
+    await capacity_ledger.refresh_hosts()
+    await deploy_queued_labs()
+    # Publier les connexions proxy dans le registre partagé (si configuré)
+    await websocket_proxy_service.start()
+    # Resynchroniser périodiquement le statut des VMs avec l'hyperviseur
+    vm_reconciler.start()
+    vm_metrics_collector.start()
+    # Détruire périodiquement l'infrastructure des labs disparus de la base
+    orphan_collector.start()
+    # Hiberner les labs inactifs
+    hibernation_manager.start()
     yield
+    await hibernation_manager.stop()
+    await orphan_collector.stop()
+    await vm_metrics_collector.stop()
+    await vm_reconciler.stop()
+    await websocket_proxy_service.stop()
+    # Arrêter les workers de la ferme Ansible
+    await ansible_farm.stop()
+    await ssh_transport_pool.close_all()
+    await virt_backend.close()
+    sampling_profiler.stop()
 
 
 app = FastAPI(
@@ -30,10 +67,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Durée des requêtes HTTP par route (exposée sur /metrics)
+app.add_middleware(MetricsMiddleware)
+# Pile et requêtes SQL des requêtes plus longues que SLOW_REQUEST_THRESHOLD_MS
+app.add_middleware(SlowRequestMiddleware)
+
 # Inclusion des routeurs
 app.include_router(labs.router, prefix="/api/v1", tags=["labs"])
 app.include_router(vms.router, prefix="/api/v1", tags=["vms"])
 app.include_router(websocket.router, prefix="/api/v1", tags=["websocket"])
+app.include_router(recordings.router, prefix="/api/v1", tags=["recordings"])
+app.include_router(capacity.router, prefix="/api/v1", tags=["capacity"])
+app.include_router(admin.router, prefix="/api/v1", tags=["admin"])
 
 
 @app.get("/")
@@ -46,11 +91,20 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    # Fonction synchrone : les collecteurs interrogent la base hors de la boucle d'événements
+    return Response(metrics_registry.render(), media_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        reload=True,
+        # La compression des WebSockets est décidée par connexion dans le proxy ; hors de ce
+        # point d'entrée, lancer uvicorn avec --ws-per-message-deflate false
+        ws_per_message_deflate=False
     )
 
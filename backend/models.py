@@ -1,5 +1,4 @@
-from sqlalchemy import Column, String, Integer, Text, DateTime, ForeignKey, Table
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, String, Integer, BigInteger, Float, Text, DateTime, ForeignKey, Table, Uuid
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -10,18 +9,22 @@ import uuid
 lab_tags = Table(
     'lab_tags',
     Base.metadata,
-    Column('lab_id', UUID(as_uuid=True), ForeignKey('labs.id'), primary_key=True),
-    Column('tag_id', UUID(as_uuid=True), ForeignKey('tags.id'), primary_key=True)
+    Column('lab_id', Uuid, ForeignKey('labs.id'), primary_key=True),
+    Column('tag_id', Uuid, ForeignKey('tags.id'), primary_key=True)
 )
 
 
 class Lab(Base):
     __tablename__ = "labs"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
     name = Column(String, unique=True, nullable=False)
     description = Column(Text)
-    status = Column(String, default="created")  # created, deploying, deployed, error, deleted
+    status = Column(String, default="created")  # created, queued, deploying, deployed, hibernated, error, deleting
+    # Politique d'hibernation : délai d'inactivité (None = valeur globale, 0 = jamais) et seuil CPU
+    hibernate_after_minutes = Column(Integer)
+    hibernate_cpu_threshold = Column(Float)
+    last_activity_at = Column(Float)  # dernière connexion SSH/VNC (epoch)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -33,8 +36,8 @@ class Lab(Base):
 class VM(Base):
     __tablename__ = "vms"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    lab_id = Column(UUID(as_uuid=True), ForeignKey("labs.id"), nullable=False)
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
+    lab_id = Column(Uuid, ForeignKey("labs.id"), nullable=False)
     name = Column(String, nullable=False)
     vcpu = Column(Integer, nullable=False)
     ram_mb = Column(Integer, nullable=False)
@@ -45,6 +48,9 @@ class VM(Base):
     status = Column(String, default="pending")  # pending, running, stopped, error
     ansible_config_yaml = Column(Text)
     terraform_state = Column(Text)
+    # Domaine libvirt créé par Terraform (nom et UUID renvoyés par ses outputs)
+    domain_name = Column(String, index=True)
+    domain_uuid = Column(String, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -55,7 +61,7 @@ class VM(Base):
 class Tag(Base):
     __tablename__ = "tags"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
     name = Column(String, unique=True, nullable=False)
 
     # Relations
@@ -65,8 +71,8 @@ class Tag(Base):
 class DeploymentLog(Base):
     __tablename__ = "deployment_logs"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    lab_id = Column(UUID(as_uuid=True), ForeignKey("labs.id"), nullable=False)
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
+    lab_id = Column(Uuid, ForeignKey("labs.id"), nullable=False)
     log_type = Column(String, nullable=False)  # terraform, ansible
     content = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -74,3 +80,72 @@ class DeploymentLog(Base):
     # Relations
     lab = relationship("Lab")
 
+
+class DeploymentSpan(Base):
+    """
+    Étape chronométrée d'un déploiement (span). Les spans d'une tentative partagent un
+    trace_id et sont écrits en une seule insertion à la fin du déploiement.
+    """
+    __tablename__ = "deployment_spans"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    trace_id = Column(Uuid, nullable=False, index=True)
+    lab_id = Column(Uuid, ForeignKey("labs.id"), nullable=False, index=True)
+    seq = Column(Integer, nullable=False)  # ordre d'ouverture dans la trace
+    parent_seq = Column(Integer)  # nul pour la racine
+    name = Column(String, nullable=False, index=True)  # terraform.apply, image_download, ssh_ready...
+    vm_name = Column(String)  # étapes propres à une VM
+    started_at = Column(Float, nullable=False, index=True)  # epoch
+    duration = Column(Float, nullable=False)  # secondes
+    status = Column(String, nullable=False)  # ok, error
+    attributes = Column(Text)  # JSON compact, nul si vide
+
+
+class ProxyConnection(Base):
+    """Connexion proxy publiée par un worker pour le registre partagé."""
+    __tablename__ = "proxy_connections"
+
+    connection_id = Column(String, primary_key=True)
+    worker_id = Column(String, nullable=False, index=True)
+    type = Column(String, nullable=False)  # ssh, vnc
+    vm_id = Column(String, nullable=False, index=True)
+    lab_id = Column(String, index=True)
+    started_at = Column(Float, nullable=False)
+    last_activity = Column(Float, nullable=False)
+    bytes_in = Column(BigInteger, default=0)
+    bytes_out = Column(BigInteger, default=0)
+    heartbeat_at = Column(Float, nullable=False, index=True)
+
+
+class ProxyCloseCommand(Base):
+    """Demande de fermeture des connexions d'une VM, adressée à tous les workers."""
+    __tablename__ = "proxy_close_commands"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    vm_id = Column(String, nullable=False)
+    issued_by = Column(String, nullable=False)
+    created_at = Column(Float, nullable=False, index=True)
+
+
+class HostCapacity(Base):
+    """Ressources physiques d'un hyperviseur, relevées au démarrage ou fixées par configuration."""
+    __tablename__ = "host_capacities"
+
+    host = Column(String, primary_key=True)  # URI libvirt
+    vcpu = Column(Integer, nullable=False)
+    ram_mb = Column(Integer, nullable=False)
+    disk_gb = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class CapacityReservation(Base):
+    """Ressources réservées par un lab sur un hôte, ou demandées en file d'attente."""
+    __tablename__ = "capacity_reservations"
+
+    lab_id = Column(Uuid, ForeignKey("labs.id"), primary_key=True)
+    host = Column(String, index=True)  # nul tant que le lab est en file d'attente
+    state = Column(String, nullable=False, index=True)  # reserved, queued
+    vcpu = Column(Integer, nullable=False)
+    ram_mb = Column(Integer, nullable=False)
+    disk_gb = Column(Integer, nullable=False)
+    requested_at = Column(Float, nullable=False)  # ordre de la file d'attente
@@ -0,0 +1,77 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+import hmac
+import os
+
+from services.profiler import sampling_profiler, slow_request_log, PROFILER_MAX_SECONDS
+
+# Jeton exigé dans l'en-tête X-Admin-Token (vide = endpoints d'administration ouverts)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if ADMIN_TOKEN and not hmac.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Jeton d'administration invalide")
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/admin/profiler")
+async def get_profiler_status(top: int = Query(20, ge=1, le=200)):
+    """État du profileur échantillonneur et fonctions les plus échantillonnées."""
+    return sampling_profiler.status(top)
+
+
+@router.post("/admin/profiler/start")
+async def start_profiler(
+    seconds: float = Query(30, gt=0, le=PROFILER_MAX_SECONDS),
+    interval_ms: Optional[float] = Query(None, ge=1, le=1000),
+    include_idle: bool = Query(False)
+):
+    """Démarre une fenêtre de profilage ; le profil précédent est remplacé."""
+    if not sampling_profiler.start(seconds, interval_ms, include_idle):
+        raise HTTPException(status_code=409, detail="Profilage déjà en cours")
+    return sampling_profiler.status(0)
+
+
+@router.post("/admin/profiler/stop")
+async def stop_profiler():
+    """Arrête la fenêtre de profilage en cours avant son terme."""
+    sampling_profiler.stop()
+    return sampling_profiler.status()
+
+
+@router.get("/admin/profiler/collapsed", response_class=PlainTextResponse)
+async def get_profiler_collapsed():
+    """Profil au format « collapsed stacks », pour flamegraph.pl ou speedscope."""
+    return sampling_profiler.collapsed()
+
+
+@router.get("/admin/slow-requests")
+async def list_slow_requests(
+    limit: int = Query(20, ge=1, le=1000),
+    statements: bool = Query(False, description="Inclure les requêtes SQL")
+):
+    """Dernières requêtes HTTP plus longues que le seuil, de la plus récente à la plus ancienne."""
+    return {
+        "threshold_ms": slow_request_log.threshold * 1000,
+        "requests": slow_request_log.list(limit, statements)
+    }
+
+
+@router.get("/admin/slow-requests/{request_id}")
+async def get_slow_request(request_id: int):
+    """Détail d'une requête lente : pile d'attente et requêtes SQL."""
+    request = slow_request_log.get(request_id)
+    if request is None:
+        raise HTTPException(status_code=404, detail="Requête lente non trouvée (évincée du tampon ?)")
+    return request
+
+
+@router.delete("/admin/slow-requests")
+async def clear_slow_requests():
+    """Vide le tampon des requêtes lentes."""
+    slow_request_log.clear()
+    return {"message": "Tampon des requêtes lentes vidé"}
@@ -0,0 +1,13 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+
+from database import get_db
+from services.capacity import capacity_ledger
+
+router = APIRouter()
+
+
+@router.get("/capacity")
+async def get_capacity(db: Session = Depends(get_db)):
+    """Capacité, réservations et marge disponible de chaque hyperviseur, et labs en attente."""
+    return capacity_ledger.snapshot(db)
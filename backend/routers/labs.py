@@ -1,12 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Query
+from sqlalchemy.orm import Session, selectinload
+from typing import List, Optional
+import asyncio
+import time
 import uuid
 
 from database import get_db
 from models import Lab, VM, DeploymentLog
-from schemas import LabCreate, LabResponse, DeploymentLogResponse
-from services.deployment import deploy_lab
+from schemas import LabCreate, LabResponse, DeploymentLogResponse, HibernationPolicy
+from services.deployment import deploy_lab, destroy_lab
+from services.vm_management import power_lab_vms, POWER_ACTIONS
+from services.vm_cache import vm_cache
+from services.vm_metrics import vm_metrics_collector
+from services.capacity import capacity_ledger, CapacityError
+from services.hibernation import hibernation_manager
+from services.tracing import lab_timeline, stage_percentiles
 
 router = APIRouter()
 
@@ -25,6 +33,9 @@ async def create_lab(lab: LabCreate, db: Session = Depends(get_db)):
         description=lab.description,
         status="created"
     )
+    if lab.hibernation:
+        db_lab.hibernate_after_minutes = lab.hibernation.idle_minutes
+        db_lab.hibernate_cpu_threshold = lab.hibernation.cpu_threshold
     db.add(db_lab)
     db.flush()  # Pour obtenir l'ID du lab
     
@@ -50,10 +61,25 @@ async def create_lab(lab: LabCreate, db: Session = Depends(get_db)):
 @router.get("/labs", response_model=List[LabResponse])
 async def list_labs(db: Session = Depends(get_db)):
     """Liste tous les laboratoires virtuels."""
-    labs = db.query(Lab).all()
+    # VMs chargées en une requête : LabResponse les sérialise pour chaque lab (sinon 1 + N)
+    labs = db.query(Lab).options(selectinload(Lab.vms)).all()
     return labs
 
 
+@router.get("/labs/timeline/percentiles")
+async def get_stage_percentiles(
+    since_hours: float = Query(24, gt=0, description="Fenêtre d'analyse en heures"),
+    name: Optional[List[str]] = Query(None, description="Étapes à retenir (toutes par défaut)"),
+    status: Optional[str] = Query(None, description="Statut des spans (ok, error)"),
+    db: Session = Depends(get_db)
+):
+    """Percentiles de durée de chaque étape de déploiement, tous labs confondus."""
+    return {
+        "since_hours": since_hours,
+        "stages": stage_percentiles(db, time.time() - since_hours * 3600, name, status)
+    }
+
+
 @router.get("/labs/{lab_id}", response_model=LabResponse)
 async def get_lab(lab_id: uuid.UUID, db: Session = Depends(get_db)):
     """Récupère les détails d'un laboratoire spécifique."""
@@ -64,17 +90,30 @@ async def get_lab(lab_id: uuid.UUID, db: Session = Depends(get_db)):
 
 
 @router.delete("/labs/{lab_id}")
-async def delete_lab(lab_id: uuid.UUID, db: Session = Depends(get_db)):
-    """Supprime un laboratoire virtuel."""
+async def delete_lab(
+    lab_id: uuid.UUID,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db)
+):
+    """
+    Supprime un laboratoire virtuel : son infrastructure (domaines, volumes, réseau,
+    répertoires de travail) est détruite en arrière-plan, puis le lab est retiré de la base.
+    Sur un lab déjà en suppression (démontage interrompu), la suppression est relancée.
+    """
     lab = db.query(Lab).filter(Lab.id == lab_id).first()
     if not lab:
         raise HTTPException(status_code=404, detail="Lab non trouvé")
-    
-    # TODO: Implémenter la destruction de l'infrastructure Terraform
-    
-    db.delete(lab)
+
+    if lab.status == "deploying":
+        raise HTTPException(status_code=400, detail=f"Opération impossible: le lab est en état {lab.status}")
+
+    retry = lab.status == "deleting"
+    lab.status = "deleting"
     db.commit()
-    return {"message": "Lab supprimé avec succès"}
+
+    background_tasks.add_task(destroy_lab, lab_id, db)
+    message = "Suppression du lab relancée" if retry else "Suppression du lab lancée"
+    return {"message": message, "lab_id": str(lab_id)}
 
 
 @router.post("/labs/{lab_id}/deploy")
@@ -90,6 +129,25 @@ async def deploy_lab_endpoint(
     
     if lab.status == "deploying":
         raise HTTPException(status_code=400, detail="Le lab est déjà en cours de déploiement")
+    if lab.status == "queued":
+        raise HTTPException(status_code=400, detail="Le lab est déjà en attente de ressources")
+    if lab.status == "deleting":
+        raise HTTPException(status_code=400, detail="Le lab est en cours de suppression")
+    if lab.status == "hibernated":
+        # Redéployer écraserait les domaines dont l'état est sauvegardé sur disque
+        raise HTTPException(status_code=400, detail="Le lab est hiberné : le reprendre avant de le redéployer")
+    
+    # Contrôle d'admission : réserver les ressources du lab sur un hôte. Hors de la boucle
+    # d'événements : le verrou du registre peut être tenu par un drain de la file d'attente
+    try:
+        state, host = await asyncio.to_thread(capacity_ledger.admit, db, lab_id)
+    except CapacityError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    if state == "queued":
+        lab.status = "queued"
+        db.commit()
+        return {"message": "Déploiement en attente de ressources", "status": "queued"}
     
     # Mettre à jour le statut
     lab.status = "deploying"
@@ -98,7 +156,7 @@ async def deploy_lab_endpoint(
     # Lancer le déploiement en arrière-plan
     background_tasks.add_task(deploy_lab, lab_id, db)
     
-    return {"message": "Déploiement lancé"}
+    return {"message": "Déploiement lancé", "status": "deploying", "host": host}
 
 
 @router.get("/labs/{lab_id}/logs", response_model=List[DeploymentLogResponse])
@@ -111,3 +169,105 @@ async def get_lab_logs(lab_id: uuid.UUID, db: Session = Depends(get_db)):
     logs = db.query(DeploymentLog).filter(DeploymentLog.lab_id == lab_id).order_by(DeploymentLog.created_at).all()
     return logs
 
+
+@router.get("/labs/{lab_id}/timeline")
+async def get_lab_timeline(lab_id: uuid.UUID, trace_id: Optional[uuid.UUID] = None, db: Session = Depends(get_db)):
+    """Chronologie des étapes d'un déploiement (le dernier par défaut) : spans par VM et par ressource."""
+    timeline = lab_timeline(db, lab_id, trace_id)
+    if timeline is None:
+        raise HTTPException(status_code=404, detail="Aucune chronologie de déploiement pour ce lab")
+    return timeline
+
+
+
+async def _lab_power_operation(lab_id: uuid.UUID, action: str, db: Session) -> dict:
+    """Applique une action à toutes les VMs d'un lab et enregistre les statuts en une écriture."""
+    lab = db.query(Lab).filter(Lab.id == lab_id).first()
+    if not lab:
+        raise HTTPException(status_code=404, detail="Lab non trouvé")
+    if lab.status == "hibernated":
+        # Démarrer les domaines à froid perdrait leur état sauvegardé sur disque
+        raise HTTPException(status_code=400, detail="Le lab est hiberné : le reprendre avec /resume")
+    if lab.status != "deployed":
+        raise HTTPException(status_code=400, detail=f"Opération impossible: le lab est en état {lab.status}")
+    
+    # Colonnes utiles uniquement : le domaine est adressé sans charger vm.lab
+    vms = db.query(VM.id, VM.name, VM.status, VM.lab_id, VM.domain_name).filter(VM.lab_id == lab_id).all()
+    results = await power_lab_vms(vms, action)
+    
+    succeeded = [vm.id for vm, result in zip(vms, results) if result["success"]]
+    if succeeded:
+        db.query(VM).filter(VM.id.in_(succeeded)).update(
+            {VM.status: POWER_ACTIONS[action][1]}, synchronize_session=False
+        )
+        db.commit()
+        # Mise à jour en masse : hors du suivi de l'ORM, le cache est invalidé explicitement
+        vm_cache.invalidate(succeeded)
+    
+    return {
+        "lab_id": str(lab_id),
+        "action": action,
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "results": results
+    }
+
+
+@router.post("/labs/{lab_id}/start")
+async def start_lab_endpoint(lab_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Démarre toutes les VMs d'un laboratoire."""
+    return await _lab_power_operation(lab_id, "start", db)
+
+
+@router.post("/labs/{lab_id}/stop")
+async def stop_lab_endpoint(lab_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Arrête toutes les VMs d'un laboratoire."""
+    return await _lab_power_operation(lab_id, "stop", db)
+
+
+@router.post("/labs/{lab_id}/restart")
+async def restart_lab_endpoint(lab_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Redémarre toutes les VMs d'un laboratoire."""
+    return await _lab_power_operation(lab_id, "restart", db)
+
+
+@router.post("/labs/{lab_id}/hibernate")
+async def hibernate_lab_endpoint(lab_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Suspend sur disque toutes les VMs actives d'un laboratoire."""
+    lab = db.query(Lab).filter(Lab.id == lab_id).first()
+    if not lab:
+        raise HTTPException(status_code=404, detail="Lab non trouvé")
+    if lab.status != "deployed":
+        raise HTTPException(status_code=400, detail="Seul un lab déployé peut être hiberné")
+    return await hibernation_manager.hibernate_lab(lab_id)
+
+
+@router.post("/labs/{lab_id}/resume")
+async def resume_lab_endpoint(lab_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Restaure les VMs hibernées d'un laboratoire."""
+    lab = db.query(Lab).filter(Lab.id == lab_id).first()
+    if not lab:
+        raise HTTPException(status_code=404, detail="Lab non trouvé")
+    try:
+        return await hibernation_manager.resume_lab(lab_id)
+    except CapacityError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.put("/labs/{lab_id}/hibernation", response_model=LabResponse)
+async def update_hibernation_policy(lab_id: uuid.UUID, policy: HibernationPolicy, db: Session = Depends(get_db)):
+    """Définit la politique d'hibernation d'un laboratoire (champs nuls : valeurs globales)."""
+    lab = db.query(Lab).filter(Lab.id == lab_id).first()
+    if not lab:
+        raise HTTPException(status_code=404, detail="Lab non trouvé")
+    lab.hibernate_after_minutes = policy.idle_minutes
+    lab.hibernate_cpu_threshold = policy.cpu_threshold
+    db.commit()
+    db.refresh(lab)
+    return lab
+
+
+@router.get("/labs/{lab_id}/metrics")
+async def get_lab_metrics(lab_id: uuid.UUID, window: int = Query(3600, ge=60, le=7 * 86400)):
+    """Séries de métriques de toutes les VMs d'un lab, servies depuis la mémoire du collecteur."""
+    return vm_metrics_collector.lab_series(str(lab_id), window)
@@ -0,0 +1,27 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import uuid
+
+from services.session_recorder import RECORDINGS_DIR, RecordingReader, list_recordings
+
+router = APIRouter()
+
+
+@router.get("/recordings")
+async def get_recordings(vm_id: Optional[uuid.UUID] = Query(None)):
+    """Liste les enregistrements de sessions SSH (peut être filtré par vm_id)."""
+    return list_recordings(RECORDINGS_DIR, str(vm_id) if vm_id else None)
+
+
+@router.get("/recordings/{recording_id}/replay")
+async def replay_recording(recording_id: uuid.UUID, start: float = Query(0.0, ge=0)):
+    """Rejoue un enregistrement au format asciicast v2 à partir de `start` secondes."""
+    reader = RecordingReader(RECORDINGS_DIR, str(recording_id))
+    if not reader.exists():
+        raise HTTPException(status_code=404, detail="Enregistrement non trouvé")
+    
+    return StreamingResponse(
+        reader.stream(start),
+        media_type="application/x-asciicast"
+    )
@@ -7,6 +7,7 @@ from database import get_db
 from models import VM
 from schemas import VMResponse, SSHConnectionInfo, VNCConnectionInfo
 from services.vm_management import start_vm, stop_vm, restart_vm
+from services.vm_metrics import vm_metrics_collector
 
 router = APIRouter()
 
@@ -121,3 +122,9 @@ async def get_vnc_access(vm_id: uuid.UUID, db: Session = Depends(get_db)):
         port=vm.vnc_port
     )
 
+
+
+@router.get("/vms/{vm_id}/metrics")
+async def get_vm_metrics(vm_id: uuid.UUID, window: int = Query(3600, ge=60, le=7 * 86400)):
+    """Séries de métriques d'une VM, servies depuis la mémoire du collecteur."""
+    return vm_metrics_collector.vm_series(str(vm_id), window)
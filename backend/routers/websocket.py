@@ -1,41 +1,57 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
-from sqlalchemy.orm import Session
-from database import get_db
-from models import VM
-from services.websocket_service import websocket_proxy_service
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Query
+from services.vm_cache import vm_cache
+from services.hibernation import hibernation_manager
+from services.capacity import CapacityError
+from services.websocket_service import websocket_proxy_service, SSH_PROXY_MODE
+from services.session_recorder import recording_writer
+from services.multiplexer import MuxSession
+import os
 import uuid
 import logging
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Enregistrement de toutes les sessions SSH, en plus de l'opt-in par connexion (?record=true)
+SSH_RECORDING_ENABLED = os.getenv("SSH_RECORDING_ENABLED", "false").lower() == "true"
+
 
 @router.websocket("/ws/ssh/{vm_id}")
-async def websocket_ssh_endpoint(websocket: WebSocket, vm_id: str, db: Session = Depends(get_db)):
-    """Endpoint WebSocket pour les connexions SSH."""
+async def websocket_ssh_endpoint(websocket: WebSocket, vm_id: str):
+    """
+    Endpoint WebSocket pour les connexions SSH.
+    Aucune session de base de données n'est gardée pendant le relais.
+    """
     await websocket.accept()
     
     try:
         # Vérifier que la VM existe et récupérer ses informations
-        vm = db.query(VM).filter(VM.id == vm_id).first()
-        if not vm:
-            await websocket.send_text("Erreur: VM non trouvée")
+        target, error = await _resolve_vm_for_channel(vm_id, "ssh")
+        if error:
+            await websocket.send_text(f"Erreur: {error}")
             await websocket.close()
             return
+        host, port, lab_id = target
         
-        if not vm.ssh_port:
-            await websocket.send_text("Erreur: Port SSH non configuré pour cette VM")
-            await websocket.close()
-            return
+        # Démarrer l'enregistrement de la session si demandé
+        recorder = None
+        if SSH_RECORDING_ENABLED or websocket.query_params.get("record") == "true":
+            recorder = recording_writer.start_recording(
+                vm_id, lab_id,
+                width=int(websocket.query_params.get("cols", 80)),
+                height=int(websocket.query_params.get("rows", 24))
+            )
         
-        if vm.status != "running":
-            await websocket.send_text("Erreur: La VM n'est pas en cours d'exécution")
-            await websocket.close()
-            return
-        
-        # Établir la connexion SSH via le proxy
+        # Établir la connexion SSH via le proxy (binaire par défaut, texte sur demande)
+        text_mode = websocket.query_params.get("encoding") == "text"
+        native = (websocket.query_params.get("mode") or SSH_PROXY_MODE) == "native"
         await websocket_proxy_service.handle_ssh_connection(
-            websocket, vm_id, "localhost", vm.ssh_port
+            websocket, vm_id, host, port,
+            text_mode=text_mode, lab_id=lab_id, recorder=recorder,
+            compress=websocket.query_params.get("compress") == "deflate",
+            native=native,
+            cols=int(websocket.query_params.get("cols", 80)),
+            rows=int(websocket.query_params.get("rows", 24))
         )
         
     except WebSocketDisconnect:
@@ -54,31 +70,23 @@ async def websocket_ssh_endpoint(websocket: WebSocket, vm_id: str, db: Session =
 
 
 @router.websocket("/ws/vnc/{vm_id}")
-async def websocket_vnc_endpoint(websocket: WebSocket, vm_id: str, db: Session = Depends(get_db)):
+async def websocket_vnc_endpoint(websocket: WebSocket, vm_id: str):
     """Endpoint WebSocket pour les connexions VNC."""
     await websocket.accept()
     
     try:
         # Vérifier que la VM existe et récupérer ses informations
-        vm = db.query(VM).filter(VM.id == vm_id).first()
-        if not vm:
-            await websocket.send_text("Erreur: VM non trouvée")
-            await websocket.close()
-            return
-        
-        if not vm.vnc_port:
-            await websocket.send_text("Erreur: Port VNC non configuré pour cette VM")
-            await websocket.close()
-            return
-        
-        if vm.status != "running":
-            await websocket.send_text("Erreur: La VM n'est pas en cours d'exécution")
+        target, error = await _resolve_vm_for_channel(vm_id, "vnc")
+        if error:
+            await websocket.send_text(f"Erreur: {error}")
             await websocket.close()
             return
+        host, port, lab_id = target
         
         # Établir la connexion VNC via le proxy
         await websocket_proxy_service.handle_vnc_connection(
-            websocket, vm_id, "localhost", vm.vnc_port
+            websocket, vm_id, host, port, lab_id=lab_id,
+            compress=websocket.query_params.get("compress") == "deflate"
         )
         
     except WebSocketDisconnect:
@@ -96,19 +104,73 @@ async def websocket_vnc_endpoint(websocket: WebSocket, vm_id: str, db: Session =
             pass
 
 
+async def _resolve_vm_for_channel(vm_id: str, kind: str):
+    """Résout le port SSH ou VNC d'une VM via le cache (session courte en cas de défaut)."""
+    vm = await vm_cache.resolve(vm_id)
+    if vm is not None and vm.status == "hibernated" and vm.lab_id:
+        # Lab hiberné : reprise transparente avant l'ouverture du canal
+        try:
+            await hibernation_manager.resume_lab(vm.lab_id)
+        except CapacityError as e:
+            return None, str(e)
+        vm = await vm_cache.resolve(vm_id, refresh=True)
+    error = _check_vm_for_channel(vm, kind)
+    if error:
+        # Un refus est revérifié en base : l'entrée a pu changer sur un autre worker
+        vm = await vm_cache.resolve(vm_id, refresh=True)
+        error = _check_vm_for_channel(vm, kind)
+        if error:
+            return None, error
+    
+    port = vm.ssh_port if kind == "ssh" else vm.vnc_port
+    return ("localhost", port, vm.lab_id), None
+
+
+def _check_vm_for_channel(vm, kind: str):
+    if vm is None:
+        return "VM non trouvée"
+    
+    port = vm.ssh_port if kind == "ssh" else vm.vnc_port
+    if not port:
+        return f"Port {kind.upper()} non configuré pour cette VM"
+    
+    if vm.status != "running":
+        return "La VM n'est pas en cours d'exécution"
+    
+    return None
+
+
+@router.websocket("/ws/mux")
+async def websocket_mux_endpoint(websocket: WebSocket):
+    """Endpoint WebSocket multiplexé : plusieurs canaux SSH/VNC sur une seule connexion."""
+    await websocket.accept()
+    
+    session = MuxSession(websocket, websocket_proxy_service, _resolve_vm_for_channel)
+    try:
+        await session.run()
+    except WebSocketDisconnect:
+        logger.info("Connexion WebSocket multiplexée fermée")
+    except Exception as e:
+        logger.error(f"Erreur dans la connexion WebSocket multiplexée: {e}")
+    finally:
+        try:
+            await websocket.close()
+        except:
+            pass
+
+
 @router.get("/connections/{vm_id}")
 async def get_vm_connections(vm_id: str):
-    """Récupère les connexions actives pour une VM."""
-    connections = websocket_proxy_service.get_active_connections_for_vm(vm_id)
+    """Récupère les connexions actives pour une VM, tous workers confondus."""
+    connections = websocket_proxy_service.describe_connections_for_vm(vm_id)
     return {
         "vm_id": vm_id,
         "active_connections": len(connections),
-        "connections": [
-            {
-                "type": conn["type"],
-                "connection_time": "N/A"  # Pourrait être ajouté plus tard
-            }
-            for conn in connections
-        ]
+        "connections": connections
     }
 
+
+@router.get("/connections")
+async def get_connections_overview(limit: int = Query(10, ge=1, le=100)):
+    """Liste les connexions les plus actives et les plus inactives du proxy."""
+    return websocket_proxy_service.get_connections_overview(limit)
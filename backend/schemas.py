@@ -23,6 +23,7 @@ class VMResponse(BaseModel):
     ssh_port: Optional[int]
     vnc_port: Optional[int]
     status: str
+    domain_name: Optional[str] = None
     created_at: datetime
     updated_at: datetime
 
@@ -30,11 +31,19 @@ class VMResponse(BaseModel):
         from_attributes = True
 
 
+class HibernationPolicy(BaseModel):
+    # Minutes sans connexion avant hibernation (None = valeur globale, 0 = jamais)
+    idle_minutes: Optional[int] = Field(None, ge=0, le=7 * 24 * 60)
+    # CPU invité (%) au-delà duquel le lab reste actif même sans connexion
+    cpu_threshold: Optional[float] = Field(None, ge=0, le=100)
+
+
 class LabCreate(BaseModel):
     name: str
     description: Optional[str] = None
     vms: List[VMCreate]
     ansible_config_yaml: Optional[str] = None
+    hibernation: Optional[HibernationPolicy] = None
 
 
 class LabResponse(BaseModel):
@@ -42,6 +51,9 @@ class LabResponse(BaseModel):
     name: str
     description: Optional[str]
     status: str
+    hibernate_after_minutes: Optional[int] = None
+    hibernate_cpu_threshold: Optional[float] = None
+    last_activity_at: Optional[float] = None
     created_at: datetime
     updated_at: datetime
     vms: List[VMResponse] = []
@@ -0,0 +1,203 @@
+import asyncio
+import os
+import time
+import uuid
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from .executors import command_executor
+
+logger = logging.getLogger(__name__)
+
+
+class ForkBudget:
+    """Budget de forks Ansible partagé entre tous les workers, avec un plafond par lab."""
+
+    def __init__(self, total_forks: int, lab_forks: int):
+        self.total_forks = total_forks
+        self.lab_forks = min(lab_forks, total_forks)
+        self.available = total_forks
+        self.in_use_by_lab: Dict[uuid.UUID, int] = {}
+        self._condition = asyncio.Condition()
+
+    def _fits(self, lab_id: uuid.UUID, forks: int) -> bool:
+        used_by_lab = self.in_use_by_lab.get(lab_id, 0)
+        return self.available >= forks and used_by_lab + forks <= self.lab_forks
+
+    async def acquire(self, lab_id: uuid.UUID, wanted: int) -> int:
+        """Réserve des forks pour un lab, en attendant que le budget le permette."""
+        forks = max(1, min(wanted, self.lab_forks))
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._fits(lab_id, forks))
+            self.available -= forks
+            self.in_use_by_lab[lab_id] = self.in_use_by_lab.get(lab_id, 0) + forks
+        return forks
+
+    async def release(self, lab_id: uuid.UUID, forks: int):
+        """Rend des forks au budget global et au budget du lab."""
+        async with self._condition:
+            self.available += forks
+            remaining = self.in_use_by_lab.get(lab_id, 0) - forks
+            if remaining > 0:
+                self.in_use_by_lab[lab_id] = remaining
+            else:
+                self.in_use_by_lab.pop(lab_id, None)
+            self._condition.notify_all()
+
+
+class AnsibleJob:
+    """Exécution d'un playbook en attente dans la file de la ferme."""
+
+    def __init__(self, lab_id: uuid.UUID, command: List[str], working_dir: str,
+                 env: Dict[str, str], host_count: int):
+        self.id = uuid.uuid4()
+        self.lab_id = lab_id
+        self.command = command
+        self.working_dir = working_dir
+        self.env = env
+        self.host_count = host_count
+        self.submitted_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class AnsibleFarm:
+    """
+    Ferme d'exécution Ansible : un nombre fixe de workers consomme une file de jobs.
+    Chaque worker dispose de son propre répertoire de travail et de ses sockets
+    ControlPath, et les processus ansible-playbook sont lancés avec une priorité réduite
+    pour que les workers de l'API restent réactifs.
+    """
+
+    def __init__(self, workers: Optional[int] = None, total_forks: Optional[int] = None,
+                 lab_forks: Optional[int] = None, niceness: Optional[int] = None,
+                 base_dir: Optional[str] = None):
+        self.worker_count = workers or int(os.getenv("ANSIBLE_FARM_WORKERS", "4"))
+        self.total_forks = total_forks or int(os.getenv("ANSIBLE_FARM_FORKS", "20"))
+        self.lab_forks = lab_forks or int(os.getenv("ANSIBLE_FARM_LAB_FORKS", "5"))
+        self.niceness = niceness if niceness is not None else int(os.getenv("ANSIBLE_FARM_NICE", "10"))
+        self.base_dir = base_dir or os.getenv("ANSIBLE_FARM_DIR", "/tmp/ansible_farm")
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._budget: Optional[ForkBudget] = None
+        self._workers: List[asyncio.Task] = []
+        self._running_jobs: Dict[int, AnsibleJob] = {}
+
+    def _ensure_started(self):
+        """Démarre les workers dans la boucle courante au premier job soumis."""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._budget = ForkBudget(self.total_forks, self.lab_forks)
+        self._workers = [
+            asyncio.create_task(self._worker(index))
+            for index in range(self.worker_count)
+        ]
+
+    async def stop(self):
+        """Arrête les workers de la ferme."""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        self._budget = None
+
+    async def submit(self, lab_id: uuid.UUID, command: List[str], working_dir: str,
+                     env: Optional[Dict[str, str]] = None, host_count: int = 1) -> Tuple[int, str]:
+        """Place un playbook dans la file et attend son code de retour et sa sortie."""
+        self._ensure_started()
+        job = AnsibleJob(lab_id, command, working_dir, env or {}, host_count)
+        await self._queue.put(job)
+        return await job.future
+
+    def queue_depth(self) -> int:
+        """Nombre de jobs en attente d'un worker."""
+        return self._queue.qsize() if self._queue else 0
+
+    def get_stats(self) -> dict:
+        """Retourne l'état courant de la ferme."""
+        return {
+            "workers": self.worker_count,
+            "queued_jobs": self.queue_depth(),
+            "running_jobs": len(self._running_jobs),
+            "total_forks": self.total_forks,
+            "available_forks": self._budget.available if self._budget else self.total_forks,
+            "lab_forks": self.lab_forks,
+        }
+
+    def _worker_dirs(self, index: int) -> Tuple[str, str]:
+        worker_dir = os.path.join(self.base_dir, f"worker_{index}")
+        control_path_dir = os.path.join(worker_dir, "cp")
+        os.makedirs(control_path_dir, exist_ok=True)
+        os.makedirs(os.path.join(worker_dir, "tmp"), exist_ok=True)
+        return worker_dir, control_path_dir
+
+    async def _worker(self, index: int):
+        """Boucle d'un worker : consomme les jobs de la file un par un."""
+        worker_dir, control_path_dir = self._worker_dirs(index)
+
+        while True:
+            job = await self._queue.get()
+            if job.future.cancelled():
+                self._queue.task_done()
+                continue
+
+            self._running_jobs[index] = job
+            run = asyncio.ensure_future(self._run_job(job, worker_dir, control_path_dir))
+            # Job annulé par l'appelant : l'exécution est annulée et le processus tué
+            job.future.add_done_callback(lambda future, run=run: run.cancel() if future.cancelled() else None)
+            try:
+                await asyncio.wait((run,))
+            except asyncio.CancelledError:
+                # Arrêt de la ferme : le job en cours est annulé avec son processus
+                run.cancel()
+                await asyncio.gather(run, return_exceptions=True)
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            finally:
+                self._running_jobs.pop(index, None)
+                self._queue.task_done()
+
+            if run.cancelled() or job.future.done():
+                continue
+            if run.exception() is not None:
+                logger.error(f"Erreur du worker Ansible {index} pour le lab {job.lab_id}: {run.exception()}")
+                job.future.set_exception(run.exception())
+            else:
+                job.future.set_result(run.result())
+
+    async def _run_job(self, job: AnsibleJob, worker_dir: str, control_path_dir: str) -> Tuple[int, str]:
+        """Exécute un job dans l'environnement isolé du worker."""
+        forks = await self._budget.acquire(job.lab_id, job.host_count)
+
+        try:
+            env = {
+                **os.environ,
+                **job.env,
+                "ANSIBLE_FORKS": str(forks),
+                "ANSIBLE_SSH_CONTROL_PATH_DIR": control_path_dir,
+                "ANSIBLE_LOCAL_TEMP": os.path.join(worker_dir, "tmp"),
+            }
+
+            # Le processus et son groupe (forks, ssh) sont tués si le job est annulé
+            result = await command_executor.run(
+                [*job.command, "--forks", str(forks)],
+                cwd=job.working_dir,
+                env=env,
+                start_new_session=True,
+                preexec_fn=self._lower_priority
+            )
+            return result.returncode, result.stdout
+
+        finally:
+            await self._budget.release(job.lab_id, forks)
+
+    def _lower_priority(self):
+        """Réduit la priorité CPU du processus ansible-playbook (exécuté dans le fils)."""
+        if self.niceness:
+            os.nice(self.niceness)
+
+
+# Instance globale de la ferme
+ansible_farm = AnsibleFarm()
@@ -1,11 +1,17 @@
 import asyncio
 import subprocess
 import os
+import time
 import tempfile
 import yaml
 from pathlib import Path
 from sqlalchemy.orm import Session
 from models import Lab, VM, DeploymentLog
+from .ansible_farm import ansible_farm
+from .ssh_pool import ssh_transport_pool, SSHAuthenticationError, SSH_PROXY_MODE
+from .executors import command_executor
+from .telemetry import deploy_stage_duration
+from .tracing import span, record_span
 import uuid
 
 
@@ -46,12 +52,13 @@ class AnsibleService:
             self._generate_ansible_config(ansible_cfg_path)
             
             # Attendre que les VMs soient accessibles
-            await self._wait_for_vms_ready(lab, db)
+            with deploy_stage_duration.time(stage="ssh_wait"), span("ansible.ssh_wait", vms=len(lab.vms)):
+                await self._wait_for_vms_ready(lab, db)
             
             # Exécuter Ansible
             await self._run_ansible_command(
                 ["ansible-playbook", "-i", inventory_path, playbook_path, "-v"],
-                work_dir, lab.id, db
+                work_dir, lab.id, db, host_count=len(lab.vms)
             )
             
             return True
@@ -100,60 +107,76 @@ pipelining = True
         await self._log_info(lab.id, "Attente que les VMs soient prêtes pour SSH...", db)
         
         start_time = asyncio.get_event_loop().time()
+        waiting_since = time.time()
+        ready = set()
+        # Dernier refus d'authentification par VM (mode SSH natif)
+        auth_errors = {}
+        attempts = 0
         
         while True:
-            all_ready = True
+            attempts += 1
             
             for vm in lab.vms:
-                if not vm.ssh_port:
-                    all_ready = False
+                if vm.name in ready or not vm.ssh_port:
                     continue
                 
-                # Tester la connexion SSH
                 try:
-                    process = await asyncio.create_subprocess_exec(
-                        "nc", "-z", "localhost", str(vm.ssh_port),
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    
-                    await asyncio.wait_for(process.communicate(), timeout=5)
-                    
-                    if process.returncode != 0:
-                        all_ready = False
-                
-                except (asyncio.TimeoutError, Exception):
-                    all_ready = False
+                    vm_ready = await self._ssh_ready(vm.ssh_port)
+                except SSHAuthenticationError as e:
+                    # Journalisé au premier refus : la clé peut encore être en cours d'installation
+                    # par cloud-init, l'attente continue
+                    if vm.name not in auth_errors:
+                        await self._log_error(lab.id, f"VM {vm.name}: {e}", db)
+                    auth_errors[vm.name] = str(e)
+                    continue
+                if vm_ready:
+                    auth_errors.pop(vm.name, None)
+                    ready.add(vm.name)
+                    # Délai entre le début de l'attente et la première réponse SSH de la VM
+                    record_span("ssh_ready", waiting_since, time.time(), vm=vm.name, attempts=attempts)
             
-            if all_ready:
+            if len(ready) == len(lab.vms):
                 await self._log_info(lab.id, "Toutes les VMs sont prêtes pour SSH", db)
                 break
             
             # Vérifier le timeout
             if asyncio.get_event_loop().time() - start_time > timeout:
-                raise Exception(f"Timeout: Les VMs ne sont pas prêtes après {timeout} secondes")
+                detail = "".join(f"; {name}: {error}" for name, error in auth_errors.items())
+                raise Exception(f"Timeout: Les VMs ne sont pas prêtes après {timeout} secondes{detail}")
             
             await asyncio.sleep(10)
     
-    async def _run_ansible_command(self, command: list, working_dir: str, lab_id: uuid.UUID, db: Session):
-        """Exécute une commande Ansible et log la sortie."""
+    async def _ssh_ready(self, ssh_port: int) -> bool:
+        """Teste si une VM accepte les connexions SSH."""
+        # Session authentifiée via le pool en mode SSH natif seulement (elle utilise SSH_USERNAME
+        # et SSH_KEY_PATH) ; sinon, et sur une chaîne d'outils simulée, une sonde du port
+        if SSH_PROXY_MODE == "native" and ssh_transport_pool.available and command_executor.name == "subprocess":
+            return await ssh_transport_pool.is_ready("localhost", ssh_port)
+        
+        try:
+            result = await command_executor.run(
+                ["nc", "-z", "localhost", str(ssh_port)], merge_stderr=False, timeout=5
+            )
+            return result.returncode == 0
+        except (asyncio.TimeoutError, Exception):
+            return False
+    
+    async def _run_ansible_command(self, command: list, working_dir: str, lab_id: uuid.UUID, db: Session,
+                                   host_count: int = 1):
+        """Exécute une commande Ansible via la ferme d'exécution et log la sortie."""
         
         env = {
-            **os.environ,
             "ANSIBLE_CONFIG": os.path.join(working_dir, "ansible.cfg"),
             "ANSIBLE_HOST_KEY_CHECKING": "False"
         }
         
-        process = await asyncio.create_subprocess_exec(
-            *command,
-            cwd=working_dir,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            env=env
-        )
-        
-        output, _ = await process.communicate()
-        output_str = output.decode('utf-8')
+        with deploy_stage_duration.time(stage="ansible"), span("ansible.playbook", hosts=host_count) as current:
+            returncode, output_str = await ansible_farm.submit(
+                lab_id, command, working_dir, env=env, host_count=host_count
+            )
+            if current is not None:
+                current.attributes["returncode"] = returncode
+                current.status = "ok" if returncode == 0 else "error"
         
         # Logger la sortie
         log_entry = DeploymentLog(
@@ -164,7 +187,7 @@ pipelining = True
         db.add(log_entry)
         db.commit()
         
-        if process.returncode != 0:
+        if returncode != 0:
             raise Exception(f"Ansible command failed: {output_str}")
         
         return output_str
@@ -0,0 +1,333 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import Lab, VM, HostCapacity, CapacityReservation
+from .virt_backend import VirtBackend, virt_backend, LIBVIRT_URI
+
+logger = logging.getLogger(__name__)
+
+# Taux de surallocation admis par ressource (vCPU partagés, RAM et disque non surengagés par défaut)
+CPU_OVERCOMMIT_RATIO = float(os.getenv("CPU_OVERCOMMIT_RATIO", "4.0"))
+RAM_OVERCOMMIT_RATIO = float(os.getenv("RAM_OVERCOMMIT_RATIO", "1.0"))
+DISK_OVERCOMMIT_RATIO = float(os.getenv("DISK_OVERCOMMIT_RATIO", "1.0"))
+# Mémoire laissée au système hôte, retirée de la capacité de chaque hyperviseur
+HOST_RESERVED_RAM_MB = int(os.getenv("HOST_RESERVED_RAM_MB", "2048"))
+# "queue" : un déploiement qui ne tient pas attend la libération de ressources ; "reject" : refus immédiat
+ADMISSION_MODE = os.getenv("ADMISSION_MODE", "queue")
+# Capacités fixées par configuration, prioritaires sur celles relevées sur l'hyperviseur :
+# "uri=vcpu:ram_mb:disk_gb" séparés par des virgules
+HOST_CAPACITY = os.getenv("HOST_CAPACITY", "")
+
+RESOURCES = ("vcpu", "ram_mb", "disk_gb")
+
+
+class CapacityError(Exception):
+    """Le lab ne tient sur aucun hôte dans les limites de surallocation."""
+
+
+def parse_host_capacity(value: str) -> Dict[str, dict]:
+    capacities = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        host, spec = item.rsplit("=", 1)
+        vcpu, ram_mb, disk_gb = (int(part) for part in spec.split(":"))
+        capacities[host.strip()] = {'vcpu': vcpu, 'ram_mb': ram_mb, 'disk_gb': disk_gb}
+    return capacities
+
+
+def lab_demand(db: Session, lab_id) -> dict:
+    """Ressources demandées par les VMs d'un lab, en une requête."""
+    row = db.query(
+        func.coalesce(func.sum(VM.vcpu), 0),
+        func.coalesce(func.sum(VM.ram_mb), 0),
+        func.coalesce(func.sum(VM.disk_gb), 0)
+    ).filter(VM.lab_id == lab_id).one()
+    return dict(zip(RESOURCES, (int(value) for value in row)))
+
+
+def host_limits(host: HostCapacity) -> dict:
+    """Ressources allouables d'un hôte, surallocation comprise."""
+    return {
+        'vcpu': int(host.vcpu * CPU_OVERCOMMIT_RATIO),
+        'ram_mb': int(max(host.ram_mb - HOST_RESERVED_RAM_MB, 0) * RAM_OVERCOMMIT_RATIO),
+        'disk_gb': int(host.disk_gb * DISK_OVERCOMMIT_RATIO),
+    }
+
+
+def _fits(demand: dict, headroom: dict) -> bool:
+    return all(demand[resource] <= headroom[resource] for resource in RESOURCES)
+
+
+class CapacityLedger:
+    """
+    Registre des ressources réservées par hôte. Chaque lab déployé y détient une réservation,
+    prise à l'admission du déploiement et rendue à la destruction du lab ou à l'échec de son
+    déploiement ; les labs qui ne tiennent pas attendent dans une file servie dans l'ordre
+    d'arrivée. Un lab hiberné ne réserve plus de RAM jusqu'à sa reprise.
+    """
+
+    def __init__(self, backend: Optional[VirtBackend] = None, session_factory=SessionLocal,
+                 mode: str = ADMISSION_MODE):
+        self.backend = backend
+        self.session_factory = session_factory
+        self.mode = mode
+        # Les admissions d'un même processus sont sérialisées ; entre processus, les lignes
+        # des hôtes sont verrouillées (SELECT ... FOR UPDATE) le temps de la décision
+        self._lock = threading.Lock()
+
+    async def refresh_hosts(self):
+        """Relève la capacité des hyperviseurs et enregistre les labs déjà déployés sans réservation."""
+        capacities = parse_host_capacity(HOST_CAPACITY)
+        if not capacities:
+            try:
+                capacities = await (self.backend or virt_backend).host_capacity()
+            except Exception as e:
+                logger.error(f"Impossible de relever la capacité des hyperviseurs: {e}")
+        await asyncio.to_thread(self._store_hosts, capacities)
+
+    def _store_hosts(self, capacities: Dict[str, dict]):
+        db = self.session_factory()
+        try:
+            for host, capacity in capacities.items():
+                db.merge(HostCapacity(host=host, **capacity))
+
+            reserved = select(CapacityReservation.lab_id)
+            default_host = next(iter(capacities), LIBVIRT_URI.split(",")[0].strip())
+            for (lab_id,) in db.query(Lab.id).filter(Lab.status == "deployed", ~Lab.id.in_(reserved)):
+                db.add(CapacityReservation(
+                    lab_id=lab_id, host=default_host, state="reserved",
+                    requested_at=time.time(), **lab_demand(db, lab_id)
+                ))
+            db.commit()
+        finally:
+            db.close()
+
+    def _usage(self, db: Session, exclude_lab=None) -> Dict[str, dict]:
+        query = db.query(
+            CapacityReservation.host,
+            func.sum(CapacityReservation.vcpu),
+            func.sum(CapacityReservation.ram_mb),
+            func.sum(CapacityReservation.disk_gb)
+        ).filter(CapacityReservation.state == "reserved")
+        if exclude_lab is not None:
+            query = query.filter(CapacityReservation.lab_id != exclude_lab)
+        return {
+            host: dict(zip(RESOURCES, (int(value or 0) for value in values)))
+            for host, *values in query.group_by(CapacityReservation.host)
+        }
+
+    def _headroom(self, hosts: List[HostCapacity], usage: Dict[str, dict]) -> Dict[str, dict]:
+        headroom = {}
+        for host in hosts:
+            limits = host_limits(host)
+            used = usage.get(host.host, {})
+            headroom[host.host] = {resource: limits[resource] - used.get(resource, 0) for resource in RESOURCES}
+        return headroom
+
+    @staticmethod
+    def _place(demand: dict, headroom: Dict[str, dict]) -> Optional[str]:
+        """Hôte retenu : celui qui garde le plus de RAM libre parmi ceux où le lab tient."""
+        candidates = [host for host, free in headroom.items() if _fits(demand, free)]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda host: headroom[host]['ram_mb'] - demand['ram_mb'])
+
+    def admit(self, db: Session, lab_id: uuid.UUID) -> Tuple[str, Optional[str]]:
+        """
+        Admission d'un déploiement : réserve les ressources du lab sur un hôte et retourne
+        ("reserved", hôte), ou met le lab en file d'attente et retourne ("queued", None).
+        Lève CapacityError si le lab ne tient pas (mode "reject") ou ne tiendra jamais.
+        Valide la transaction.
+        """
+        with self._lock:
+            try:
+                hosts = db.query(HostCapacity).order_by(HostCapacity.host).with_for_update().all()
+                demand = lab_demand(db, lab_id)
+                reservation = db.query(CapacityReservation).filter(CapacityReservation.lab_id == lab_id).first()
+
+                if not hosts:
+                    # Capacité inconnue (hyperviseur injoignable au démarrage) : comptabilité seule
+                    host = reservation.host if reservation and reservation.host else LIBVIRT_URI.split(",")[0].strip()
+                else:
+                    headroom = self._headroom(hosts, self._usage(db, exclude_lab=lab_id))
+                    # Les labs déjà en attente passent en premier
+                    waiting = db.query(CapacityReservation).filter(
+                        CapacityReservation.state == "queued", CapacityReservation.lab_id != lab_id
+                    ).count()
+                    host = self._place(demand, headroom) if not waiting else None
+                    if host is None:
+                        self._refuse(demand, hosts, headroom, waiting)
+
+                if reservation is None:
+                    reservation = CapacityReservation(lab_id=lab_id, requested_at=time.time())
+                    db.add(reservation)
+                reservation.vcpu, reservation.ram_mb, reservation.disk_gb = (demand[r] for r in RESOURCES)
+                reservation.host = host
+                reservation.state = "reserved" if host else "queued"
+                db.commit()
+                return reservation.state, host
+            except Exception:
+                db.rollback()
+                raise
+
+    def _refuse(self, demand: dict, hosts: List[HostCapacity], headroom: Dict[str, dict], waiting: int):
+        """Le lab ne tient pas maintenant : erreur, sauf en mode file d'attente s'il peut tenir un jour."""
+        if not any(_fits(demand, host_limits(host)) for host in hosts):
+            raise CapacityError(
+                "Le lab dépasse la capacité de tous les hôtes ("
+                + ", ".join(f"{resource} {demand[resource]}" for resource in RESOURCES) + ")"
+            )
+        if self.mode == "queue":
+            return
+        if waiting:
+            raise CapacityError(f"Capacité insuffisante: {waiting} lab(s) en attente")
+        best = max(headroom.values(), key=lambda free: free['ram_mb'])
+        raise CapacityError("Capacité insuffisante: " + ", ".join(
+            f"{resource} {demand[resource]} demandés pour {max(best[resource], 0)} disponibles"
+            for resource in RESOURCES if demand[resource] > best[resource]
+        ))
+
+    def release(self, db: Session, lab_id: uuid.UUID):
+        """Rend les ressources d'un lab (la transaction est validée par l'appelant)."""
+        db.query(CapacityReservation).filter(
+            CapacityReservation.lab_id == lab_id
+        ).delete(synchronize_session=False)
+
+    def suspend(self, db: Session, lab_id: uuid.UUID) -> bool:
+        """
+        Rend la RAM d'un lab hiberné : ses vCPU et son disque (image et état sauvegardé)
+        restent réservés. Indique si de la RAM a été rendue. La transaction est validée par l'appelant.
+        """
+        return db.query(CapacityReservation).filter(
+            CapacityReservation.lab_id == lab_id, CapacityReservation.state == "reserved",
+            CapacityReservation.ram_mb > 0
+        ).update({CapacityReservation.ram_mb: 0}, synchronize_session=False) > 0
+
+    def resume(self, db: Session, lab_id: uuid.UUID) -> str:
+        """
+        Admission de la reprise d'un lab hiberné : sa RAM est réservée à nouveau sur son hôte,
+        où ses domaines sont sauvegardés, avant les labs en attente. Lève CapacityError si
+        elle n'y tient plus. Valide la transaction.
+        """
+        with self._lock:
+            try:
+                demand = lab_demand(db, lab_id)
+                reservation = db.query(CapacityReservation).filter(CapacityReservation.lab_id == lab_id).first()
+                if reservation is None or reservation.state != "reserved":
+                    # Lab hiberné sans réservation (registre vidé) : comptabilité seule
+                    if reservation is None:
+                        reservation = CapacityReservation(lab_id=lab_id, requested_at=time.time())
+                        db.add(reservation)
+                    reservation.vcpu, reservation.ram_mb, reservation.disk_gb = (demand[r] for r in RESOURCES)
+                    reservation.host = reservation.host or LIBVIRT_URI.split(",")[0].strip()
+                    reservation.state = "reserved"
+                    db.commit()
+                    return reservation.host
+
+                host = db.query(HostCapacity).filter(
+                    HostCapacity.host == reservation.host
+                ).with_for_update().first()
+                if host is not None:
+                    free = self._headroom([host], self._usage(db, exclude_lab=lab_id))[host.host]['ram_mb']
+                    if demand['ram_mb'] > free:
+                        raise CapacityError(
+                            f"RAM insuffisante sur {host.host} pour reprendre le lab: "
+                            f"{demand['ram_mb']} MB demandés pour {max(free, 0)} disponibles"
+                        )
+                reservation.ram_mb = demand['ram_mb']
+                db.commit()
+                return reservation.host
+            except Exception:
+                db.rollback()
+                raise
+
+    def host_for(self, db: Session, lab_id: uuid.UUID) -> Optional[str]:
+        row = db.query(CapacityReservation.host).filter(
+            CapacityReservation.lab_id == lab_id, CapacityReservation.state == "reserved"
+        ).first()
+        return row.host if row else None
+
+    def drain_queue(self) -> List[uuid.UUID]:
+        """
+        Admet les labs en attente dans l'ordre d'arrivée, jusqu'au premier qui ne tient pas.
+        Les labs admis passent en statut "deploying" ; retourne leurs identifiants.
+        """
+        with self._lock:
+            db = self.session_factory()
+            try:
+                hosts = db.query(HostCapacity).order_by(HostCapacity.host).with_for_update().all()
+                headroom = self._headroom(hosts, self._usage(db))
+                admitted = []
+                queued = db.query(CapacityReservation).filter(
+                    CapacityReservation.state == "queued"
+                ).order_by(CapacityReservation.requested_at)
+                for reservation in queued:
+                    demand = {resource: getattr(reservation, resource) for resource in RESOURCES}
+                    host = self._place(demand, headroom) if hosts else LIBVIRT_URI.split(",")[0].strip()
+                    if host is None:
+                        break
+                    if hosts:
+                        for resource in RESOURCES:
+                            headroom[host][resource] -= demand[resource]
+                    reservation.host = host
+                    reservation.state = "reserved"
+                    admitted.append(reservation.lab_id)
+                if admitted:
+                    db.query(Lab).filter(Lab.id.in_(admitted)).update(
+                        {Lab.status: "deploying"}, synchronize_session=False
+                    )
+                db.commit()
+                return admitted
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def snapshot(self, db: Session) -> dict:
+        """Capacité, réservations et marge de chaque hôte, et file d'attente."""
+        hosts = db.query(HostCapacity).order_by(HostCapacity.host).all()
+        usage = self._usage(db)
+        headroom = self._headroom(hosts, usage)
+        queue = db.query(CapacityReservation).filter(
+            CapacityReservation.state == "queued"
+        ).order_by(CapacityReservation.requested_at).all()
+        return {
+            'admission_mode': self.mode,
+            'overcommit_ratios': {
+                'vcpu': CPU_OVERCOMMIT_RATIO, 'ram_mb': RAM_OVERCOMMIT_RATIO, 'disk_gb': DISK_OVERCOMMIT_RATIO
+            },
+            'hosts': [
+                {
+                    'host': host.host,
+                    'capacity': {resource: getattr(host, resource) for resource in RESOURCES},
+                    'limits': host_limits(host),
+                    'reserved': usage.get(host.host, dict.fromkeys(RESOURCES, 0)),
+                    'headroom': headroom[host.host]
+                }
+                for host in hosts
+            ],
+            'queue': [
+                {
+                    'lab_id': str(reservation.lab_id),
+                    'position': position,
+                    'demand': {resource: getattr(reservation, resource) for resource in RESOURCES},
+                    'queued_seconds': round(time.time() - reservation.requested_at, 1)
+                }
+                for position, reservation in enumerate(queue, 1)
+            ]
+        }
+
+
+# Instance globale du registre de capacité
+capacity_ledger = CapacityLedger()
@@ -0,0 +1,104 @@
+import os
+import time
+import zlib
+from typing import Tuple
+
+# Les petits messages (frappes clavier, échos) ne gagnent rien à être compressés
+COMPRESSION_MIN_SIZE = 256
+# Au-delà de ce ratio (taille compressée / taille d'origine), la compression est désactivée
+COMPRESSION_MAX_RATIO = float(os.getenv("COMPRESSION_MAX_RATIO", "0.85"))
+# En dessous de ce débit de compression (octets/s), le coût CPU est jugé trop élevé
+COMPRESSION_MIN_THROUGHPUT = float(os.getenv("COMPRESSION_MIN_THROUGHPUT", str(20 * 1024 * 1024)))
+# Une fois désactivée, la compression est réessayée après ce volume de données
+COMPRESSION_PROBE_INTERVAL = 1024 * 1024
+COMPRESSION_LEVEL = 1
+# Poids de la dernière mesure dans la moyenne glissante du ratio
+COMPRESSION_EWMA_WEIGHT = 0.2
+
+# Préfixe d'un message binaire sur /ws/ssh et /ws/vnc quand le client a demandé ?compress=deflate
+PREFIX_RAW = b"\x00"
+PREFIX_DEFLATE = b"\x01"
+
+
+class AdaptiveDeflate:
+    """
+    Compression deflate brute (format permessage-deflate, sans reprise de contexte)
+    activée ou désactivée par connexion selon le ratio et le coût CPU observés.
+    Chaque message compressé est autonome : on peut basculer à tout moment.
+    """
+
+    __slots__ = (
+        'enabled', 'ratio', 'bytes_in', 'bytes_out', 'cpu_seconds',
+        'messages_compressed', '_bytes_since_probe'
+    )
+
+    def __init__(self):
+        self.enabled = True
+        self.ratio = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+        self.messages_compressed = 0
+        self._bytes_since_probe = 0
+
+    def encode(self, data: bytes) -> Tuple[bool, bytes]:
+        """Retourne (compressé, charge utile) pour un message sortant."""
+        size = len(data)
+        self.bytes_in += size
+
+        if size < COMPRESSION_MIN_SIZE:
+            self.bytes_out += size
+            return False, data
+
+        if not self.enabled:
+            self._bytes_since_probe += size
+            if self._bytes_since_probe < COMPRESSION_PROBE_INTERVAL:
+                self.bytes_out += size
+                return False, data
+            # Sonde : réévaluer le gain sur ce message
+            self._bytes_since_probe = 0
+
+        start = time.perf_counter()
+        compressed = zlib.compress(data, COMPRESSION_LEVEL, wbits=-zlib.MAX_WBITS)
+        cost = time.perf_counter() - start
+        self.cpu_seconds += cost
+
+        ratio = len(compressed) / size
+        if self.ratio is None:
+            self.ratio = ratio
+        else:
+            self.ratio += COMPRESSION_EWMA_WEIGHT * (ratio - self.ratio)
+
+        self.enabled = (
+            self.ratio <= COMPRESSION_MAX_RATIO
+            and size / max(cost, 1e-9) >= COMPRESSION_MIN_THROUGHPUT
+        )
+
+        if len(compressed) >= size:
+            self.bytes_out += size
+            return False, data
+
+        self.bytes_out += len(compressed)
+        self.messages_compressed += 1
+        return True, compressed
+
+    def encode_prefixed(self, data: bytes) -> bytes:
+        """Encode un message avec le préfixe d'un octet des endpoints directs."""
+        compressed, payload = self.encode(data)
+        return (PREFIX_DEFLATE if compressed else PREFIX_RAW) + payload
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.bytes_in - self.bytes_out
+
+    def to_dict(self) -> dict:
+        """Retourne les métriques de compression sous forme sérialisable."""
+        return {
+            'enabled': self.enabled,
+            'ratio': round(self.ratio, 3) if self.ratio is not None else None,
+            'bytes_before': self.bytes_in,
+            'bytes_after': self.bytes_out,
+            'saved_bytes': self.saved_bytes,
+            'messages_compressed': self.messages_compressed,
+            'cpu_ms': round(self.cpu_seconds * 1000, 3)
+        }
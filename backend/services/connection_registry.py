@@ -0,0 +1,115 @@
+import heapq
+import time
+from typing import Dict, List, Optional
+
+
+class ConnectionRecord:
+    """Connexion proxy active et ses compteurs de trafic."""
+
+    __slots__ = (
+        'connection_id', 'type', 'vm_id', 'lab_id', 'websocket', 'reader', 'writer',
+        'started_at', 'last_activity', 'bytes_in', 'bytes_out', 'frames_out',
+        'to_client_queue', 'to_vm_queue', 'compressor'
+    )
+
+    def __init__(self, connection_id: str, type: str, vm_id: str, lab_id: Optional[str],
+                 websocket, reader, writer):
+        self.connection_id = connection_id
+        self.type = type
+        self.vm_id = vm_id
+        self.lab_id = lab_id
+        self.websocket = websocket
+        self.reader = reader
+        self.writer = writer
+        self.started_at = time.time()
+        self.last_activity = self.started_at
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_out = 0
+        self.to_client_queue = None
+        self.to_vm_queue = None
+        self.compressor = None
+
+    def to_dict(self, now: Optional[float] = None) -> dict:
+        """Retourne les métriques de la connexion sous forme sérialisable."""
+        now = now or time.time()
+        duration = max(now - self.started_at, 1e-6)
+        return {
+            'connection_id': self.connection_id,
+            'type': self.type,
+            'vm_id': self.vm_id,
+            'lab_id': self.lab_id,
+            'connection_time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started_at)),
+            'duration_seconds': round(duration, 3),
+            'idle_seconds': round(now - self.last_activity, 3),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_out': self.frames_out,
+            'throughput_in_bps': round(self.bytes_in / duration),
+            'throughput_out_bps': round(self.bytes_out / duration),
+            'queue_depth': {
+                'to_client': self.to_client_queue.qsize() if self.to_client_queue else 0,
+                'to_vm': self.to_vm_queue.qsize() if self.to_vm_queue else 0
+            },
+            'compression': self.compressor.to_dict() if self.compressor else None
+        }
+
+
+class ConnectionRegistry:
+    """Registre des connexions proxy, indexé par identifiant, par VM et par lab."""
+
+    def __init__(self):
+        self._by_id: Dict[str, ConnectionRecord] = {}
+        self._by_vm: Dict[str, Dict[str, ConnectionRecord]] = {}
+        self._by_lab: Dict[str, Dict[str, ConnectionRecord]] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def add(self, record: ConnectionRecord):
+        """Enregistre une connexion dans tous les index."""
+        self._by_id[record.connection_id] = record
+        self._by_vm.setdefault(record.vm_id, {})[record.connection_id] = record
+        if record.lab_id:
+            self._by_lab.setdefault(record.lab_id, {})[record.connection_id] = record
+
+    def remove(self, connection_id: str) -> Optional[ConnectionRecord]:
+        """Retire une connexion de tous les index."""
+        record = self._by_id.pop(connection_id, None)
+        if record is None:
+            return None
+
+        self._discard(self._by_vm, record.vm_id, connection_id)
+        if record.lab_id:
+            self._discard(self._by_lab, record.lab_id, connection_id)
+        return record
+
+    @staticmethod
+    def _discard(index: Dict[str, Dict[str, ConnectionRecord]], key: str, connection_id: str):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(connection_id, None)
+            if not bucket:
+                del index[key]
+
+    def get(self, connection_id: str) -> Optional[ConnectionRecord]:
+        return self._by_id.get(connection_id)
+
+    def for_vm(self, vm_id: str) -> List[ConnectionRecord]:
+        """Connexions actives d'une VM."""
+        return list(self._by_vm.get(vm_id, {}).values())
+
+    def for_lab(self, lab_id: str) -> List[ConnectionRecord]:
+        """Connexions actives d'un lab."""
+        return list(self._by_lab.get(lab_id, {}).values())
+
+    def all(self) -> List[ConnectionRecord]:
+        return list(self._by_id.values())
+
+    def busiest(self, limit: int = 10) -> List[ConnectionRecord]:
+        """Connexions ayant relayé le plus d'octets."""
+        return heapq.nlargest(limit, self._by_id.values(), key=lambda r: r.bytes_in + r.bytes_out)
+
+    def idle(self, limit: int = 10) -> List[ConnectionRecord]:
+        """Connexions inactives depuis le plus longtemps."""
+        return heapq.nsmallest(limit, self._by_id.values(), key=lambda r: r.last_activity)
@@ -1,10 +1,26 @@
 import asyncio
-from sqlalchemy.orm import Session
-from models import Lab, VM, DeploymentLog
+import logging
+import time
+from sqlalchemy.orm import Session, selectinload
+from models import Lab, VM, DeploymentLog, DeploymentSpan
 from .terraform_service import TerraformService
 from .ansible_service import AnsibleService
+from .teardown import destroy_lab_resources
+from .websocket_service import websocket_proxy_service
+from .capacity import capacity_ledger
+from .telemetry import deploy_duration
+from .tracing import begin_trace, end_trace, span
+from database import SessionLocal
 import uuid
 
+logger = logging.getLogger(__name__)
+
+# Déploiements lancés hors requête (file d'attente), référencés jusqu'à leur fin
+_queued_deployments = set()
+
+# Labs en cours de démontage dans ce processus : une suppression relancée ne les démonte pas deux fois
+_teardowns = set()
+
 
 async def deploy_lab(lab_id: uuid.UUID, db: Session):
     """
@@ -13,13 +29,27 @@ async def deploy_lab(lab_id: uuid.UUID, db: Session):
     """
     terraform_service = TerraformService()
     ansible_service = AnsibleService()
+    started = time.perf_counter()
+    lab = None
+    trace = None
     
     try:
-        # Récupérer le lab depuis la base de données
-        lab = db.query(Lab).filter(Lab.id == lab_id).first()
+        # Le déploiement dure plusieurs minutes de commandes externes : les objets chargés
+        # ici ne sont pas relus après chaque commit de journal, si bien que la session ne
+        # garde pas de connexion du pool (transaction ouverte) pendant les commandes.
+        db.expire_on_commit = False
+
+        # Récupérer le lab et ses VMs depuis la base de données
+        lab = db.query(Lab).options(selectinload(Lab.vms)).filter(Lab.id == lab_id).first()
         if not lab:
             return
         
+        # Hyperviseur retenu à l'admission du déploiement
+        host = capacity_ledger.host_for(db, lab_id)
+        
+        # Chronologie des étapes, écrite en une fois à la fin du déploiement
+        trace = begin_trace(lab_id, host=host, vms=len(lab.vms))
+        
         # Mettre à jour le statut
         lab.status = "deploying"
         db.commit()
@@ -33,7 +63,8 @@ async def deploy_lab(lab_id: uuid.UUID, db: Session):
         db.add(log_entry)
         db.commit()
         
-        terraform_success = await terraform_service.deploy_lab(lab, db)
+        with span("terraform"):
+            terraform_success = await terraform_service.deploy_lab(lab, db, host)
         
         if not terraform_success:
             lab.status = "error"
@@ -52,7 +83,8 @@ async def deploy_lab(lab_id: uuid.UUID, db: Session):
             db.add(log_entry)
             db.commit()
             
-            ansible_success = await ansible_service.configure_lab(lab, db)
+            with span("ansible"):
+                ansible_success = await ansible_service.configure_lab(lab, db)
             
             if not ansible_success:
                 lab.status = "error"
@@ -84,37 +116,107 @@ async def deploy_lab(lab_id: uuid.UUID, db: Session):
         )
         db.add(error_log)
         db.commit()
+    
+    finally:
+        if lab is not None:
+            deploy_duration.observe(time.perf_counter() - started, status=lab.status)
+        if trace is not None:
+            end_trace(trace, "ok" if lab.status == "deployed" else "error", lab_status=lab.status)
+            try:
+                await asyncio.to_thread(trace.save)
+            except Exception as e:
+                logger.warning(f"Chronologie du déploiement du lab {lab_id} non enregistrée: {e}")
+        if lab is not None and lab.status != "deployed":
+            # Déploiement échoué ou interrompu : la réservation prise à l'admission est rendue
+            await _release_reservation(lab_id, db, drain=lab.status == "error")
+
+
+async def _release_reservation(lab_id: uuid.UUID, db: Session, drain: bool):
+    """Rend les ressources réservées d'un lab et, sur demande, admet les labs en attente."""
+    try:
+        capacity_ledger.release(db, lab_id)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Réservation du lab {lab_id} non rendue: {e}")
+        return
+    if drain:
+        await deploy_queued_labs()
 
 
 async def destroy_lab(lab_id: uuid.UUID, db: Session):
-    """Détruit l'infrastructure d'un laboratoire."""
-    terraform_service = TerraformService()
-    
+    """
+    Détruit l'infrastructure d'un laboratoire puis le supprime de la base.
+    Cette fonction est exécutée en arrière-plan ; les ressources qui n'ont pas pu être
+    détruites sont reprises par le ramasse-miettes des ressources orphelines. Une
+    suppression relancée (lab resté « deleting » après un redémarrage du worker) reprend
+    le démontage, sauf s'il est encore en cours dans ce processus.
+    """
+    if lab_id in _teardowns:
+        return False
+    _teardowns.add(lab_id)
+    try:
+        return await _destroy_lab(lab_id, db)
+    finally:
+        _teardowns.discard(lab_id)
+
+
+async def _destroy_lab(lab_id: uuid.UUID, db: Session):
     try:
         lab = db.query(Lab).filter(Lab.id == lab_id).first()
         if not lab:
-            return
-        
-        # Détruire l'infrastructure Terraform
-        success = await terraform_service.destroy_lab(lab, db)
-        
-        if success:
-            # Mettre à jour le statut des VMs
-            for vm in lab.vms:
-                vm.status = "deleted"
-            
-            lab.status = "deleted"
-            db.commit()
-        
-        return success
-        
-    except Exception as e:
-        error_log = DeploymentLog(
-            lab_id=lab_id,
-            log_type="error",
-            content=f"Erreur lors de la destruction: {str(e)}"
-        )
-        db.add(error_log)
+            return False
+
+        # Couper les consoles ouvertes avant de détruire les domaines
+        for (vm_id,) in db.query(VM.id).filter(VM.lab_id == lab_id):
+            await websocket_proxy_service.close_all_connections_for_vm(str(vm_id))
+
+        errors = await destroy_lab_resources(lab_id)
+        for error in errors:
+            logger.warning(f"Destruction incomplète du lab {lab_id}: {error}")
+
+        db.query(DeploymentLog).filter(DeploymentLog.lab_id == lab_id).delete(synchronize_session=False)
+        db.query(DeploymentSpan).filter(DeploymentSpan.lab_id == lab_id).delete(synchronize_session=False)
+        capacity_ledger.release(db, lab_id)
+        db.delete(lab)
         db.commit()
+
+        # Les ressources rendues peuvent permettre de déployer des labs en attente
+        await deploy_queued_labs()
+        return not errors
+
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Erreur lors de la destruction du lab {lab_id}: {e}")
+        lab = db.query(Lab).filter(Lab.id == lab_id).first()
+        if lab:
+            lab.status = "error"
+            db.add(DeploymentLog(
+                lab_id=lab_id,
+                log_type="error",
+                content=f"Erreur lors de la destruction: {str(e)}"
+            ))
+            db.commit()
         return False
 
+
+async def _deploy_in_session(lab_id: uuid.UUID):
+    db = SessionLocal()
+    try:
+        await deploy_lab(lab_id, db)
+    finally:
+        db.close()
+
+
+async def deploy_queued_labs():
+    """Lance le déploiement des labs en attente pour lesquels des ressources sont disponibles."""
+    try:
+        admitted = await asyncio.to_thread(capacity_ledger.drain_queue)
+    except Exception as e:
+        logger.error(f"Erreur lors de l'admission des labs en attente: {e}")
+        return
+    for lab_id in admitted:
+        logger.info(f"Lab {lab_id} admis depuis la file d'attente")
+        task = asyncio.create_task(_deploy_in_session(lab_id))
+        _queued_deployments.add(task)
+        task.add_done_callback(_queued_deployments.discard)
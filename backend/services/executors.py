@@ -0,0 +1,304 @@
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import signal
+import time
+import uuid
+import logging
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# "subprocess" (binaires réels) ou "fake" (chaîne d'outils simulée pour les tests et benchmarks)
+COMMAND_EXECUTOR = os.getenv("COMMAND_EXECUTOR", "subprocess")
+# Exécuteur simulé : facteur appliqué aux latences et taux d'échec forcé (vide = profils)
+FAKE_EXECUTOR_TIME_SCALE = float(os.getenv("FAKE_EXECUTOR_TIME_SCALE", "1"))
+FAKE_EXECUTOR_FAILURE_RATE = os.getenv("FAKE_EXECUTOR_FAILURE_RATE", "")
+
+# Longueur maximale d'une ligne lue en continu (sorties JSON de terraform)
+STREAM_LINE_LIMIT = 16 * 1024 * 1024
+
+
+class CommandResult:
+    """Code de retour et sorties d'une commande externe."""
+
+    __slots__ = ('returncode', 'stdout', 'stderr')
+
+    def __init__(self, returncode: int, stdout: str, stderr: str = ""):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class CommandExecutor(ABC):
+    """
+    Interface commune d'exécution des outils externes (terraform, ansible-playbook, virsh, nc).
+    Un exécuteur qui n'implémente pas `run` échoue dès son instanciation.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def run(self, command: Sequence[str], cwd: Optional[str] = None,
+                  env: Optional[Dict[str, str]] = None, merge_stderr: bool = True,
+                  timeout: Optional[float] = None, on_line: Optional[Callable[[str], None]] = None,
+                  **options) -> CommandResult:
+        """
+        Exécute une commande et attend sa fin. Avec `merge_stderr`, les erreurs sont
+        entrelacées dans `stdout`. `on_line` reçoit chaque ligne de `stdout` dès qu'elle
+        est produite. Lève asyncio.TimeoutError après `timeout` secondes.
+        """
+
+
+class SubprocessExecutor(CommandExecutor):
+    """Exécution réelle dans un sous-processus ; `options` est transmis à create_subprocess_exec."""
+
+    name = "subprocess"
+
+    async def run(self, command: Sequence[str], cwd: Optional[str] = None,
+                  env: Optional[Dict[str, str]] = None, merge_stderr: bool = True,
+                  timeout: Optional[float] = None, on_line: Optional[Callable[[str], None]] = None,
+                  **options) -> CommandResult:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT if merge_stderr else asyncio.subprocess.PIPE,
+            env=env,
+            limit=STREAM_LINE_LIMIT,
+            **options
+        )
+        try:
+            if on_line is None:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            else:
+                stdout, stderr = await asyncio.wait_for(self._stream(process, on_line), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            self._kill(process, options.get("start_new_session", False))
+            raise
+        return CommandResult(
+            process.returncode,
+            stdout.decode('utf-8', errors='replace'),
+            stderr.decode('utf-8', errors='replace') if stderr else ""
+        )
+
+    @staticmethod
+    def _kill(process, group: bool):
+        """
+        Tue le processus. Lancé dans sa propre session, tout son groupe est tué : les forks
+        d'ansible-playbook et leurs `ssh` ne survivent pas au processus principal.
+        """
+        try:
+            if group:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    async def _stream(process, on_line: Callable[[str], None]) -> Tuple[bytes, bytes]:
+        stderr_task = asyncio.ensure_future(process.stderr.read()) if process.stderr else None
+        try:
+            chunks = []
+            async for line in process.stdout:
+                chunks.append(line)
+                on_line(line.decode('utf-8', errors='replace'))
+            stderr = await stderr_task if stderr_task else b""
+            await process.wait()
+            return b"".join(chunks), stderr
+        finally:
+            if stderr_task and not stderr_task.done():
+                stderr_task.cancel()
+
+
+class FakeProfile:
+    """
+    Comportement simulé d'une commande : latence de base plus une part par unité
+    (VM du plan Terraform, hôte de l'inventaire Ansible), gigue relative, volume de
+    sortie et taux d'échec.
+    """
+
+    __slots__ = ('latency', 'per_unit', 'jitter', 'lines', 'lines_per_unit', 'failure_rate')
+
+    def __init__(self, latency: float, per_unit: float = 0.0, jitter: float = 0.2,
+                 lines: int = 0, lines_per_unit: int = 0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.per_unit = per_unit
+        self.jitter = jitter
+        self.lines = lines
+        self.lines_per_unit = lines_per_unit
+        self.failure_rate = failure_rate
+
+
+# Ordres de grandeur relevés sur un hyperviseur local (images de base en cache)
+DEFAULT_PROFILES = {
+    "terraform init": FakeProfile(2.5, lines=25),
+    "terraform plan": FakeProfile(1.5, per_unit=0.3, lines=20, lines_per_unit=45),
+    "terraform apply": FakeProfile(8.0, per_unit=4.0, lines=15, lines_per_unit=60, failure_rate=0.02),
+    "terraform output": FakeProfile(0.4),
+    "terraform destroy": FakeProfile(3.0, per_unit=1.5, lines=10, lines_per_unit=20),
+    "ansible-playbook": FakeProfile(6.0, per_unit=2.0, lines=20, lines_per_unit=30, failure_rate=0.03),
+    "virsh": FakeProfile(0.05, jitter=0.5),
+    "nc": FakeProfile(0.01, jitter=0.5),
+}
+
+# Sorties Terraform d'un domaine déclaré dans main.tf : output "<domaine>_domain"
+_TF_DOMAIN_OUTPUT = re.compile(r'^output "(\w+)_domain"', re.MULTILINE)
+_INVENTORY_HOST = re.compile(r'^\S+ ansible_host=', re.MULTILINE)
+
+
+class FakeExecutor(CommandExecutor):
+    """
+    Chaîne d'outils simulée : aucune commande n'est lancée. Les latences, volumes de
+    sortie et échecs suivent des profils par commande ; `terraform output -json` décrit
+    les domaines déclarés dans le main.tf du répertoire de travail, que `terraform apply`
+    crée dans le backend de virtualisation s'il est simulé (FakeBackend).
+    """
+
+    name = "fake"
+
+    def __init__(self, profiles: Optional[Dict[str, FakeProfile]] = None,
+                 time_scale: float = FAKE_EXECUTOR_TIME_SCALE,
+                 failure_rate: Optional[float] = None, seed: Optional[int] = None, backend=None):
+        self.profiles = dict(DEFAULT_PROFILES, **(profiles or {}))
+        self.time_scale = time_scale
+        if failure_rate is None and FAKE_EXECUTOR_FAILURE_RATE:
+            failure_rate = float(FAKE_EXECUTOR_FAILURE_RATE)
+        self.failure_rate = failure_rate
+        self.backend = backend
+        self.rng = random.Random(seed)
+        # Ports VNC attribués automatiquement par libvirt, uniques sur l'hôte
+        self._vnc_ports = itertools.count(5900)
+        # Durées mesurées (horloge murale, boucle d'événements comprise) par commande
+        self.timings: Dict[str, List[float]] = {}
+        self.stats = {'commands': 0, 'failures': 0, 'output_bytes': 0}
+
+    def reset(self):
+        self.timings = {}
+        self.stats = {'commands': 0, 'failures': 0, 'output_bytes': 0}
+
+    @staticmethod
+    def command_key(command: Sequence[str]) -> str:
+        program = os.path.basename(command[0])
+        if program == "terraform" and len(command) > 1:
+            return f"terraform {command[1]}"
+        return program
+
+    async def run(self, command: Sequence[str], cwd: Optional[str] = None,
+                  env: Optional[Dict[str, str]] = None, merge_stderr: bool = True,
+                  timeout: Optional[float] = None, on_line: Optional[Callable[[str], None]] = None,
+                  **options) -> CommandResult:
+        key = self.command_key(command)
+        profile = self.profiles.get(key) or FakeProfile(0.0)
+        started = time.perf_counter()
+
+        domains = _read_matches(cwd, "main.tf", _TF_DOMAIN_OUTPUT) if key.startswith("terraform") else []
+        units = len(domains) if key.startswith("terraform") else (
+            len(_read_matches(cwd, "inventory.ini", _INVENTORY_HOST)) if key == "ansible-playbook" else 1
+        )
+        delay = (profile.latency + profile.per_unit * units) * self.time_scale
+        delay *= 1 + self.rng.uniform(-profile.jitter, profile.jitter)
+        if timeout is not None and delay > timeout:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+
+        # Progression des ressources Terraform, émise au fil de l'eau comme le vrai binaire
+        progress = []
+        elapsed = 0.0
+        for at, line in (self._apply_progress(domains, delay) if key == "terraform apply" else []):
+            await asyncio.sleep(at - elapsed)
+            elapsed = at
+            progress.append(line)
+            if on_line:
+                on_line(line)
+        await asyncio.sleep(max(delay - elapsed, 0.0))
+
+        failure_rate = profile.failure_rate if self.failure_rate is None else self.failure_rate
+        failed = self.rng.random() < failure_rate
+        lines = profile.lines + profile.lines_per_unit * units
+        output = "".join(f"[{key}] étape simulée {i}: " + "." * 60 + "\n" for i in range(lines))
+        if on_line and not progress:
+            for line in output.splitlines(True):
+                on_line(line)
+        output = "".join(progress) + output
+        if failed:
+            output += f"Error: échec simulé de {key}\n"
+        elif key == "terraform output":
+            output = json.dumps(self._terraform_outputs(domains))
+        elif key == "terraform apply":
+            self._create_domains(domains)
+
+        self.stats['commands'] += 1
+        self.stats['failures'] += failed
+        self.stats['output_bytes'] += len(output)
+        self.timings.setdefault(key, []).append(time.perf_counter() - started)
+        returncode = (2 if key == "ansible-playbook" else 1) if failed else 0
+        if merge_stderr or not failed:
+            return CommandResult(returncode, output)
+        return CommandResult(returncode, "", output)
+
+    # Phases de `terraform apply` (fractions de sa durée) : réseau, téléchargement des
+    # images de base, disques et cloud-init, puis domaines (démarrage et attente du bail DHCP)
+    _APPLY_PHASES = (
+        ("libvirt_network.lab_network", 0.0, 0.05),
+        ("libvirt_volume.{}_base", 0.05, 0.55),
+        ("libvirt_volume.{}_disk", 0.55, 0.62),
+        ("libvirt_cloudinit_disk.{}_cloudinit", 0.55, 0.60),
+        ("libvirt_domain.{}", 0.62, 0.98),
+    )
+
+    def _apply_progress(self, domains: List[str], delay: float) -> List[tuple]:
+        events = []
+        for resource, begin, end in self._APPLY_PHASES:
+            names = [resource] if "{}" not in resource else [resource.format(d) for d in domains]
+            for name in names:
+                start = begin * delay
+                finish = (end - self.rng.uniform(0, 0.3) * (end - begin)) * delay
+                events.append((start, f"{name}: Creating...\n"))
+                events.append((finish, f"{name}: Creation complete after {max(int(finish - start), 0)}s "
+                                       f"[id={uuid.uuid4()}]\n"))
+        return sorted(events, key=lambda event: event[0])
+
+    def _terraform_outputs(self, domains: List[str]) -> dict:
+        outputs = {}
+        for index, domain in enumerate(domains):
+            outputs[f"{domain}_domain"] = {"value": {"name": domain, "uuid": str(uuid.uuid4())}}
+            outputs[f"{domain}_vnc_port"] = {"value": next(self._vnc_ports)}
+            outputs[f"{domain}_ip"] = {"value": f"192.168.122.{10 + index}"}
+        return outputs
+
+    def _create_domains(self, domains: List[str]):
+        from .virt_backend import virt_backend
+
+        backend = self.backend or virt_backend
+        if not hasattr(backend, "add_domain"):
+            return
+        for domain in domains:
+            backend.add_domain(domain, state="running")
+            backend.volumes.add(f"{domain}.qcow2")
+
+
+def _read_matches(directory: Optional[str], filename: str, pattern) -> List[str]:
+    if not directory:
+        return []
+    try:
+        with open(os.path.join(directory, filename)) as f:
+            return pattern.findall(f.read())
+    except OSError:
+        return []
+
+
+def create_command_executor(name: str = COMMAND_EXECUTOR) -> CommandExecutor:
+    """Instancie l'exécuteur configuré."""
+    if name == "fake":
+        return FakeExecutor()
+    return SubprocessExecutor()
+
+
+# Instance globale de l'exécuteur des commandes externes
+command_executor = create_command_executor()
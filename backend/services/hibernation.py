@@ -0,0 +1,222 @@
+import asyncio
+import os
+import time
+import uuid
+import logging
+from typing import Dict, List, Optional
+
+from sqlalchemy import bindparam
+
+from database import SessionLocal
+from models import Lab, VM
+from .virt_backend import VirtBackend
+from .capacity import capacity_ledger
+from .deployment import deploy_queued_labs
+from .vm_management import power_lab_vms
+from .vm_cache import vm_cache
+from .vm_metrics import vm_metrics_collector
+from .websocket_service import websocket_proxy_service
+
+logger = logging.getLogger(__name__)
+
+# Intervalle de vérification de l'inactivité des labs en secondes (0 pour désactiver)
+HIBERNATE_CHECK_INTERVAL = float(os.getenv("HIBERNATE_CHECK_INTERVAL", "60"))
+# Valeurs par défaut des politiques : minutes sans connexion (0 = jamais) et seuil de CPU invité (%)
+HIBERNATE_IDLE_MINUTES = int(os.getenv("HIBERNATE_IDLE_MINUTES", "120"))
+HIBERNATE_CPU_THRESHOLD = float(os.getenv("HIBERNATE_CPU_THRESHOLD", "5"))
+
+_UPDATE_ACTIVITY = Lab.__table__.update().where(
+    Lab.__table__.c.id == bindparam("lab_id")
+).values(last_activity_at=bindparam("activity"))
+
+
+class HibernationManager:
+    """
+    Hibernation des labs inactifs : un lab sans connexion SSH/VNC depuis le délai de sa
+    politique, et dont le CPU invité est resté sous le seuil, est suspendu sur disque
+    (managed save). Sa RAM est rendue à l'hôte ; il reprend à la connexion suivante.
+    """
+
+    def __init__(self, backend: Optional[VirtBackend] = None, session_factory=SessionLocal,
+                 interval: float = HIBERNATE_CHECK_INTERVAL):
+        self.backend = backend
+        self.session_factory = session_factory
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        # Un lab n'est hiberné ou repris que par une opération à la fois
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # Premier relevé de chaque lab par ce processus, faute d'activité enregistrée
+        self._first_seen: Dict[str, float] = {}
+        self.stats = {'hibernated': 0, 'resumed': 0, 'last_run': None}
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check_once()
+            except Exception as e:
+                logger.error(f"Erreur de détection des labs inactifs: {e}")
+
+    def _lock(self, lab_id: str) -> asyncio.Lock:
+        return self._locks.setdefault(lab_id, asyncio.Lock())
+
+    def _sync_activity(self, activity: Dict[str, float]) -> List[tuple]:
+        """Publie l'activité relevée par ce worker et lit les politiques des labs déployés."""
+        db = self.session_factory()
+        try:
+            if activity:
+                db.execute(_UPDATE_ACTIVITY, [
+                    {"lab_id": uuid.UUID(lab_id), "activity": at} for lab_id, at in activity.items()
+                ])
+                db.commit()
+            return db.query(
+                Lab.id, Lab.hibernate_after_minutes, Lab.hibernate_cpu_threshold, Lab.last_activity_at
+            ).filter(Lab.status == "deployed").all()
+        finally:
+            db.close()
+
+    async def check_once(self) -> List[str]:
+        """Un cycle : relevé de l'activité, puis hibernation des labs inactifs. Retourne leurs ids."""
+        now = time.time()
+        labs = await asyncio.to_thread(self._sync_activity, websocket_proxy_service.collect_lab_activity())
+        self.stats['last_run'] = now
+
+        deployed = set()
+        hibernated = []
+        for lab_id, idle_minutes, cpu_threshold, last_activity in labs:
+            lab_id = str(lab_id)
+            deployed.add(lab_id)
+            idle_after = (HIBERNATE_IDLE_MINUTES if idle_minutes is None else idle_minutes) * 60
+            if idle_after <= 0:
+                continue
+            # Sans activité enregistrée, le délai court depuis le premier relevé du lab
+            last = last_activity if last_activity else self._first_seen.setdefault(lab_id, now)
+            if now - last < idle_after:
+                continue
+
+            threshold = HIBERNATE_CPU_THRESHOLD if cpu_threshold is None else cpu_threshold
+            cpu_peak = vm_metrics_collector.lab_cpu_peak(lab_id, idle_after)
+            if cpu_peak is not None and cpu_peak >= threshold:
+                continue
+
+            logger.info(f"Lab {lab_id} inactif depuis {int((now - last) / 60)} min, hibernation")
+            result = await self.hibernate_lab(lab_id)
+            if result["hibernated"]:
+                hibernated.append(lab_id)
+
+        for lab_id in [lab_id for lab_id in self._first_seen if lab_id not in deployed]:
+            del self._first_seen[lab_id]
+        return hibernated
+
+    def _lab_vms(self, lab_id: str, status: str) -> list:
+        db = self.session_factory()
+        try:
+            return db.query(VM.id, VM.name, VM.status, VM.lab_id, VM.domain_name).filter(
+                VM.lab_id == uuid.UUID(lab_id), VM.status == status
+            ).all()
+        finally:
+            db.close()
+
+    def _record(self, lab_id: str, vm_ids: list, vm_status: str, lab_status: Optional[str],
+                activity: Optional[float] = None) -> bool:
+        """Enregistre les statuts ; un lab hiberné rend sa RAM au registre de capacité (retourné)."""
+        released = False
+        db = self.session_factory()
+        try:
+            if vm_ids:
+                db.query(VM).filter(VM.id.in_(vm_ids)).update({VM.status: vm_status}, synchronize_session=False)
+            values = {}
+            if lab_status:
+                values[Lab.status] = lab_status
+            if activity is not None:
+                values[Lab.last_activity_at] = activity
+            if values:
+                db.query(Lab).filter(Lab.id == uuid.UUID(lab_id)).update(values, synchronize_session=False)
+            if lab_status == "hibernated":
+                released = capacity_ledger.suspend(db, uuid.UUID(lab_id))
+            db.commit()
+        finally:
+            db.close()
+        # Mise à jour en masse : hors du suivi de l'ORM, le cache est invalidé explicitement
+        vm_cache.invalidate(vm_ids)
+        return released
+
+    def _reserve(self, lab_id: str):
+        db = self.session_factory()
+        try:
+            capacity_ledger.resume(db, uuid.UUID(lab_id))
+        finally:
+            db.close()
+
+    def _release(self, lab_id: str):
+        db = self.session_factory()
+        try:
+            capacity_ledger.suspend(db, uuid.UUID(lab_id))
+            db.commit()
+        finally:
+            db.close()
+
+    async def hibernate_lab(self, lab_id) -> dict:
+        """Suspend sur disque les VMs actives d'un lab ; le lab n'est hiberné que si toutes l'ont été."""
+        lab_id = str(lab_id)
+        async with self._lock(lab_id):
+            vms = await asyncio.to_thread(self._lab_vms, lab_id, "running")
+            if not vms:
+                return {"lab_id": lab_id, "hibernated": False, "results": []}
+            results = await power_lab_vms(vms, "hibernate", self.backend)
+            succeeded = [vm.id for vm, result in zip(vms, results) if result["success"]]
+            complete = len(succeeded) == len(vms)
+            released = await asyncio.to_thread(self._record, lab_id, succeeded, "hibernated",
+                                               "hibernated" if complete else None)
+            if complete:
+                self.stats['hibernated'] += 1
+                # La RAM rendue peut permettre de déployer des labs en attente
+                if released:
+                    await deploy_queued_labs()
+            else:
+                logger.warning(f"Hibernation partielle du lab {lab_id}: {len(succeeded)}/{len(vms)} VMs")
+            return {"lab_id": lab_id, "hibernated": complete, "results": results}
+
+    async def resume_lab(self, lab_id) -> dict:
+        """
+        Restaure les VMs hibernées d'un lab. Les connexions simultanées au même lab
+        attendent la même reprise au lieu de la relancer. La RAM du lab est d'abord
+        réservée à nouveau sur son hôte : CapacityError si elle n'y tient plus.
+        """
+        lab_id = str(lab_id)
+        async with self._lock(lab_id):
+            vms = await asyncio.to_thread(self._lab_vms, lab_id, "hibernated")
+            if not vms:
+                return {"lab_id": lab_id, "resumed": False, "results": []}
+            await asyncio.to_thread(self._reserve, lab_id)
+            started = time.monotonic()
+            results = await power_lab_vms(vms, "resume", self.backend)
+            succeeded = [vm.id for vm, result in zip(vms, results) if result["success"]]
+            complete = len(succeeded) == len(vms)
+            if not succeeded:
+                # Aucune VM reprise : le lab reste hiberné et ne garde pas sa RAM
+                await asyncio.to_thread(self._release, lab_id)
+            await asyncio.to_thread(self._record, lab_id, succeeded, "running",
+                                    "deployed" if complete else None, time.time())
+            self._first_seen.pop(lab_id, None)
+            if complete:
+                self.stats['resumed'] += 1
+                logger.info(f"Lab {lab_id} repris en {time.monotonic() - started:.1f}s")
+            return {"lab_id": lab_id, "resumed": complete, "results": results}
+
+
+# Instance globale du gestionnaire d'hibernation
+hibernation_manager = HibernationManager()
@@ -0,0 +1,318 @@
+import asyncio
+import json
+import struct
+import time
+import uuid
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from .connection_registry import ConnectionRecord
+from .websocket_service import WebSocketProxyService, SSH_PROXY_MODE
+from .compression import AdaptiveDeflate
+from .ssh_pool import ssh_transport_pool
+
+logger = logging.getLogger(__name__)
+
+# En-tête de trame : type (u8), drapeaux (u8), canal (u16), big-endian
+FRAME_HEADER = struct.Struct("!BBH")
+WINDOW_PAYLOAD = struct.Struct("!I")
+
+FRAME_DATA = 0x00
+FRAME_OPEN = 0x01
+FRAME_OPENED = 0x02
+FRAME_CLOSE = 0x03
+FRAME_RESIZE = 0x04
+FRAME_WINDOW = 0x05
+FRAME_ERROR = 0x06
+
+# Drapeau : charge utile compressée en deflate brut (message autonome)
+FLAG_DEFLATE = 0x01
+
+# Fenêtre de crédit initiale accordée dans chaque sens, par canal
+MUX_INITIAL_WINDOW = 256 * 1024
+MUX_READ_SIZE = 64 * 1024
+MUX_MAX_CHANNELS = 16
+
+# Résolution d'une VM : (vm_id, type) -> (hôte, port, lab_id), ou message d'erreur
+VMResolver = Callable[[str, str], Awaitable[Tuple[Optional[Tuple[str, int, str]], Optional[str]]]]
+
+
+def encode_frame(frame_type: int, channel_id: int, payload: bytes = b"", flags: int = 0) -> bytes:
+    """Construit une trame multiplexée."""
+    return FRAME_HEADER.pack(frame_type, flags, channel_id) + payload
+
+
+def decode_frame(frame: bytes) -> Tuple[int, int, int, bytes]:
+    """Découpe une trame multiplexée en (type, drapeaux, canal, charge utile)."""
+    if len(frame) < FRAME_HEADER.size:
+        raise ValueError("Trame trop courte")
+    frame_type, flags, channel_id = FRAME_HEADER.unpack_from(frame)
+    return frame_type, flags, channel_id, frame[FRAME_HEADER.size:]
+
+
+class MuxChannel:
+    """Canal terminal ou VNC transporté par une session multiplexée."""
+
+    def __init__(self, channel_id: int, kind: str, record: ConnectionRecord, reader, writer):
+        self.channel_id = channel_id
+        self.kind = kind
+        self.record = record
+        self.reader = reader
+        self.writer = writer
+        self.cols = 80
+        self.rows = 24
+        # Processus asyncssh en mode SSH natif (None en mode TCP brut)
+        self.process = None
+        # Crédit restant pour envoyer des données au client
+        self.send_credit = MUX_INITIAL_WINDOW
+        self.credit_available = asyncio.Event()
+        self.credit_available.set()
+        # Données du client en attente d'écriture vers la VM (bornées par la fenêtre du client)
+        self.inbound: asyncio.Queue = asyncio.Queue()
+        self.inbound_bytes = 0
+        self.tasks = []
+
+    def grant(self, credit: int):
+        """Ajoute du crédit d'envoi accordé par le client."""
+        self.send_credit += credit
+        if self.send_credit > 0:
+            self.credit_available.set()
+
+    def resize(self, cols: int, rows: int):
+        """
+        Applique la taille du terminal.
+        En mode TCP brut, la négociation SSH est faite par le navigateur : la taille
+        est seulement mémorisée.
+        """
+        self.cols = cols
+        self.rows = rows
+        if self.process is not None:
+            self.process.change_terminal_size(cols, rows)
+
+
+class MuxSession:
+    """
+    Session multiplexée : plusieurs canaux SSH/VNC vers des VMs sur un seul WebSocket.
+    Chaque canal dispose d'un contrôle de flux par crédits dans les deux sens.
+    """
+
+    def __init__(self, websocket, proxy: WebSocketProxyService, resolve_vm: VMResolver):
+        self.websocket = websocket
+        self.proxy = proxy
+        self.resolve_vm = resolve_vm
+        self.channels: Dict[int, MuxChannel] = {}
+        # Ouvertures en cours (résolution de la VM, connexion) : elles ne bloquent pas la réception
+        self._opening: Dict[int, asyncio.Task] = {}
+        self._send_lock = asyncio.Lock()
+
+    async def run(self):
+        """Boucle de réception des trames du client."""
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+
+                frame = message.get("bytes")
+                if frame is None:
+                    continue
+
+                try:
+                    frame_type, flags, channel_id, payload = decode_frame(frame)
+                except ValueError:
+                    continue
+
+                await self._dispatch(frame_type, channel_id, payload)
+        finally:
+            for task in list(self._opening.values()):
+                task.cancel()
+            await asyncio.gather(*self._opening.values(), return_exceptions=True)
+            for channel_id in list(self.channels):
+                await self._close_channel(channel_id, notify=False)
+
+    async def _dispatch(self, frame_type: int, channel_id: int, payload: bytes):
+        if frame_type == FRAME_DATA:
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                return
+            if channel.inbound_bytes + len(payload) > MUX_INITIAL_WINDOW:
+                await self._send_error(channel_id, "Fenêtre de réception dépassée")
+                await self._close_channel(channel_id)
+                return
+            channel.inbound_bytes += len(payload)
+            channel.inbound.put_nowait(payload)
+
+        elif frame_type == FRAME_WINDOW:
+            channel = self.channels.get(channel_id)
+            if channel is not None and len(payload) >= WINDOW_PAYLOAD.size:
+                channel.grant(WINDOW_PAYLOAD.unpack_from(payload)[0])
+
+        elif frame_type == FRAME_OPEN:
+            await self._start_open(channel_id, payload)
+
+        elif frame_type == FRAME_RESIZE:
+            channel = self.channels.get(channel_id)
+            if channel is not None:
+                try:
+                    size = json.loads(payload or b"{}")
+                    cols, rows = int(size.get("cols", channel.cols)), int(size.get("rows", channel.rows))
+                except (ValueError, TypeError, AttributeError):
+                    # Taille invalide : seul ce redimensionnement est ignoré
+                    return
+                channel.resize(cols, rows)
+
+        elif frame_type == FRAME_CLOSE:
+            opening = self._opening.get(channel_id)
+            if opening is not None:
+                opening.cancel()
+            await self._close_channel(channel_id)
+
+    async def _start_open(self, channel_id: int, payload: bytes):
+        """
+        Valide une demande d'ouverture puis lance la connexion dans une tâche : une VM
+        lente à joindre (ou à sortir d'hibernation) ne retarde pas les autres canaux.
+        """
+        if channel_id in self.channels or channel_id in self._opening:
+            await self._send_error(channel_id, "Canal déjà ouvert")
+            return
+        if len(self.channels) + len(self._opening) >= MUX_MAX_CHANNELS:
+            await self._send_error(channel_id, "Nombre maximal de canaux atteint")
+            return
+
+        try:
+            request = json.loads(payload or b"{}")
+            vm_id = str(request["vm_id"])
+            kind = request.get("kind", "ssh")
+            if kind not in ("ssh", "vnc"):
+                raise ValueError(kind)
+            cols, rows = int(request.get("cols", 80)), int(request.get("rows", 24))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            await self._send_error(channel_id, "Requête d'ouverture invalide")
+            return
+
+        native = kind == "ssh" and (request.get("mode") or SSH_PROXY_MODE) == "native"
+        compress = request.get("compress") == "deflate"
+        self._opening[channel_id] = asyncio.create_task(
+            self._open_channel(channel_id, vm_id, kind, cols, rows, native, compress)
+        )
+
+    async def _open_channel(self, channel_id: int, vm_id: str, kind: str, cols: int, rows: int,
+                            native: bool, compress: bool):
+        """Ouvre un canal vers le port SSH ou VNC d'une VM."""
+        try:
+            target, error = await self.resolve_vm(vm_id, kind)
+            if error:
+                await self._send_error(channel_id, error)
+                return
+
+            host, port, lab_id = target
+            process = None
+            try:
+                if native:
+                    process = await ssh_transport_pool.open_shell(host, port, cols, rows)
+                    reader, writer = process.stdout, process.stdin
+                else:
+                    reader, writer = await asyncio.open_connection(host, port, limit=MUX_INITIAL_WINDOW)
+            except Exception as e:
+                await self._send_error(channel_id, f"Erreur de connexion {kind.upper()}: {str(e)}")
+                return
+        except asyncio.CancelledError:
+            # Canal fermé par le client ou session terminée pendant l'ouverture
+            return
+        except Exception as e:
+            logger.error(f"Erreur d'ouverture du canal {channel_id} vers la VM {vm_id}: {e}")
+            return
+        finally:
+            self._opening.pop(channel_id, None)
+
+        record = ConnectionRecord(str(uuid.uuid4()), kind, vm_id, lab_id, self.websocket, reader, writer)
+        if compress:
+            record.compressor = AdaptiveDeflate()
+        self.proxy.registry.add(record)
+
+        channel = MuxChannel(channel_id, kind, record, reader, writer)
+        channel.cols, channel.rows = cols, rows
+        channel.process = process
+        self.channels[channel_id] = channel
+
+        try:
+            await self._send(FRAME_OPENED, channel_id, WINDOW_PAYLOAD.pack(MUX_INITIAL_WINDOW))
+        except Exception:
+            await self._close_channel(channel_id, notify=False)
+            return
+        # Fermé pendant l'envoi de la confirmation
+        if self.channels.get(channel_id) is not channel:
+            return
+        channel.tasks = [
+            asyncio.create_task(self._pump_to_client(channel)),
+            asyncio.create_task(self._pump_to_vm(channel))
+        ]
+
+    async def _pump_to_client(self, channel: MuxChannel):
+        """Transfère les données de la VM vers le client dans la limite du crédit accordé."""
+        record = channel.record
+        try:
+            while True:
+                while channel.send_credit <= 0:
+                    channel.credit_available.clear()
+                    await channel.credit_available.wait()
+
+                data = await channel.reader.read(min(channel.send_credit, MUX_READ_SIZE))
+                if not data:
+                    break
+
+                channel.send_credit -= len(data)
+                if record.compressor:
+                    compressed, payload = record.compressor.encode(data)
+                    await self._send(FRAME_DATA, channel.channel_id, payload, FLAG_DEFLATE if compressed else 0)
+                else:
+                    await self._send(FRAME_DATA, channel.channel_id, data)
+                record.bytes_out += len(data)
+                record.frames_out += 1
+                record.last_activity = time.time()
+        except Exception as e:
+            logger.error(f"Erreur VM->canal {channel.channel_id} ({record.connection_id}): {e}")
+
+        await self._close_channel(channel.channel_id)
+
+    async def _pump_to_vm(self, channel: MuxChannel):
+        """Écrit les données du client vers la VM et rend le crédit correspondant."""
+        record = channel.record
+        try:
+            while True:
+                data = await channel.inbound.get()
+                channel.writer.write(data)
+                await channel.writer.drain()
+                channel.inbound_bytes -= len(data)
+                record.bytes_in += len(data)
+                record.last_activity = time.time()
+                await self._send(FRAME_WINDOW, channel.channel_id, WINDOW_PAYLOAD.pack(len(data)))
+        except Exception as e:
+            logger.error(f"Erreur canal->VM {channel.channel_id} ({record.connection_id}): {e}")
+
+    async def _close_channel(self, channel_id: int, notify: bool = True):
+        """Ferme un canal et libère sa connexion vers la VM."""
+        channel = self.channels.pop(channel_id, None)
+        if channel is None:
+            return
+
+        current = asyncio.current_task()
+        for task in channel.tasks:
+            if task is not current:
+                task.cancel()
+
+        await self.proxy._cleanup_connection(channel.record.connection_id)
+
+        if notify:
+            try:
+                await self._send(FRAME_CLOSE, channel_id)
+            except Exception:
+                pass
+
+    async def _send_error(self, channel_id: int, message: str):
+        await self._send(FRAME_ERROR, channel_id, json.dumps({"message": message}).encode('utf-8'))
+
+    async def _send(self, frame_type: int, channel_id: int, payload: bytes = b"", flags: int = 0):
+        """Envoie une trame ; les envois des différents canaux sont sérialisés."""
+        async with self._send_lock:
+            await self.websocket.send_bytes(encode_frame(frame_type, channel_id, payload, flags))
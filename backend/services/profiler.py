@@ -0,0 +1,308 @@
+import asyncio
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+import logging
+from typing import Dict, List, Optional
+
+from database import QueryStats, track_queries
+
+logger = logging.getLogger(__name__)
+
+# Profileur échantillonneur : période d'échantillonnage par défaut et durée maximale d'une fenêtre
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "600"))
+# Requêtes lentes : seuil de capture (0 = désactivé) et taille du tampon circulaire
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "1000"))
+SLOW_REQUEST_BUFFER_SIZE = int(os.getenv("SLOW_REQUEST_BUFFER_SIZE", "100"))
+
+# Feuilles de pile d'un thread en attente : boucle d'événements sans travail, pool de threads
+# inactif (concurrent.futures attend sa file dans _worker, sans cadre Python plus profond)
+_IDLE_LEAVES = frozenset((("selectors.py", "select"), ("threading.py", "wait"), ("thread.py", "_worker")))
+
+
+def _frame_label(code) -> str:
+    # Deux derniers éléments du chemin : distingue les nombreux __init__.py
+    path = code.co_filename.rsplit(os.sep, 2)
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({'/'.join(path[-2:])})"
+
+
+def _is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_LEAVES
+
+
+class SamplingProfiler:
+    """
+    Profileur échantillonneur en processus : un thread relève périodiquement la pile de
+    tous les threads (sys._current_frames) et compte les piles identiques. Le code
+    profilé n'est pas instrumenté ; le coût est celui du thread d'échantillonnage.
+    Le résultat est au format « collapsed stacks » (flamegraph.pl, speedscope).
+    """
+
+    def __init__(self):
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.interval = PROFILER_INTERVAL_MS / 1000
+        self.include_idle = False
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: Optional[float] = None, interval_ms: Optional[float] = None,
+              include_idle: bool = False) -> bool:
+        """Démarre une fenêtre de profilage (arrêt automatique après `seconds`). False si déjà actif."""
+        if self.running:
+            return False
+        with self._lock:
+            self.stacks = {}
+            self.samples = 0
+        self.interval = (interval_ms or PROFILER_INTERVAL_MS) / 1000
+        self.include_idle = include_idle
+        self.started_at = time.time()
+        self.stopped_at = None
+        self._stop.clear()
+        duration = min(seconds or PROFILER_MAX_SECONDS, PROFILER_MAX_SECONDS)
+        self._thread = threading.Thread(target=self._run, args=(duration,), name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Profilage démarré pour {duration:.0f}s (période {self.interval * 1000:.1f} ms)")
+        return True
+
+    def stop(self) -> bool:
+        """Arrête la fenêtre en cours ; le profil reste disponible jusqu'au prochain démarrage."""
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        return True
+
+    def _run(self, duration: float):
+        own = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + duration
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            for thread_id, frame in frames.items():
+                if thread_id == own or (not self.include_idle and _is_idle(frame)):
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                labels.append(names.get(thread_id, str(thread_id)))
+                stack = ";".join(reversed(labels))
+                with self._lock:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                    self.samples += 1
+            del frames
+        self.stopped_at = time.time()
+        logger.info(f"Profilage terminé : {self.samples} échantillons")
+
+    def collapsed(self) -> str:
+        """Une ligne par pile : cadres séparés par « ; » puis nombre d'échantillons."""
+        with self._lock:
+            items = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+    def status(self, top: int = 20) -> dict:
+        """État de la fenêtre et fonctions les plus présentes (en propre et en cumulé)."""
+        with self._lock:
+            items = list(self.stacks.items())
+            samples = self.samples
+        own: Dict[str, int] = {}
+        total: Dict[str, int] = {}
+        # Profondeur maximale de chaque fonction dans les piles
+        depth: Dict[str, int] = {}
+        for stack, count in items:
+            frames = stack.split(";")
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            # Une fonction récursive n'est comptée qu'une fois par pile
+            for frame in set(frames[1:]):
+                total[frame] = total.get(frame, 0) + count
+            for index, frame in enumerate(frames):
+                depth[frame] = max(depth.get(frame, 0), index)
+
+        def ranking(counts):
+            # À égalité d'échantillons (appelants d'une même pile), la fonction la plus profonde
+            # d'abord, puis par nom : le classement est stable d'un appel à l'autre
+            ordered = sorted(counts.items(), key=lambda item: (-item[1], -depth[item[0]], item[0]))
+            return [{"frame": frame, "samples": count, "percent": round(count * 100 / samples, 1)}
+                    for frame, count in ordered[:top]]
+
+        end = self.stopped_at or time.time()
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "duration_s": round(end - self.started_at, 3) if self.started_at else 0.0,
+            "interval_ms": self.interval * 1000,
+            "include_idle": self.include_idle,
+            "samples": samples,
+            "stacks": len(items),
+            "top_self": ranking(own) if samples else [],
+            "top_total": ranking(total) if samples else [],
+        }
+
+
+def await_stack(task: asyncio.Task) -> List[str]:
+    """
+    Pile d'attente d'une tâche : chaîne des coroutines suspendues, de la plus externe à
+    celle qui attend (Task.get_stack ne rend que le premier cadre d'une coroutine suspendue).
+    """
+    lines = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "ag_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        lines.append(f"{_frame_label(frame.f_code)} ligne {frame.f_lineno}")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "ag_await", None) or getattr(coro, "gi_yieldfrom", None)
+    if coro is None or not lines:
+        return lines
+    # Fin de chaîne : objet attendu (Future, tâche de fond, exécution dans un thread)
+    lines.append(f"<{type(coro).__name__}>")
+    return lines
+
+
+class SlowRequest:
+    """Requête HTTP ayant dépassé le seuil de lenteur."""
+
+    __slots__ = ('id', 'method', 'path', 'route', 'status', 'started_at', 'duration',
+                 'stack', 'statements', 'statement_count', 'db_time', 'slowest')
+
+    def __init__(self, id: int, method: str, path: str, route: str, status: int, started_at: float,
+                 duration: float, stack: List[str], queries: QueryStats):
+        self.id = id
+        self.method = method
+        self.path = path
+        self.route = route
+        self.status = status
+        self.started_at = started_at
+        self.duration = duration
+        self.stack = stack
+        self.statements = queries.statements
+        self.statement_count = queries.count
+        self.db_time = queries.duration
+        self.slowest = queries.slowest_statements()
+
+    def to_dict(self, statements: bool = True) -> dict:
+        result = {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 1),
+            "db_time_ms": round(self.db_time * 1000, 1),
+            "statement_count": self.statement_count,
+            "slowest_statements": self.slowest,
+            "stack": self.stack,
+        }
+        if statements:
+            result["statements"] = [{"sql": sql, "duration_ms": round(duration * 1000, 2)}
+                                    for sql, duration in self.statements]
+        return result
+
+
+class SlowRequestLog:
+    """Tampon circulaire des dernières requêtes lentes (les plus anciennes sont évincées)."""
+
+    def __init__(self, size: int = SLOW_REQUEST_BUFFER_SIZE, threshold_ms: float = SLOW_REQUEST_THRESHOLD_MS):
+        self.requests = collections.deque(maxlen=size)
+        self.threshold = threshold_ms / 1000
+        self._ids = itertools.count(1)
+
+    def add(self, method: str, path: str, route: str, status: int, started_at: float,
+            duration: float, stack: List[str], queries: QueryStats):
+        self.requests.append(SlowRequest(next(self._ids), method, path, route, status, started_at,
+                                         duration, stack, queries))
+
+    def list(self, limit: int = 20, statements: bool = False) -> List[dict]:
+        return [request.to_dict(statements) for request in reversed(list(self.requests))][:limit]
+
+    def get(self, request_id: int) -> Optional[dict]:
+        for request in self.requests:
+            if request.id == request_id:
+                return request.to_dict()
+        return None
+
+    def clear(self):
+        self.requests.clear()
+
+
+class SlowRequestMiddleware:
+    """
+    Middleware ASGI : les requêtes HTTP plus longues que le seuil sont gardées avec leurs
+    requêtes SQL et leur pile d'attente, relevée au moment où le seuil est franchi (si la
+    boucle d'événements est elle-même bloquée, le profileur échantillonneur la montre).
+    La durée s'arrête à l'envoi de la réponse : les tâches d'arrière-plan n'en font pas partie.
+    """
+
+    def __init__(self, app, log: Optional[SlowRequestLog] = None):
+        self.app = app
+        self.log = log or slow_request_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.log.threshold <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        started_at = time.time()
+        started = time.perf_counter()
+        status = 500
+        duration = None
+        stack: List[str] = []
+
+        def capture_stack():
+            nonlocal stack
+            if duration is None and task is not None:
+                frames = await_stack(task)
+                # Seuls les cadres sous ce middleware concernent la requête
+                marker = f"{type(self).__qualname__}.__call__ "
+                below = next((i for i, line in enumerate(frames) if line.startswith(marker)), -1)
+                stack = frames[below + 1:]
+
+        timer = asyncio.get_running_loop().call_later(self.log.threshold, capture_stack)
+
+        # Requêtes SQL de la requête (partagées avec MetricsMiddleware), comptées jusqu'à
+        # l'envoi de la réponse
+        with track_queries(f"{scope['method']} {scope['path']}") as queries:
+            async def send_with_timing(message):
+                nonlocal status, duration
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                    duration = time.perf_counter() - started
+                    queries.active = False
+                    timer.cancel()
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                timer.cancel()
+                if duration is None:
+                    duration = time.perf_counter() - started
+                if duration >= self.log.threshold:
+                    route = scope.get("route")
+                    self.log.add(scope["method"], scope["path"], getattr(route, "path", "unmatched"),
+                                 status, started_at, duration, stack, queries)
+
+
+# Instance globale du profileur échantillonneur
+sampling_profiler = SamplingProfiler()
+
+# Instance globale du tampon des requêtes lentes
+slow_request_log = SlowRequestLog()
@@ -0,0 +1,274 @@
+import asyncio
+import os
+import socket
+import time
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .connection_registry import ConnectionRegistry
+
+logger = logging.getLogger(__name__)
+
+# "memory" (un seul processus) ou "database" (registre partagé entre workers et réplicas)
+CONNECTION_REGISTRY_BACKEND = os.getenv("CONNECTION_REGISTRY_BACKEND", "memory")
+CONNECTION_REGISTRY_WORKER_ID = os.getenv(
+    "CONNECTION_REGISTRY_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}"
+)
+# Intervalle de publication des connexions locales et de lecture des commandes de fermeture
+CONNECTION_REGISTRY_SYNC_INTERVAL = float(os.getenv("CONNECTION_REGISTRY_SYNC_INTERVAL", "1.0"))
+# Les connexions d'un worker sans battement de cœur depuis ce délai sont ignorées puis purgées
+CONNECTION_REGISTRY_STALE_AFTER = float(os.getenv("CONNECTION_REGISTRY_STALE_AFTER", "15"))
+CLOSE_COMMAND_TTL = 60.0
+
+CloseHandler = Callable[[str], Awaitable[None]]
+
+
+class MemoryRegistryBackend:
+    """Backend par défaut : les connexions ne sont visibles que par le processus courant."""
+
+    shared = False
+
+    def __init__(self, worker_id: str = CONNECTION_REGISTRY_WORKER_ID):
+        self.worker_id = worker_id
+
+    async def start(self, registry: ConnectionRegistry, on_close_vm: CloseHandler):
+        pass
+
+    async def stop(self):
+        pass
+
+    def request_close_vm(self, vm_id: str):
+        pass
+
+    def remote_for_vm(self, vm_id: str) -> List[dict]:
+        return []
+
+    def remote_for_lab(self, lab_id: str) -> List[dict]:
+        return []
+
+    def remote_all(self) -> List[dict]:
+        return []
+
+
+class DatabaseRegistryBackend(MemoryRegistryBackend):
+    """
+    Registre partagé via la base de données.
+    Chaque worker publie ses connexions par lots à intervalle régulier, et conserve en mémoire
+    un instantané des connexions des autres workers : les lectures ne touchent pas la base.
+    Les fermetures demandées sur un worker sont relayées aux autres par une table de commandes.
+    """
+
+    shared = True
+
+    def __init__(self, session_factory=None, worker_id: str = CONNECTION_REGISTRY_WORKER_ID,
+                 interval: float = CONNECTION_REGISTRY_SYNC_INTERVAL):
+        super().__init__(worker_id)
+        if session_factory is None:
+            from database import SessionLocal
+            session_factory = SessionLocal
+        self.session_factory = session_factory
+        self.interval = interval
+        self._registry: Optional[ConnectionRegistry] = None
+        self._on_close_vm: Optional[CloseHandler] = None
+        self._task: Optional[asyncio.Task] = None
+        self._published: Set[str] = set()
+        self._pending_commands: List[str] = []
+        self._last_command_id: Optional[int] = None
+        # Instantané des connexions des autres workers
+        self._remote_by_vm: Dict[str, List[dict]] = {}
+        self._remote_by_lab: Dict[str, List[dict]] = {}
+        self._remote: List[dict] = []
+
+    async def start(self, registry: ConnectionRegistry, on_close_vm: CloseHandler):
+        self._registry = registry
+        self._on_close_vm = on_close_vm
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Arrête la synchronisation et retire les connexions publiées par ce worker."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await asyncio.to_thread(self._withdraw)
+        except Exception as e:
+            logger.error(f"Erreur au retrait des connexions du worker {self.worker_id}: {e}")
+
+    def request_close_vm(self, vm_id: str):
+        """Diffuse une demande de fermeture aux autres workers (au prochain cycle)."""
+        self._pending_commands.append(vm_id)
+
+    def remote_for_vm(self, vm_id: str) -> List[dict]:
+        return self._remote_by_vm.get(vm_id, [])
+
+    def remote_for_lab(self, lab_id: str) -> List[dict]:
+        return self._remote_by_lab.get(lab_id, [])
+
+    def remote_all(self) -> List[dict]:
+        return self._remote
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync_once()
+            except Exception as e:
+                logger.error(f"Erreur de synchronisation du registre de connexions: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def sync_once(self):
+        """Un cycle : publication des connexions locales, lecture des autres workers et des commandes."""
+        now = time.time()
+        records = self._registry.all() if self._registry is not None else []
+        live = {
+            record.connection_id: {
+                'connection_id': record.connection_id,
+                'worker_id': self.worker_id,
+                'type': record.type,
+                'vm_id': record.vm_id,
+                'lab_id': record.lab_id,
+                'started_at': record.started_at,
+                'last_activity': record.last_activity,
+                'bytes_in': record.bytes_in,
+                'bytes_out': record.bytes_out,
+                'heartbeat_at': now
+            }
+            for record in records
+        }
+        commands, self._pending_commands = self._pending_commands, []
+
+        try:
+            remote, close_vms, last_command_id = await asyncio.to_thread(self._sync, live, commands, now)
+        except Exception:
+            # Cycle en échec (base indisponible) : les fermetures seront diffusées au cycle suivant
+            self._pending_commands = commands + self._pending_commands
+            raise
+
+        self._published = set(live)
+        self._last_command_id = last_command_id
+        self._set_snapshot(remote, now)
+        for vm_id in close_vms:
+            if self._on_close_vm is not None:
+                await self._on_close_vm(vm_id)
+
+    def _sync(self, live: Dict[str, dict], commands: List[str],
+              now: float) -> Tuple[List[dict], Set[str], int]:
+        """
+        Partie bloquante d'un cycle, exécutée hors de la boucle d'événements. L'état du
+        backend n'est mis à jour par l'appelant qu'une fois la transaction validée.
+        """
+        from models import ProxyConnection, ProxyCloseCommand
+
+        db = self.session_factory()
+        try:
+            closed = self._published - set(live)
+            if closed:
+                db.query(ProxyConnection).filter(
+                    ProxyConnection.connection_id.in_(closed)
+                ).delete(synchronize_session=False)
+
+            opened = [mapping for connection_id, mapping in live.items() if connection_id not in self._published]
+            updated = [mapping for connection_id, mapping in live.items() if connection_id in self._published]
+            if opened:
+                db.bulk_insert_mappings(ProxyConnection, opened)
+            if updated:
+                db.bulk_update_mappings(ProxyConnection, updated)
+
+            if commands:
+                db.bulk_insert_mappings(ProxyCloseCommand, [
+                    {'vm_id': vm_id, 'issued_by': self.worker_id, 'created_at': now}
+                    for vm_id in commands
+                ])
+
+            # Commandes émises depuis le dernier cycle (les plus anciennes sont ignorées au démarrage)
+            query = db.query(ProxyCloseCommand.id, ProxyCloseCommand.vm_id, ProxyCloseCommand.issued_by)
+            if self._last_command_id is None:
+                query = query.filter(ProxyCloseCommand.created_at >= now)
+            else:
+                query = query.filter(ProxyCloseCommand.id > self._last_command_id)
+            close_vms = set()
+            last_id = self._last_command_id or 0
+            for command_id, vm_id, issued_by in query:
+                last_id = max(last_id, command_id)
+                if issued_by != self.worker_id:
+                    close_vms.add(vm_id)
+            if self._last_command_id is None:
+                max_id = db.query(ProxyCloseCommand.id).order_by(ProxyCloseCommand.id.desc()).limit(1).scalar()
+                last_id = max(last_id, max_id or 0)
+
+            remote = [
+                {
+                    'connection_id': row.connection_id,
+                    'worker_id': row.worker_id,
+                    'type': row.type,
+                    'vm_id': row.vm_id,
+                    'lab_id': row.lab_id,
+                    'started_at': row.started_at,
+                    'last_activity': row.last_activity,
+                    'bytes_in': row.bytes_in or 0,
+                    'bytes_out': row.bytes_out or 0
+                }
+                for row in db.query(ProxyConnection).filter(
+                    ProxyConnection.worker_id != self.worker_id,
+                    ProxyConnection.heartbeat_at >= now - CONNECTION_REGISTRY_STALE_AFTER
+                )
+            ]
+
+            # Ménage : workers disparus sans se retirer et commandes expirées
+            db.query(ProxyConnection).filter(
+                ProxyConnection.heartbeat_at < now - 4 * CONNECTION_REGISTRY_STALE_AFTER
+            ).delete(synchronize_session=False)
+            db.query(ProxyCloseCommand).filter(
+                ProxyCloseCommand.created_at < now - CLOSE_COMMAND_TTL
+            ).delete(synchronize_session=False)
+
+            db.commit()
+            return remote, close_vms, last_id
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _withdraw(self):
+        from models import ProxyConnection
+
+        db = self.session_factory()
+        try:
+            db.query(ProxyConnection).filter(
+                ProxyConnection.worker_id == self.worker_id
+            ).delete(synchronize_session=False)
+            db.commit()
+            self._published = set()
+        finally:
+            db.close()
+
+    def _set_snapshot(self, remote: List[dict], now: float):
+        by_vm: Dict[str, List[dict]] = {}
+        by_lab: Dict[str, List[dict]] = {}
+        for connection in remote:
+            duration = max(now - connection['started_at'], 1e-6)
+            connection['connection_time'] = time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(connection['started_at'])
+            )
+            connection['duration_seconds'] = round(duration, 3)
+            connection['idle_seconds'] = round(now - connection['last_activity'], 3)
+            by_vm.setdefault(connection['vm_id'], []).append(connection)
+            if connection['lab_id']:
+                by_lab.setdefault(connection['lab_id'], []).append(connection)
+        self._remote = remote
+        self._remote_by_vm = by_vm
+        self._remote_by_lab = by_lab
+
+
+def create_registry_backend(name: str = CONNECTION_REGISTRY_BACKEND) -> MemoryRegistryBackend:
+    """Instancie le backend du registre de connexions configuré."""
+    if name == "database":
+        return DatabaseRegistryBackend()
+    if name != "memory":
+        logger.warning(f"Backend de registre inconnu '{name}', utilisation du registre en mémoire")
+    return MemoryRegistryBackend()
@@ -0,0 +1,290 @@
+import bisect
+import codecs
+import gzip
+import json
+import mmap
+import os
+import queue
+import threading
+import time
+import uuid
+import zlib
+import logging
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RECORDINGS_DIR = os.getenv("RECORDINGS_DIR", "/var/lib/virtual-lab-manager/recordings")
+# Un membre gzip est écrit toutes les RECORDING_INDEX_INTERVAL secondes ou tous les
+# RECORDING_MEMBER_SIZE octets : chaque membre est un point d'entrée de l'index
+RECORDING_INDEX_INTERVAL = float(os.getenv("RECORDING_INDEX_INTERVAL", "2.0"))
+RECORDING_MEMBER_SIZE = 256 * 1024
+REPLAY_CHUNK_SIZE = 64 * 1024
+
+
+class SessionRecorder:
+    """
+    Enregistrement d'une session terminal.
+    Le relais ne fait qu'horodater et déposer les octets dans une file : le décodage,
+    la sérialisation asciicast et la compression ont lieu dans le thread d'écriture.
+    """
+
+    def __init__(self, writer: "RecordingWriter", recording_id: str, vm_id: str,
+                 lab_id: Optional[str], width: int, height: int):
+        self.recording_id = recording_id
+        self.vm_id = vm_id
+        self.lab_id = lab_id
+        self.width = width
+        self.height = height
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self._writer = writer
+
+    def record_output(self, data: bytes):
+        """Enregistre une sortie du terminal (appelé depuis la boucle de relais)."""
+        self._writer.queue.put_nowait((self, time.monotonic() - self._started, data))
+
+    def close(self):
+        """Termine l'enregistrement."""
+        self._writer.queue.put_nowait((self, None, None))
+
+
+class _RecordingFile:
+    """État d'écriture d'un enregistrement, manipulé uniquement par le thread d'écriture."""
+
+    def __init__(self, recorder: SessionRecorder, base_path: str):
+        self.cast = open(base_path + ".cast.gz", "ab")
+        self.index = open(base_path + ".idx", "a")
+        self.offset = self.cast.tell()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.lines: List[str] = []
+        self.pending_size = 0
+        self.member_time: Optional[float] = None
+        self.member_started = time.monotonic()
+        self.last_elapsed = 0.0
+
+        header = {
+            "version": 2,
+            "width": recorder.width,
+            "height": recorder.height,
+            "timestamp": int(recorder.started_at),
+            "title": f"VM {recorder.vm_id}"
+        }
+        self.lines.append(json.dumps(header) + "\n")
+        self.member_time = 0.0
+
+    def add(self, elapsed: float, data: bytes):
+        text = self.decoder.decode(data)
+        if not text:
+            return
+        if self.member_time is None:
+            self.member_time = elapsed
+            self.member_started = time.monotonic()
+        self.last_elapsed = elapsed
+        line = json.dumps([round(elapsed, 6), "o", text]) + "\n"
+        self.lines.append(line)
+        self.pending_size += len(line)
+
+    def should_flush(self, now: float) -> bool:
+        if not self.lines:
+            return False
+        return (self.pending_size >= RECORDING_MEMBER_SIZE
+                or now - self.member_started >= RECORDING_INDEX_INTERVAL)
+
+    def flush(self):
+        """Écrit les lignes en attente sous forme d'un membre gzip indépendant, puis l'indexe."""
+        if not self.lines:
+            return
+        member = gzip.compress("".join(self.lines).encode('utf-8'), compresslevel=6)
+        self.cast.write(member)
+        self.cast.flush()
+        self.index.write(f"{self.member_time:.6f} {self.offset}\n")
+        self.index.flush()
+        self.offset += len(member)
+        self.lines = []
+        self.pending_size = 0
+        self.member_time = None
+
+    def close(self):
+        tail = self.decoder.decode(b'', final=True)
+        if tail:
+            self.lines.append(json.dumps([round(self.last_elapsed, 6), "o", tail]) + "\n")
+        self.flush()
+        self.cast.close()
+        self.index.close()
+
+
+class RecordingWriter:
+    """Thread d'écriture unique partagé par tous les enregistrements en cours."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.queue: "queue.SimpleQueue[Tuple[SessionRecorder, Optional[float], Optional[bytes]]]" = queue.SimpleQueue()
+        self._files: Dict[str, _RecordingFile] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start_recording(self, vm_id: str, lab_id: Optional[str] = None,
+                        width: int = 80, height: int = 24) -> SessionRecorder:
+        """Crée un enregistrement et écrit ses métadonnées."""
+        self._ensure_started()
+        recorder = SessionRecorder(self, str(uuid.uuid4()), vm_id, lab_id, width, height)
+
+        metadata = {
+            "recording_id": recorder.recording_id,
+            "vm_id": vm_id,
+            "lab_id": lab_id,
+            "width": width,
+            "height": height,
+            "started_at": recorder.started_at
+        }
+        with open(self.base_path(recorder.recording_id) + ".json", "w") as f:
+            json.dump(metadata, f)
+
+        return recorder
+
+    def base_path(self, recording_id: str) -> str:
+        return os.path.join(self.directory, recording_id)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(
+                    target=self._run, name="session-recording-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                recorder, elapsed, data = self.queue.get(timeout=RECORDING_INDEX_INTERVAL)
+                self._handle(recorder, elapsed, data)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                logger.error(f"Erreur d'écriture d'un enregistrement de session: {e}")
+
+            now = time.monotonic()
+            for recording_file in self._files.values():
+                if recording_file.should_flush(now):
+                    recording_file.flush()
+
+    def _handle(self, recorder: SessionRecorder, elapsed: Optional[float], data: Optional[bytes]):
+        recording_file = self._files.get(recorder.recording_id)
+
+        if elapsed is None:
+            if recording_file is not None:
+                recording_file.close()
+                del self._files[recorder.recording_id]
+            return
+
+        if recording_file is None:
+            recording_file = _RecordingFile(recorder, self.base_path(recorder.recording_id))
+            self._files[recorder.recording_id] = recording_file
+
+        recording_file.add(elapsed, data)
+
+
+class RecordingReader:
+    """Relecture d'un enregistrement à partir d'un instant donné, via mmap."""
+
+    def __init__(self, directory: str, recording_id: str):
+        self.base_path = os.path.join(directory, recording_id)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.base_path + ".json")
+
+    def metadata(self) -> dict:
+        with open(self.base_path + ".json") as f:
+            return json.load(f)
+
+    def _load_index(self) -> Tuple[List[float], List[int]]:
+        times, offsets = [], []
+        if os.path.exists(self.base_path + ".idx"):
+            with open(self.base_path + ".idx") as f:
+                for line in f:
+                    member_time, offset = line.split()
+                    times.append(float(member_time))
+                    offsets.append(int(offset))
+        return times, offsets
+
+    def stream(self, start: float = 0.0) -> Iterator[bytes]:
+        """
+        Produit un flux asciicast v2 commençant à `start` secondes.
+        Seuls les membres gzip postérieurs au point d'entrée de l'index sont décompressés.
+        """
+        metadata = self.metadata()
+        header = {
+            "version": 2,
+            "width": metadata["width"],
+            "height": metadata["height"],
+            "timestamp": int(metadata["started_at"] + start),
+            "title": f"VM {metadata['vm_id']}"
+        }
+        yield (json.dumps(header) + "\n").encode('utf-8')
+
+        times, offsets = self._load_index()
+        cast_path = self.base_path + ".cast.gz"
+        if not offsets or not os.path.exists(cast_path) or os.path.getsize(cast_path) == 0:
+            return
+        position = max(bisect.bisect_right(times, start) - 1, 0)
+
+        with open(cast_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for line in self._iter_lines(mapped, offsets[position]):
+                    if not line.startswith(b"["):
+                        continue
+                    event = json.loads(line)
+                    if event[0] < start:
+                        continue
+                    event[0] = round(event[0] - start, 6)
+                    yield (json.dumps(event) + "\n").encode('utf-8')
+
+    def _iter_lines(self, mapped: mmap.mmap, offset: int) -> Iterator[bytes]:
+        """Décompresse les membres gzip successifs à partir d'un offset et découpe en lignes."""
+        decompressor = zlib.decompressobj(wbits=31)
+        pending = b""
+
+        while offset < len(mapped):
+            data = mapped[offset:offset + REPLAY_CHUNK_SIZE]
+            offset += len(data)
+
+            while data:
+                pending += decompressor.decompress(data)
+                if decompressor.eof:
+                    # Fin d'un membre : le reste appartient au membre suivant
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+                else:
+                    data = b""
+
+                *lines, pending = pending.split(b"\n")
+                yield from lines
+
+        if pending:
+            yield pending
+
+
+def list_recordings(directory: str, vm_id: Optional[str] = None) -> List[dict]:
+    """Liste les métadonnées des enregistrements disponibles."""
+    if not os.path.isdir(directory):
+        return []
+
+    recordings = []
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if vm_id is None or metadata.get("vm_id") == vm_id:
+            recordings.append(metadata)
+
+    return sorted(recordings, key=lambda m: m["started_at"], reverse=True)
+
+
+# Instance globale du writer d'enregistrements
+recording_writer = RecordingWriter(RECORDINGS_DIR)
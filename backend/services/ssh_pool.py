@@ -0,0 +1,164 @@
+import asyncio
+import os
+import time
+import logging
+from typing import Dict, Optional, Tuple
+
+try:
+    import asyncssh
+except ImportError:  # Le mode SSH natif est optionnel
+    asyncssh = None
+
+logger = logging.getLogger(__name__)
+
+# Mode SSH par défaut : "tcp" (SSH négocié par le navigateur) ou "native" (terminé par le backend)
+SSH_PROXY_MODE = os.getenv("SSH_PROXY_MODE", "tcp")
+SSH_USERNAME = os.getenv("SSH_USERNAME", "ubuntu")
+SSH_KEY_PATH = os.getenv("SSH_KEY_PATH", "/home/ubuntu/.ssh/id_rsa")
+SSH_CONNECT_TIMEOUT = float(os.getenv("SSH_CONNECT_TIMEOUT", "10"))
+SSH_KEEPALIVE_INTERVAL = int(os.getenv("SSH_KEEPALIVE_INTERVAL", "30"))
+# Un transport sans canal ouvert est fermé après ce délai
+SSH_POOL_IDLE_TIMEOUT = float(os.getenv("SSH_POOL_IDLE_TIMEOUT", "300"))
+
+
+class SSHAuthenticationError(Exception):
+    """La VM répond mais refuse la session : clé ou utilisateur (SSH_KEY_PATH, SSH_USERNAME) à corriger."""
+
+
+class PooledTransport:
+    """Connexion SSH partagée vers une VM et ses canaux ouverts."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.channels = 0
+        self.last_used = time.monotonic()
+
+
+class SSHTransportPool:
+    """
+    Pool de transports SSH terminés côté backend, un par VM (hôte, port).
+    Les sessions navigateur, les tests de disponibilité et les commandes rapides
+    ouvrent des canaux sur le transport existant au lieu de refaire un échange de clés.
+    """
+
+    def __init__(self):
+        self._transports: Dict[Tuple[str, int], PooledTransport] = {}
+        self._locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+        self._reaper: Optional[asyncio.Task] = None
+
+    @property
+    def available(self) -> bool:
+        """Indique si le mode SSH natif est utilisable (asyncssh installé)."""
+        return asyncssh is not None
+
+    async def _acquire(self, host: str, port: int) -> PooledTransport:
+        """Retourne le transport d'une VM, en l'ouvrant si nécessaire."""
+        if asyncssh is None:
+            raise RuntimeError("Le mode SSH natif nécessite le paquet asyncssh")
+
+        key = (host, port)
+        transport = self._transports.get(key)
+        if transport is not None and not transport.connection.is_closed():
+            transport.last_used = time.monotonic()
+            return transport
+
+        # Un seul échange de clés par VM, même si plusieurs sessions arrivent ensemble
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            transport = self._transports.get(key)
+            if transport is None or transport.connection.is_closed():
+                # Transport fermé (VM redémarrée, coupure) : retiré même si la reconnexion échoue
+                self._transports.pop(key, None)
+                connection = await asyncio.wait_for(
+                    asyncssh.connect(
+                        host, port,
+                        username=SSH_USERNAME,
+                        client_keys=[SSH_KEY_PATH],
+                        known_hosts=None,
+                        keepalive_interval=SSH_KEEPALIVE_INTERVAL
+                    ),
+                    timeout=SSH_CONNECT_TIMEOUT
+                )
+                transport = PooledTransport(connection)
+                self._transports[key] = transport
+                self._ensure_reaper()
+
+        transport.last_used = time.monotonic()
+        return transport
+
+    async def open_shell(self, host: str, port: int, cols: int = 80, rows: int = 24,
+                         term_type: str = "xterm-256color"):
+        """Ouvre un shell interactif (canal avec PTY) sur le transport de la VM."""
+        transport = await self._acquire(host, port)
+        process = await transport.connection.create_process(
+            term_type=term_type, term_size=(cols, rows), encoding=None
+        )
+        transport.channels += 1
+
+        def _release(_):
+            transport.channels -= 1
+            transport.last_used = time.monotonic()
+
+        asyncio.ensure_future(process.wait_closed()).add_done_callback(_release)
+        return process
+
+    async def run(self, host: str, port: int, command: str, timeout: float = 30) -> Tuple[int, str, str]:
+        """Exécute une commande rapide sur la VM et retourne (code, stdout, stderr)."""
+        transport = await self._acquire(host, port)
+        transport.channels += 1
+        try:
+            result = await asyncio.wait_for(
+                transport.connection.run(command, check=False), timeout=timeout
+            )
+            return result.exit_status, result.stdout or "", result.stderr or ""
+        finally:
+            transport.channels -= 1
+            transport.last_used = time.monotonic()
+
+    async def is_ready(self, host: str, port: int, timeout: float = 5) -> bool:
+        """
+        Vérifie qu'une VM accepte les sessions SSH. Un refus d'authentification ou une
+        clé illisible lève SSHAuthenticationError : attendre ne les corrigerait pas.
+        """
+        if asyncssh is None:
+            return False
+        try:
+            exit_status, _, _ = await self.run(host, port, "true", timeout=timeout)
+            return exit_status == 0
+        except (asyncssh.PermissionDenied, asyncssh.KeyImportError, FileNotFoundError, PermissionError) as e:
+            raise SSHAuthenticationError(
+                f"Session SSH refusée sur {host}:{port} ({SSH_USERNAME}, {SSH_KEY_PATH}): {e}"
+            ) from e
+        except Exception:
+            return False
+
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_idle())
+
+    async def _reap_idle(self):
+        """Ferme périodiquement les transports inactifs."""
+        while self._transports:
+            await asyncio.sleep(SSH_POOL_IDLE_TIMEOUT / 2)
+            now = time.monotonic()
+            for key, transport in list(self._transports.items()):
+                closed = transport.connection.is_closed()
+                idle = transport.channels == 0 and now - transport.last_used > SSH_POOL_IDLE_TIMEOUT
+                if closed or idle:
+                    del self._transports[key]
+                    transport.connection.close()
+
+    async def close_all(self):
+        """Ferme tous les transports du pool."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        transports = list(self._transports.values())
+        self._transports.clear()
+        for transport in transports:
+            transport.connection.close()
+            await transport.connection.wait_closed()
+
+
+# Instance globale du pool
+ssh_transport_pool = SSHTransportPool()
@@ -0,0 +1,11 @@
+from typing import Sequence
+
+
+def percentile(ordered: Sequence[float], p: float) -> float:
+    """Percentile par interpolation linéaire sur une série triée."""
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import re
+import shutil
+import time
+import uuid
+import logging
+from typing import Dict, Iterable, List, Optional, Set
+
+from database import SessionLocal
+from models import Lab
+from .virt_backend import VirtBackend, virt_backend
+
+logger = logging.getLogger(__name__)
+
+# Intervalle du ramasse-miettes des ressources orphelines en secondes (0 pour le désactiver)
+ORPHAN_GC_INTERVAL = float(os.getenv("ORPHAN_GC_INTERVAL", "3600"))
+# Destructions simultanées (domaines, volumes, réseaux) lors d'un démontage
+TEARDOWN_CONCURRENCY = int(os.getenv("TEARDOWN_CONCURRENCY", "8"))
+# Nombre maximal de labs orphelins nettoyés par cycle du ramasse-miettes
+ORPHAN_GC_BATCH = int(os.getenv("ORPHAN_GC_BATCH", "20"))
+# Un répertoire de travail récent peut appartenir à un lab en cours de création
+ORPHAN_GC_GRACE = 600.0
+
+WORKSPACE_ROOT = "/tmp"
+WORKSPACE_PREFIXES = ("terraform_lab_", "ansible_lab_")
+
+# Préfixe des ressources libvirt d'un lab : "lab_" suivi de l'UUID du lab, tirets remplacés
+_RESOURCE_LAB_ID = re.compile(
+    r"^lab_([0-9a-f]{8}_[0-9a-f]{4}_[0-9a-f]{4}_[0-9a-f]{4}_[0-9a-f]{12})"
+)
+
+
+def resource_lab_id(name: str) -> Optional[str]:
+    """Identifiant du lab propriétaire d'un domaine, d'un volume ou d'un réseau."""
+    match = _RESOURCE_LAB_ID.match(name)
+    return str(uuid.UUID(match.group(1).replace("_", "-"))) if match else None
+
+
+def workspace_dirs(lab_id) -> List[str]:
+    """Répertoires de travail Terraform et Ansible d'un lab."""
+    return [os.path.join(WORKSPACE_ROOT, f"{prefix}{lab_id}") for prefix in WORKSPACE_PREFIXES]
+
+
+class LabResources:
+    """Ressources libvirt et répertoires de travail encore présents, regroupés par lab."""
+
+    __slots__ = ('domains', 'volumes', 'networks', 'workspaces')
+
+    def __init__(self):
+        self.domains: List[str] = []
+        self.volumes: List[str] = []
+        self.networks: List[str] = []
+        self.workspaces: List[str] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.domains or self.volumes or self.networks or self.workspaces)
+
+
+async def inventory(backend: VirtBackend) -> Dict[str, LabResources]:
+    """Inventaire des ressources des labs : un appel par type de ressource."""
+    domains, volumes, networks = await asyncio.gather(
+        backend.list_states(), backend.list_volumes(), backend.list_networks()
+    )
+    resources: Dict[str, LabResources] = {}
+    for kind, names in (("domains", domains), ("volumes", volumes), ("networks", networks)):
+        for name in names:
+            lab_id = resource_lab_id(name)
+            if lab_id is not None:
+                getattr(resources.setdefault(lab_id, LabResources()), kind).append(name)
+    return resources
+
+
+def _scan_workspaces(older_than: float) -> Dict[str, List[str]]:
+    workspaces: Dict[str, List[str]] = {}
+    try:
+        entries = list(os.scandir(WORKSPACE_ROOT))
+    except OSError:
+        return workspaces
+    for entry in entries:
+        prefix = next((p for p in WORKSPACE_PREFIXES if entry.name.startswith(p)), None)
+        if prefix is None:
+            continue
+        try:
+            lab_id = str(uuid.UUID(entry.name[len(prefix):]))
+            if not entry.is_dir() or entry.stat().st_mtime > older_than:
+                continue
+        except (ValueError, OSError):
+            continue
+        workspaces.setdefault(lab_id, []).append(entry.path)
+    return workspaces
+
+
+def _remove_dirs(paths: Iterable[str]):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+async def destroy_resources(resources: LabResources, backend: Optional[VirtBackend] = None,
+                            concurrency: int = TEARDOWN_CONCURRENCY) -> List[str]:
+    """
+    Détruit des ressources en parallèle dans la limite de `concurrency` : les domaines
+    d'abord (ils utilisent les volumes et le réseau), puis volumes et réseaux, et enfin
+    les répertoires de travail. Retourne les erreurs rencontrées.
+    """
+    backend = backend or virt_backend
+    semaphore = asyncio.Semaphore(concurrency)
+    errors: List[str] = []
+
+    async def _destroy(operation, name: str):
+        async with semaphore:
+            try:
+                await operation(name)
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+
+    await asyncio.gather(*(_destroy(backend.destroy_domain, name) for name in resources.domains))
+    await asyncio.gather(
+        *(_destroy(backend.delete_volume, name) for name in resources.volumes),
+        *(_destroy(backend.destroy_network, name) for name in resources.networks)
+    )
+    if resources.workspaces:
+        await asyncio.to_thread(_remove_dirs, resources.workspaces)
+    return errors
+
+
+async def destroy_lab_resources(lab_id, backend: Optional[VirtBackend] = None) -> List[str]:
+    """
+    Détruit toute l'infrastructure d'un lab à partir de l'état de l'hyperviseur, sans
+    dépendre de l'état Terraform. Retourne les erreurs (reprises par le ramasse-miettes).
+    """
+    backend = backend or virt_backend
+    errors: List[str] = []
+    try:
+        resources = (await inventory(backend)).get(str(lab_id), LabResources())
+    except Exception as e:
+        # Hyperviseur injoignable : seuls les répertoires de travail sont supprimés maintenant
+        errors.append(f"inventaire: {e}")
+        resources = LabResources()
+    resources.workspaces = workspace_dirs(lab_id)
+    return errors + await destroy_resources(resources, backend)
+
+
+class OrphanCollector:
+    """
+    Ramasse-miettes périodique : compare les domaines, volumes, réseaux libvirt et les
+    répertoires de travail aux labs de la base, et détruit par lots ceux des labs disparus.
+    """
+
+    def __init__(self, backend: Optional[VirtBackend] = None, session_factory=SessionLocal,
+                 interval: float = ORPHAN_GC_INTERVAL, batch_size: int = ORPHAN_GC_BATCH):
+        self.backend = backend
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {'runs': 0, 'labs_cleaned': 0, 'resources_destroyed': 0, 'errors': 0, 'last_run': None}
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.collect_once()
+            except Exception as e:
+                logger.error(f"Erreur du ramasse-miettes des ressources orphelines: {e}")
+
+    def _known_lab_ids(self) -> Set[str]:
+        db = self.session_factory()
+        try:
+            return {str(lab_id) for (lab_id,) in db.query(Lab.id)}
+        finally:
+            db.close()
+
+    async def collect_once(self) -> dict:
+        """Un cycle : inventaire, comparaison à la base, destruction d'un lot d'orphelins."""
+        backend = self.backend or virt_backend
+        # Les ressources sont relevées avant les labs : un lab créé entre-temps n'est pas orphelin
+        resources = await inventory(backend)
+        workspaces = await asyncio.to_thread(_scan_workspaces, time.time() - ORPHAN_GC_GRACE)
+        for lab_id, paths in workspaces.items():
+            resources.setdefault(lab_id, LabResources()).workspaces.extend(paths)
+        known = await asyncio.to_thread(self._known_lab_ids)
+
+        orphans = sorted(lab_id for lab_id, found in resources.items() if lab_id not in known and found)
+        batch = orphans[:self.batch_size]
+        destroyed = errors = 0
+        for lab_id in batch:
+            found = resources[lab_id]
+            failures = await destroy_resources(found, backend)
+            for failure in failures:
+                logger.warning(f"Ressource orpheline du lab {lab_id} non détruite: {failure}")
+            errors += len(failures)
+            destroyed += len(found.domains) + len(found.volumes) + len(found.networks) + len(found.workspaces) - len(failures)
+
+        if batch:
+            logger.info(f"Ramasse-miettes: {len(batch)} lab(s) orphelin(s) nettoyé(s), {len(orphans) - len(batch)} restant(s)")
+        self.stats['runs'] += 1
+        self.stats['labs_cleaned'] += len(batch)
+        self.stats['resources_destroyed'] += destroyed
+        self.stats['errors'] += errors
+        self.stats['last_run'] = time.time()
+        return {'orphan_labs': len(orphans), 'cleaned': batch, 'destroyed': destroyed, 'errors': errors}
+
+
+# Instance globale du ramasse-miettes
+orphan_collector = OrphanCollector()
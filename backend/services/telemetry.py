@@ -0,0 +1,329 @@
+import bisect
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from database import query_listeners, track_queries
+
+logger = logging.getLogger(__name__)
+
+# Bornes des histogrammes : durées des requêtes HTTP et SQL (secondes), requêtes SQL par
+# requête HTTP, durées des étapes de déploiement
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+STAGE_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 3600.0)
+
+# Format texte de Prometheus (Starlette ajoute le jeu de caractères)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+_SQL_OPERATIONS = frozenset(("SELECT", "INSERT", "UPDATE", "DELETE", "BEGIN", "COMMIT", "ROLLBACK"))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """Métrique nommée, avec une valeur par combinaison d'étiquettes."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, object] = {}
+        # Les requêtes SQL sont aussi observées depuis les threads (asyncio.to_thread)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Valeur croissante. `set` sert aux totaux relevés à la collecte (octets relayés)."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    """Valeur instantanée, en général relevée à la collecte."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Répartition d'observations par bornes cumulées, avec somme et nombre."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe la durée du bloc, y compris s'il lève une exception."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Registre des métriques exposées au format texte de Prometheus. Les valeurs coûteuses
+    ou disponibles ailleurs (pool SQL, files, connexions proxy) sont relevées par des
+    collecteurs au moment de l'export plutôt que mises à jour en continu.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrique déjà enregistrée: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Fonction appelée avant chaque export pour mettre à jour des jauges."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(f"Collecteur de métriques en échec: {e}")
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+# Instance globale du registre des métriques
+metrics_registry = MetricsRegistry()
+
+http_request_duration = metrics_registry.histogram(
+    "vlm_http_request_duration_seconds", "Durée des requêtes HTTP par route.", ("method", "route", "status")
+)
+db_query_duration = metrics_registry.histogram(
+    "vlm_db_query_duration_seconds", "Durée des requêtes SQL par opération.", ("operation",)
+)
+http_request_queries = metrics_registry.histogram(
+    "vlm_http_request_queries", "Requêtes SQL par requête HTTP, par route (détection des N+1).", ("method", "route"),
+    QUERY_COUNT_BUCKETS
+)
+db_connection_hold = metrics_registry.histogram(
+    "vlm_db_connection_hold_seconds", "Durée de détention d'une connexion du pool SQL.",
+    buckets=LATENCY_BUCKETS + (30.0, 60.0, 300.0)
+)
+db_pool_connections = metrics_registry.gauge(
+    "vlm_db_pool_connections", "Connexions du pool SQL par état.", ("state",)
+)
+deploy_stage_duration = metrics_registry.histogram(
+    "vlm_deploy_stage_duration_seconds",
+    "Durée des étapes de déploiement (init, plan, apply, output, ssh_wait, ansible).",
+    ("stage",), STAGE_BUCKETS
+)
+deploy_duration = metrics_registry.histogram(
+    "vlm_deploy_duration_seconds", "Durée totale des déploiements par statut final.", ("status",), STAGE_BUCKETS
+)
+queue_depth = metrics_registry.gauge(
+    "vlm_queue_depth", "Travaux en attente : labs en file d'admission, playbooks en file de la ferme.", ("queue",)
+)
+labs_by_status = metrics_registry.gauge("vlm_labs", "Labs par statut.", ("status",))
+proxy_connections = metrics_registry.gauge(
+    "vlm_proxy_connections", "Connexions proxy SSH/VNC actives sur ce worker.", ("type",)
+)
+proxy_bytes = metrics_registry.counter(
+    "vlm_proxy_bytes_total", "Octets relayés par le proxy (in : vers la VM, out : vers le client).",
+    ("type", "direction")
+)
+
+
+def sql_operation(statement: str) -> str:
+    word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return word if word in _SQL_OPERATIONS else "OTHER"
+
+
+def _observe_query(statement: str, duration: float):
+    db_query_duration.observe(duration, operation=sql_operation(statement))
+
+
+# Durée des requêtes SQL, chronométrées par les événements posés dans database.py
+query_listeners.append(_observe_query)
+
+
+def instrument_engine(engine):
+    """Mesure le temps de détention des connexions du pool et relève son état à l'export."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        started = connection_record.info.pop("checked_out_at", None)
+        if started is not None:
+            db_connection_hold.observe(time.perf_counter() - started)
+
+    def _collect_pool():
+        pool = engine.pool
+        # Seul QueuePool expose ses compteurs (SQLite en mémoire utilise d'autres pools)
+        if hasattr(pool, "checkedout"):
+            db_pool_connections.set(pool.checkedout(), state="checked_out")
+            db_pool_connections.set(pool.checkedin(), state="idle")
+            db_pool_connections.set(max(pool.overflow(), 0), state="overflow")
+            db_pool_connections.set(pool.size(), state="size")
+
+    metrics_registry.add_collector(_collect_pool)
+
+
+def _collect_runtime():
+    """Files d'attente, labs et connexions proxy, relevés au moment de l'export."""
+    from sqlalchemy import func
+    from database import SessionLocal
+    from models import Lab
+    from .ansible_farm import ansible_farm
+    from .websocket_service import websocket_proxy_service
+
+    db = SessionLocal()
+    try:
+        statuses = dict(db.query(Lab.status, func.count()).group_by(Lab.status).all())
+    finally:
+        db.close()
+    labs_by_status.clear()
+    for status, count in statuses.items():
+        labs_by_status.set(count, status=status)
+    queue_depth.set(statuses.get("queued", 0), queue="admission")
+    queue_depth.set(ansible_farm.queue_depth(), queue="ansible")
+
+    connections = {"ssh": 0, "vnc": 0}
+    for record in websocket_proxy_service.registry.all():
+        connections[record.type] = connections.get(record.type, 0) + 1
+    for kind, count in connections.items():
+        proxy_connections.set(count, type=kind)
+    for (kind, direction), total in websocket_proxy_service.relayed_bytes().items():
+        proxy_bytes.set(total, type=kind, direction=direction)
+
+
+metrics_registry.add_collector(_collect_runtime)
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI : durée et nombre de requêtes SQL des requêtes HTTP par route (modèle
+    de chemin, pas le chemin effectif, pour borner le nombre de séries). Les requêtes SQL
+    sont comptées jusqu'à l'envoi de la réponse. Les WebSockets ne sont pas mesurés ici.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        with track_queries(f"{scope['method']} {scope['path']}") as stats:
+            async def send_with_status(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                    stats.active = False
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = getattr(scope.get("route"), "path", "unmatched")
+                http_request_duration.observe(
+                    time.perf_counter() - started, method=scope["method"], route=route, status=status
+                )
+                http_request_queries.observe(stats.count, method=scope["method"], route=route)
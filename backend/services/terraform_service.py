@@ -3,25 +3,56 @@ import subprocess
 import os
 import tempfile
 import json
+import re
+import time
 from pathlib import Path
+from typing import Callable, Optional
 from sqlalchemy.orm import Session
 from models import Lab, VM, DeploymentLog
+from .virt_backend import format_domain_name
+from .executors import command_executor
+from .telemetry import deploy_stage_duration
+from .tracing import span, record_span
 import uuid
 
 
+# Progression d'une ressource dans la sortie de `terraform apply`
+_TF_PROGRESS = re.compile(r'^(libvirt_\w+)\.(\w+): (Creating\.\.\.|Creation complete|Creation errored)')
+_ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+# Étape tracée selon le suffixe des volumes d'une VM
+_VOLUME_STAGES = (("_base", "image_download"), ("_disk", "volume_create"), ("_cloudinit", "cloudinit_create"))
+
+
+def _resource_stage(kind: str, name: str, vms: dict) -> tuple:
+    """Nom d'étape et VM concernée d'une ressource Terraform."""
+    if kind == "libvirt_domain":
+        # La création du domaine attend son bail DHCP (wait_for_lease)
+        return "wait_for_lease", vms.get(name)
+    if kind == "libvirt_network":
+        return "network_create", None
+    for suffix, stage in _VOLUME_STAGES:
+        if name.endswith(suffix):
+            return stage, vms.get(name[:-len(suffix)])
+    return "terraform.resource", None
+
+
 class TerraformService:
     def __init__(self):
         self.base_images_path = "/var/lib/libvirt/images"
         
-    async def deploy_lab(self, lab: Lab, db: Session):
-        """Déploie un laboratoire avec Terraform."""
+    async def deploy_lab(self, lab: Lab, db: Session, host: Optional[str] = None):
+        """Déploie un laboratoire avec Terraform sur l'hyperviseur `host`."""
         try:
             # Créer un répertoire de travail pour ce lab
             work_dir = f"/tmp/terraform_lab_{lab.id}"
             os.makedirs(work_dir, exist_ok=True)
             
+            # Ports SSH réservés avant le rendu : cloud-init configure sshd sur ceux que
+            # le proxy et Ansible utiliseront
+            ssh_ports = self._allocate_ssh_ports(lab, db)
+            
             # Générer la configuration Terraform
-            tf_config = self.generate_terraform_config(lab)
+            tf_config = self.generate_terraform_config(lab, host, ssh_ports)
             tf_file_path = os.path.join(work_dir, "main.tf")
             
             with open(tf_file_path, 'w') as f:
@@ -37,9 +68,10 @@ class TerraformService:
                 ["terraform", "plan"], work_dir, lab.id, db
             )
             
-            # Appliquer le déploiement
+            # Appliquer le déploiement (un span par ressource créée)
             await self._run_terraform_command(
-                ["terraform", "apply", "-auto-approve"], work_dir, lab.id, db
+                ["terraform", "apply", "-auto-approve"], work_dir, lab.id, db,
+                on_line=self._resource_spans(lab)
             )
             
             # Récupérer les outputs
@@ -48,7 +80,7 @@ class TerraformService:
             )
             
             # Parser les outputs et mettre à jour les VMs
-            await self._update_vms_from_outputs(lab, output_result, db)
+            await self._update_vms_from_outputs(lab, output_result, db, ssh_ports)
             
             return True
             
@@ -56,8 +88,11 @@ class TerraformService:
             await self._log_error(lab.id, f"Erreur Terraform: {str(e)}", db)
             return False
     
-    def generate_terraform_config(self, lab: Lab) -> str:
-        """Génère la configuration Terraform pour un lab."""
+    def generate_terraform_config(self, lab: Lab, host: Optional[str] = None,
+                                  ssh_ports: Optional[list] = None) -> str:
+        """Génère la configuration Terraform pour un lab (ports SSH : ceux des VMs par défaut)."""
+        if ssh_ports is None:
+            ssh_ports = [vm.ssh_port for vm in lab.vms]
         
         config = '''terraform {
   required_providers {
@@ -69,7 +104,7 @@ class TerraformService:
 }
 
 provider "libvirt" {
-  uri = "qemu:///system"
+  uri = "''' + (host or "qemu:///system") + '''"
 }
 
 # Pool de stockage par défaut
@@ -98,8 +133,8 @@ resource "libvirt_network" "lab_network" {
 '''
         
         # Générer les ressources pour chaque VM
-        for i, vm in enumerate(lab.vms):
-            vm_name = f"lab_{str(lab.id).replace('-', '_')}_{vm.name}".replace(" ", "_").replace("-", "_")
+        for vm, ssh_port in zip(lab.vms, ssh_ports):
+            vm_name = format_domain_name(lab.id, vm.name)
             
             # Image de base selon l'OS
             base_image_url = self._get_base_image_url(vm.os_image)
@@ -126,7 +161,7 @@ data "template_file" "{vm_name}_user_data" {{
   template = file("${{path.module}}/cloud_init.yml")
   vars = {{
     hostname = "{vm.name}"
-    ssh_port = {22000 + i}
+    ssh_port = {ssh_port}
   }}
 }}
 
@@ -174,6 +209,13 @@ output "{vm_name}_vnc_port" {{
   value = libvirt_domain.{vm_name}.graphics[0].port
 }}
 
+output "{vm_name}_domain" {{
+  value = {{
+    name = libvirt_domain.{vm_name}.name
+    uuid = libvirt_domain.{vm_name}.id
+  }}
+}}
+
 '''
         
         return config
@@ -189,19 +231,43 @@ output "{vm_name}_vnc_port" {{
         }
         return images.get(os_image, images["ubuntu-22.04"])
     
-    async def _run_terraform_command(self, command: list, working_dir: str, lab_id: uuid.UUID, db: Session) -> str:
-        """Exécute une commande Terraform et log la sortie."""
+    def _resource_spans(self, lab: Lab) -> Callable[[str], None]:
+        """
+        Lecteur de la progression de `terraform apply` : un span par ressource, entre
+        « Creating... » et « Creation complete » (image de base, disque, cloud-init,
+        domaine jusqu'au bail DHCP).
+        """
+        vms = {format_domain_name(lab.id, vm.name): vm.name for vm in lab.vms}
+        creating = {}
         
-        process = await asyncio.create_subprocess_exec(
-            *command,
-            cwd=working_dir,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            env={**os.environ, "TF_LOG": "INFO"}
-        )
+        def on_line(line: str):
+            match = _TF_PROGRESS.match(_ANSI_ESCAPE.sub("", line))
+            if not match:
+                return
+            kind, name, event = match.groups()
+            if event == "Creating...":
+                creating[name] = time.time()
+                return
+            start = creating.pop(name, None)
+            if start is None:
+                return
+            stage, vm_name = _resource_stage(kind, name, vms)
+            record_span(stage, start, time.time(), vm=vm_name,
+                        status="ok" if event == "Creation complete" else "error", resource=f"{kind}.{name}")
         
-        output, _ = await process.communicate()
-        output_str = output.decode('utf-8')
+        return on_line
+    
+    async def _run_terraform_command(self, command: list, working_dir: str, lab_id: uuid.UUID, db: Session,
+                                     on_line: Optional[Callable[[str], None]] = None) -> str:
+        """Exécute une commande Terraform et log la sortie."""
+        
+        with deploy_stage_duration.time(stage=command[1]), span(f"terraform.{command[1]}") as current:
+            result = await command_executor.run(
+                command, cwd=working_dir, env={**os.environ, "TF_LOG": "INFO"}, on_line=on_line
+            )
+            if current is not None and result.returncode != 0:
+                current.status = "error"
+        output_str = result.stdout
         
         # Logger la sortie
         log_entry = DeploymentLog(
@@ -212,18 +278,26 @@ output "{vm_name}_vnc_port" {{
         db.add(log_entry)
         db.commit()
         
-        if process.returncode != 0:
+        if result.returncode != 0:
             raise Exception(f"Terraform command failed: {output_str}")
         
         return output_str
     
-    async def _update_vms_from_outputs(self, lab: Lab, output_json: str, db: Session):
+    async def _update_vms_from_outputs(self, lab: Lab, output_json: str, db: Session, ssh_ports: list):
         """Met à jour les VMs avec les informations de Terraform."""
         try:
             outputs = json.loads(output_json)
             
-            for vm in lab.vms:
-                vm_name = f"lab_{str(lab.id).replace('-', '_')}_{vm.name}".replace(" ", "_").replace("-", "_")
+            for vm, ssh_port in zip(lab.vms, ssh_ports):
+                vm_name = format_domain_name(lab.id, vm.name)
+                
+                # Enregistrer le domaine créé (l'id Terraform d'un libvirt_domain est son UUID)
+                domain_key = f"{vm_name}_domain"
+                if domain_key in outputs:
+                    vm.domain_name = outputs[domain_key]["value"]["name"]
+                    vm.domain_uuid = outputs[domain_key]["value"]["uuid"]
+                else:
+                    vm.domain_name = vm_name
                 
                 # Récupérer l'IP
                 ip_key = f"{vm_name}_ip"
@@ -236,8 +310,8 @@ output "{vm_name}_vnc_port" {{
                 if vnc_port_key in outputs:
                     vm.vnc_port = outputs[vnc_port_key]["value"]
                 
-                # Assigner un port SSH unique
-                vm.ssh_port = 22000 + lab.vms.index(vm)
+                # Port SSH réservé avant l'apply, celui configuré par cloud-init
+                vm.ssh_port = ssh_port
                 vm.status = "running"
             
             db.commit()
@@ -245,6 +319,29 @@ output "{vm_name}_vnc_port" {{
         except Exception as e:
             await self._log_error(lab.id, f"Erreur lors de la mise à jour des VMs: {str(e)}", db)
     
+    def _allocate_ssh_ports(self, lab: Lab, db: Session) -> list:
+        """
+        Ports SSH redirigés pour les VMs du lab : les plus bas à partir de 22000 qui ne
+        sont pas déjà attribués à un autre lab. Ils sont enregistrés sur les VMs aussitôt,
+        sans attente entre la lecture et le commit : les déploiements concurrents du
+        processus ne peuvent pas se les disputer pendant l'apply.
+        """
+        taken = {
+            port for (port,) in db.query(VM.ssh_port).filter(
+                VM.ssh_port.isnot(None), VM.lab_id != lab.id
+            )
+        }
+        ports = []
+        port = 22000
+        while len(ports) < len(lab.vms):
+            if port not in taken:
+                ports.append(port)
+            port += 1
+        for vm, port in zip(lab.vms, ports):
+            vm.ssh_port = port
+        db.commit()
+        return ports
+    
     async def _log_error(self, lab_id: uuid.UUID, error_message: str, db: Session):
         """Log une erreur."""
         log_entry = DeploymentLog(
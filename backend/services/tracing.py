@@ -0,0 +1,213 @@
+import json
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import DeploymentSpan
+from .stats import percentile
+
+logger = logging.getLogger(__name__)
+
+# Trace du déploiement en cours et span ouvert dans la tâche courante
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("deploy_trace", default=None)
+_current_span: ContextVar[Optional["Span"]] = ContextVar("deploy_span", default=None)
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+class Span:
+    """Étape chronométrée d'un déploiement, éventuellement propre à une VM."""
+
+    __slots__ = ('seq', 'parent', 'name', 'vm', 'start', 'end', 'status', 'attributes')
+
+    def __init__(self, seq: int, parent: Optional[int], name: str, vm: Optional[str],
+                 start: float, attributes: dict):
+        self.seq = seq
+        self.parent = parent
+        self.name = name
+        self.vm = vm
+        self.start = start
+        self.end: Optional[float] = None
+        self.status = "ok"
+        self.attributes = attributes
+
+
+class Trace:
+    """
+    Spans d'une tentative de déploiement, gardés en mémoire jusqu'à la fin du
+    déploiement puis écrits en une insertion groupée.
+    """
+
+    def __init__(self, lab_id):
+        self.trace_id = uuid.uuid4()
+        self.lab_id = lab_id
+        self.spans: List[Span] = []
+        self._tokens = None
+
+    def open(self, name: str, vm: Optional[str] = None, start: Optional[float] = None, **attributes) -> Span:
+        """Ouvre un span, enfant du span courant de la tâche."""
+        parent = _current_span.get()
+        span = Span(len(self.spans), parent.seq if parent else None, name, vm,
+                    time.time() if start is None else start, attributes)
+        self.spans.append(span)
+        return span
+
+    def close(self, span: Span, status: str = "ok", end: Optional[float] = None, **attributes):
+        span.end = time.time() if end is None else end
+        span.status = status
+        span.attributes.update(attributes)
+
+    @contextmanager
+    def span(self, name: str, vm: Optional[str] = None, **attributes):
+        """Span couvrant le bloc ; il devient le parent des spans ouverts dans le bloc."""
+        span = self.open(name, vm, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException:
+            self.close(span, "error")
+            raise
+        else:
+            self.close(span, span.status)
+        finally:
+            _current_span.reset(token)
+
+    def rows(self) -> List[dict]:
+        now = time.time()
+        return [{
+            'trace_id': self.trace_id, 'lab_id': self.lab_id, 'seq': span.seq,
+            'parent_seq': span.parent, 'name': span.name, 'vm_name': span.vm,
+            'started_at': span.start,
+            'duration': (span.end if span.end is not None else now) - span.start,
+            'status': span.status if span.end is not None else "error",
+            'attributes': json.dumps(span.attributes, separators=(',', ':'), default=str)
+            if span.attributes else None,
+        } for span in self.spans]
+
+    def save(self, session_factory=SessionLocal):
+        """Écrit les spans en une insertion (appel bloquant, à exécuter dans un thread)."""
+        rows = self.rows()
+        if not rows:
+            return
+        db = session_factory()
+        try:
+            db.execute(DeploymentSpan.__table__.insert(), rows)
+            db.commit()
+        finally:
+            db.close()
+
+
+def begin_trace(lab_id, name: str = "deploy", **attributes) -> Trace:
+    """Ouvre une trace et son span racine dans la tâche courante (celle du déploiement)."""
+    trace = Trace(lab_id)
+    root = Span(0, None, name, None, time.time(), attributes)
+    trace.spans.append(root)
+    trace._tokens = (_current_trace.set(trace), _current_span.set(root))
+    return trace
+
+
+def end_trace(trace: Trace, status: str = "ok", **attributes):
+    """Ferme le span racine et retire la trace de la tâche courante."""
+    trace.close(trace.spans[0], status, **attributes)
+    if trace._tokens:
+        trace_token, span_token = trace._tokens
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        trace._tokens = None
+
+
+@contextmanager
+def span(name: str, vm: Optional[str] = None, **attributes):
+    """Span de la trace courante ; sans déploiement tracé (destruction, tests), ne fait rien."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, vm, **attributes) as current:
+        yield current
+
+
+def record_span(name: str, start: float, end: float, vm: Optional[str] = None,
+                status: str = "ok", **attributes):
+    """Span reconstitué a posteriori (ressource Terraform, VM joignable), enfant du span courant."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.close(trace.open(name, vm, start=start, **attributes), status, end=end)
+
+
+def _span_dict(row, origin: float) -> dict:
+    return {
+        'id': row.seq,
+        'parent': row.parent_seq,
+        'name': row.name,
+        'vm': row.vm_name,
+        'offset_ms': round((row.started_at - origin) * 1000, 1),
+        'duration_ms': round(row.duration * 1000, 1),
+        'status': row.status,
+        'attributes': json.loads(row.attributes) if row.attributes else {},
+    }
+
+
+def lab_timeline(db: Session, lab_id, trace_id: Optional[uuid.UUID] = None) -> Optional[dict]:
+    """Chronologie d'une tentative de déploiement (la dernière par défaut) et liste des tentatives."""
+    roots = db.query(
+        DeploymentSpan.trace_id, DeploymentSpan.started_at, DeploymentSpan.duration, DeploymentSpan.status
+    ).filter(DeploymentSpan.lab_id == lab_id, DeploymentSpan.parent_seq.is_(None)).order_by(
+        DeploymentSpan.started_at.desc()
+    ).all()
+    if not roots:
+        return None
+    selected = next((root for root in roots if root.trace_id == trace_id), None) if trace_id else roots[0]
+    if selected is None:
+        return None
+
+    rows = db.query(DeploymentSpan).filter(DeploymentSpan.trace_id == selected.trace_id).order_by(
+        DeploymentSpan.seq
+    ).all()
+    return {
+        'lab_id': str(lab_id),
+        'trace_id': str(selected.trace_id),
+        'started_at': selected.started_at,
+        'duration_ms': round(selected.duration * 1000, 1),
+        'status': selected.status,
+        'spans': [_span_dict(row, selected.started_at) for row in rows],
+        'attempts': [{
+            'trace_id': str(root.trace_id),
+            'started_at': root.started_at,
+            'duration_ms': round(root.duration * 1000, 1),
+            'status': root.status,
+        } for root in roots],
+    }
+
+
+def stage_percentiles(db: Session, since: float, names: Optional[Iterable[str]] = None,
+                      status: Optional[str] = None) -> Dict[str, dict]:
+    """Percentiles de durée par étape sur l'ensemble des labs, depuis l'epoch `since`."""
+    query = db.query(DeploymentSpan.name, DeploymentSpan.duration).filter(DeploymentSpan.started_at >= since)
+    if names:
+        query = query.filter(DeploymentSpan.name.in_(list(names)))
+    if status:
+        query = query.filter(DeploymentSpan.status == status)
+
+    durations: Dict[str, List[float]] = {}
+    for name, duration in query:
+        durations.setdefault(name, []).append(duration)
+
+    stages = {}
+    for name, values in sorted(durations.items()):
+        values.sort()
+        summary = {
+            'count': len(values),
+            'mean_ms': round(sum(values) / len(values) * 1000, 1),
+            'max_ms': round(values[-1] * 1000, 1),
+        }
+        for p in PERCENTILES:
+            summary[f'p{p}_ms'] = round(percentile(values, p) * 1000, 1)
+        stages[name] = summary
+    return stages
@@ -0,0 +1,705 @@
+import asyncio
+import os
+import threading
+import uuid
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+try:
+    import libvirt
+except ImportError:  # Le backend virsh est utilisé à la place
+    libvirt = None
+
+from .executors import command_executor
+
+logger = logging.getLogger(__name__)
+
+# "libvirt" (API native), "virsh" (sous-processus) ou "fake" (tests)
+VIRT_BACKEND = os.getenv("VIRT_BACKEND", "libvirt")
+# Un ou plusieurs hyperviseurs, séparés par des virgules
+LIBVIRT_URI = os.getenv("LIBVIRT_URI", "qemu:///system")
+LIBVIRT_POOL_SIZE = int(os.getenv("LIBVIRT_POOL_SIZE", "4"))
+LIBVIRT_THREADS = int(os.getenv("LIBVIRT_THREADS", "16"))
+# Pool de stockage des volumes créés par Terraform
+STORAGE_POOL = "default"
+
+# États libvirt (virDomainState) -> noms utilisés par virsh
+DOMAIN_STATES = {
+    0: "nostate",
+    1: "running",
+    2: "blocked",
+    3: "paused",
+    4: "shutdown",
+    5: "shutoff",
+    6: "crashed",
+    7: "pmsuspended",
+}
+
+
+class DomainNotFound(Exception):
+    """Le domaine n'existe sur aucun hyperviseur configuré."""
+
+
+def format_domain_name(lab_id, vm_name: str) -> str:
+    """Nom de domaine donné par TerraformService à une VM."""
+    return f"lab_{str(lab_id).replace('-', '_')}_{vm_name}".replace(" ", "_").replace("-", "_")
+
+
+def domain_name(vm) -> str:
+    """
+    Nom du domaine libvirt d'une VM : celui enregistré au déploiement, sinon le nom
+    généré à partir de lab_id (sans chargement de vm.lab). Accepte aussi une ligne
+    de requête portant les colonnes domain_name, lab_id et name.
+    """
+    return vm.domain_name or format_domain_name(vm.lab_id, vm.name)
+
+
+def app_status(state: str) -> str:
+    """Traduit un état de domaine en statut de l'application."""
+    if state in ("running", "blocked"):
+        return "running"
+    if state in ("shutoff", "shut off"):
+        return "stopped"
+    if state == "crashed":
+        return "error"
+    return "unknown"
+
+
+def stats_counters(raw: dict) -> dict:
+    """
+    Réduit les statistiques groupées d'un domaine (clés de virConnectGetAllDomainStats,
+    identiques à celles de `virsh domstats`) à des compteurs cumulés.
+    """
+    def _sum(prefix: str, count_key: str, suffix: str) -> int:
+        return sum(int(raw.get(f"{prefix}.{i}.{suffix}", 0)) for i in range(int(raw.get(count_key, 0))))
+
+    memory_kb = int(raw.get("balloon.current", 0))
+    unused_kb = raw.get("balloon.unused")
+    return {
+        'state': DOMAIN_STATES.get(int(raw.get("state.state", 0)), "nostate"),
+        'cpu_time_ns': int(raw.get("cpu.time", 0)),
+        'vcpus': int(raw.get("vcpu.current", 1)) or 1,
+        'memory_kb': memory_kb,
+        # Sans statistiques de l'agent ballon, la mémoire résidente du processus QEMU sert d'estimation
+        'memory_used_kb': memory_kb - int(unused_kb) if unused_kb is not None else int(raw.get("balloon.rss", 0)),
+        'disk_read_bytes': _sum("block", "block.count", "rd.bytes"),
+        'disk_write_bytes': _sum("block", "block.count", "wr.bytes"),
+        'net_rx_bytes': _sum("net", "net.count", "rx.bytes"),
+        'net_tx_bytes': _sum("net", "net.count", "tx.bytes"),
+    }
+
+
+class VirtBackend(ABC):
+    """
+    Interface commune des backends de gestion des domaines. Un backend qui n'implémente
+    pas toutes les opérations abstraites échoue dès son instanciation.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def start(self, name: str):
+        ...
+
+    @abstractmethod
+    async def shutdown(self, name: str):
+        ...
+
+    @abstractmethod
+    async def reboot(self, name: str):
+        ...
+
+    @abstractmethod
+    async def managed_save(self, name: str):
+        """Suspend un domaine sur disque ; le prochain démarrage restaure sa mémoire."""
+
+    @abstractmethod
+    async def state(self, name: str) -> str:
+        ...
+
+    @abstractmethod
+    async def info(self, name: str) -> dict:
+        ...
+
+    @abstractmethod
+    async def list_states(self) -> Dict[str, str]:
+        """États de tous les domaines de tous les hyperviseurs, en un appel par hôte."""
+
+    async def list_domains(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """État et UUID de chaque domaine ; UUID à None si le backend ne le relève pas."""
+        return {name: (state, None) for name, state in (await self.list_states()).items()}
+
+    @abstractmethod
+    async def bulk_stats(self) -> Dict[str, dict]:
+        """Compteurs cumulés (voir stats_counters) de tous les domaines, en un appel par hôte."""
+
+    @abstractmethod
+    async def host_capacity(self) -> Dict[str, dict]:
+        """Ressources physiques de chaque hyperviseur : {'vcpu', 'ram_mb', 'disk_gb'} par hôte."""
+
+    # Destruction des ressources : chaque opération ignore une ressource déjà absente
+
+    @abstractmethod
+    async def destroy_domain(self, name: str):
+        """Arrête brutalement un domaine s'il est actif puis supprime sa définition."""
+
+    @abstractmethod
+    async def list_volumes(self, pool: str = STORAGE_POOL) -> List[str]:
+        ...
+
+    @abstractmethod
+    async def delete_volume(self, name: str, pool: str = STORAGE_POOL):
+        ...
+
+    @abstractmethod
+    async def list_networks(self) -> List[str]:
+        ...
+
+    @abstractmethod
+    async def destroy_network(self, name: str):
+        ...
+
+    async def close(self):
+        pass
+
+
+class LibvirtConnectionPool:
+    """Connexions ouvertes vers un hyperviseur, réutilisées d'un appel à l'autre."""
+
+    def __init__(self, uri: str, size: int = LIBVIRT_POOL_SIZE):
+        self.uri = uri
+        self._idle: List = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @staticmethod
+    def _alive(conn) -> bool:
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    @contextmanager
+    def connection(self):
+        """Emprunte une connexion (ouverte à la demande, remplacée si elle est morte)."""
+        self._slots.acquire()
+        conn = None
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is not None and not self._alive(conn):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = libvirt.open(self.uri)
+            yield conn
+        except Exception:
+            if conn is not None and not self._alive(conn):
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                with self._lock:
+                    self._idle.append(conn)
+            self._slots.release()
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            connections, self._idle = self._idle, []
+        for conn in connections:
+            self._discard(conn)
+
+
+class LibvirtBackend(VirtBackend):
+    """
+    Backend utilisant l'API libvirt : connexions persistantes par hyperviseur et
+    appels bloquants exécutés dans un pool de threads.
+    """
+
+    name = "libvirt"
+
+    def __init__(self, uris: Optional[List[str]] = None, pool_size: int = LIBVIRT_POOL_SIZE,
+                 threads: int = LIBVIRT_THREADS):
+        if libvirt is None:
+            raise RuntimeError("Le backend libvirt nécessite le paquet python-libvirt")
+        # Supprime l'affichage des erreurs libvirt sur stderr : elles sont remontées en exceptions
+        libvirt.registerErrorHandler(lambda *args: None, None)
+        uris = uris or [uri.strip() for uri in LIBVIRT_URI.split(",") if uri.strip()]
+        self.pools = {uri: LibvirtConnectionPool(uri, pool_size) for uri in uris}
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="libvirt")
+        # Hyperviseur sur lequel chaque domaine a été trouvé
+        self._locations: Dict[str, str] = {}
+
+    async def _call(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _with_domain(self, name: str, fn: Callable):
+        known = self._locations.get(name)
+        uris = ([known] if known else []) + [uri for uri in self.pools if uri != known]
+        for uri in uris:
+            with self.pools[uri].connection() as conn:
+                try:
+                    domain = conn.lookupByName(name)
+                except libvirt.libvirtError as e:
+                    if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                        continue
+                    raise
+                self._locations[name] = uri
+                return fn(domain)
+        self._locations.pop(name, None)
+        raise DomainNotFound(f"Domaine introuvable: {name}")
+
+    async def start(self, name: str):
+        await self._call(self._with_domain, name, lambda domain: domain.create())
+
+    async def shutdown(self, name: str):
+        await self._call(self._with_domain, name, lambda domain: domain.shutdown())
+
+    async def reboot(self, name: str):
+        await self._call(self._with_domain, name, lambda domain: domain.reboot(0))
+
+    async def managed_save(self, name: str):
+        await self._call(self._with_domain, name, lambda domain: domain.managedSave(0))
+
+    async def state(self, name: str) -> str:
+        state, _ = await self._call(self._with_domain, name, lambda domain: domain.state())
+        return DOMAIN_STATES.get(state, "nostate")
+
+    async def info(self, name: str) -> dict:
+        def _info(domain):
+            state, max_memory, memory, vcpus, cpu_time = domain.info()
+            return {
+                'name': domain.name(),
+                'uuid': domain.UUIDString(),
+                'state': DOMAIN_STATES.get(state, "nostate"),
+                'status': app_status(DOMAIN_STATES.get(state, "nostate")),
+                'vcpus': vcpus,
+                'max_memory_kb': max_memory,
+                'memory_kb': memory,
+                'cpu_time_ns': cpu_time,
+                'persistent': bool(domain.isPersistent()),
+                'autostart': bool(domain.autostart()),
+                'host': self._locations.get(name)
+            }
+
+        return await self._call(self._with_domain, name, _info)
+
+    def _host_domains(self, uri: str) -> Dict[str, Tuple[str, str]]:
+        with self.pools[uri].connection() as conn:
+            stats = conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        domains = {}
+        for domain, record in stats:
+            name = domain.name()
+            domains[name] = (DOMAIN_STATES.get(record.get("state.state"), "nostate"), domain.UUIDString())
+            self._locations[name] = uri
+        return domains
+
+    async def list_domains(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        results = await asyncio.gather(*(self._call(self._host_domains, uri) for uri in self.pools))
+        domains = {}
+        for host_domains in results:
+            domains.update(host_domains)
+        return domains
+
+    async def list_states(self) -> Dict[str, str]:
+        return {name: state for name, (state, _) in (await self.list_domains()).items()}
+
+    def _host_stats(self, uri: str) -> Dict[str, dict]:
+        with self.pools[uri].connection() as conn:
+            stats = conn.getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+                | libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU
+                | libvirt.VIR_DOMAIN_STATS_INTERFACE | libvirt.VIR_DOMAIN_STATS_BLOCK
+            )
+        return {domain.name(): stats_counters(record) for domain, record in stats}
+
+    async def bulk_stats(self) -> Dict[str, dict]:
+        results = await asyncio.gather(*(self._call(self._host_stats, uri) for uri in self.pools))
+        stats = {}
+        for host_stats in results:
+            stats.update(host_stats)
+        return stats
+
+    def _host_capacity(self, uri: str) -> dict:
+        with self.pools[uri].connection() as conn:
+            _, memory_mb, cpus = conn.getInfo()[:3]
+            try:
+                _, capacity, _, _ = conn.storagePoolLookupByName(STORAGE_POOL).info()
+            except libvirt.libvirtError:
+                capacity = 0
+        return {'vcpu': cpus, 'ram_mb': memory_mb, 'disk_gb': capacity // 1024 ** 3}
+
+    async def host_capacity(self) -> Dict[str, dict]:
+        results = await asyncio.gather(*(self._call(self._host_capacity, uri) for uri in self.pools))
+        return dict(zip(self.pools, results))
+
+    def _destroy_domain(self, name: str):
+        def _destroy(domain):
+            if domain.isActive():
+                domain.destroy()
+            domain.undefineFlags(
+                libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE | libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA
+            )
+
+        try:
+            self._with_domain(name, _destroy)
+        except DomainNotFound:
+            pass
+        self._locations.pop(name, None)
+
+    async def destroy_domain(self, name: str):
+        await self._call(self._destroy_domain, name)
+
+    def _each_host(self, fn: Callable) -> list:
+        """Applique `fn(conn)` sur chaque hyperviseur et concatène les résultats."""
+        results = []
+        for pool in self.pools.values():
+            with pool.connection() as conn:
+                results.extend(fn(conn))
+        return results
+
+    def _list_volumes(self, pool: str) -> List[str]:
+        def _volumes(conn):
+            try:
+                storage = conn.storagePoolLookupByName(pool)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_POOL:
+                    return []
+                raise
+            storage.refresh(0)
+            return storage.listVolumes()
+
+        return self._each_host(_volumes)
+
+    async def list_volumes(self, pool: str = STORAGE_POOL) -> List[str]:
+        return await self._call(self._list_volumes, pool)
+
+    def _delete_volume(self, name: str, pool: str):
+        def _delete(conn):
+            try:
+                conn.storagePoolLookupByName(pool).storageVolLookupByName(name).delete(0)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() not in (libvirt.VIR_ERR_NO_STORAGE_POOL, libvirt.VIR_ERR_NO_STORAGE_VOL):
+                    raise
+            return []
+
+        self._each_host(_delete)
+
+    async def delete_volume(self, name: str, pool: str = STORAGE_POOL):
+        await self._call(self._delete_volume, name, pool)
+
+    async def list_networks(self) -> List[str]:
+        return await self._call(
+            self._each_host, lambda conn: [network.name() for network in conn.listAllNetworks()]
+        )
+
+    def _destroy_network(self, name: str):
+        def _destroy(conn):
+            try:
+                network = conn.networkLookupByName(name)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() == libvirt.VIR_ERR_NO_NETWORK:
+                    return []
+                raise
+            if network.isActive():
+                network.destroy()
+            network.undefine()
+            return []
+
+        self._each_host(_destroy)
+
+    async def destroy_network(self, name: str):
+        await self._call(self._destroy_network, name)
+
+    async def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self._executor.shutdown(wait=False)
+
+
+# Messages de virsh pour une ressource absente ou un domaine déjà arrêté
+_VIRSH_MISSING = (
+    "not found", "no storage vol", "no network with matching name", "no storage pool",
+    "domain is not running", "network is not active"
+)
+
+
+class VirshBackend(VirtBackend):
+    """Backend de repli : une commande virsh par opération."""
+
+    name = "virsh"
+
+    def __init__(self, uri: Optional[str] = None):
+        self.uri = uri or LIBVIRT_URI.split(",")[0].strip()
+
+    async def _virsh(self, *args) -> str:
+        command = ["virsh", "-c", self.uri, *args] if self.uri else ["virsh", *args]
+        result = await command_executor.run(command, merge_stderr=False)
+        if result.returncode != 0:
+            message = result.stderr.strip()
+            if "failed to get domain" in message or "Domain not found" in message:
+                raise DomainNotFound(f"Domaine introuvable: {args[-1]}")
+            raise RuntimeError(message)
+        return result.stdout
+
+    async def _virsh_ignore_missing(self, *args):
+        try:
+            await self._virsh(*args)
+        except DomainNotFound:
+            pass
+        except RuntimeError as e:
+            message = str(e)
+            if not any(marker in message for marker in _VIRSH_MISSING):
+                raise
+
+    async def start(self, name: str):
+        await self._virsh("start", name)
+
+    async def shutdown(self, name: str):
+        await self._virsh("shutdown", name)
+
+    async def reboot(self, name: str):
+        await self._virsh("reboot", name)
+
+    async def managed_save(self, name: str):
+        await self._virsh("managedsave", name)
+
+    async def state(self, name: str) -> str:
+        state = (await self._virsh("domstate", name)).strip()
+        return "shutoff" if state == "shut off" else state
+
+    async def info(self, name: str) -> dict:
+        raw = {}
+        for line in (await self._virsh("dominfo", name)).split('\n'):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                raw[key.strip()] = value.strip()
+
+        state = "shutoff" if raw.get("State") == "shut off" else raw.get("State", "nostate")
+        return {
+            'name': raw.get("Name", name),
+            'uuid': raw.get("UUID"),
+            'state': state,
+            'status': app_status(state),
+            'vcpus': int(raw.get("CPU(s)", 0) or 0),
+            'max_memory_kb': int(raw.get("Max memory", "0").split()[0] or 0),
+            'memory_kb': int(raw.get("Used memory", "0").split()[0] or 0),
+            'cpu_time_ns': None,
+            'persistent': raw.get("Persistent") == "yes",
+            'autostart': raw.get("Autostart") == "enable",
+            'host': self.uri
+        }
+
+    async def list_states(self) -> Dict[str, str]:
+        states = {}
+        output = await self._virsh("list", "--all")
+        # Lignes du tableau après l'en-tête : " Id   Name   State"
+        for line in output.splitlines()[2:]:
+            parts = line.split(None, 2)
+            if len(parts) == 3:
+                state = parts[2].strip()
+                states[parts[1]] = "shutoff" if state == "shut off" else state
+        return states
+
+    async def bulk_stats(self) -> Dict[str, dict]:
+        output = await self._virsh(
+            "domstats", "--state", "--cpu-total", "--balloon", "--vcpu", "--interface", "--block"
+        )
+        stats, name, raw = {}, None, {}
+        # Blocs "Domain: 'nom'" suivis de lignes "  clé=valeur"
+        for line in output.splitlines() + ["Domain: ''"]:
+            if line.startswith("Domain:"):
+                if name:
+                    stats[name] = stats_counters(raw)
+                name, raw = line.split(":", 1)[1].strip().strip("'"), {}
+            elif "=" in line:
+                key, value = line.strip().split("=", 1)
+                raw[key] = value
+        return stats
+
+    async def host_capacity(self) -> Dict[str, dict]:
+        raw = {}
+        for line in (await self._virsh("nodeinfo")).splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                raw[key.strip()] = value.strip()
+        capacity = 0
+        try:
+            for line in (await self._virsh("pool-info", STORAGE_POOL, "--bytes")).splitlines():
+                if line.startswith("Capacity:"):
+                    capacity = int(line.split(':', 1)[1].strip())
+        except RuntimeError:
+            pass
+        return {self.uri: {
+            'vcpu': int(raw.get("CPU(s)", 0) or 0),
+            'ram_mb': int(raw.get("Memory size", "0").split()[0] or 0) // 1024,
+            'disk_gb': capacity // 1024 ** 3
+        }}
+
+    async def destroy_domain(self, name: str):
+        await self._virsh_ignore_missing("destroy", name)
+        await self._virsh_ignore_missing("undefine", name, "--managed-save", "--snapshots-metadata")
+
+    async def list_volumes(self, pool: str = STORAGE_POOL) -> List[str]:
+        try:
+            output = await self._virsh("vol-list", "--pool", pool)
+        except RuntimeError as e:
+            if "no storage pool" in str(e):
+                return []
+            raise
+        # Lignes du tableau après l'en-tête : " Name   Path"
+        return [line.split()[0] for line in output.splitlines()[2:] if line.strip()]
+
+    async def delete_volume(self, name: str, pool: str = STORAGE_POOL):
+        await self._virsh_ignore_missing("vol-delete", name, "--pool", pool)
+
+    async def list_networks(self) -> List[str]:
+        output = await self._virsh("net-list", "--all", "--name")
+        return [line.strip() for line in output.splitlines() if line.strip()]
+
+    async def destroy_network(self, name: str):
+        await self._virsh_ignore_missing("net-destroy", name)
+        await self._virsh_ignore_missing("net-undefine", name)
+
+
+class FakeBackend(VirtBackend):
+    """Backend en mémoire pour les tests : aucun hyperviseur nécessaire."""
+
+    name = "fake"
+
+    def __init__(self):
+        self.domains: Dict[str, dict] = {}
+        self.volumes: Set[str] = set()
+        self.networks: Set[str] = set()
+        self.hosts: Dict[str, dict] = {"fake": {'vcpu': 16, 'ram_mb': 65536, 'disk_gb': 1000}}
+        self.calls: List[tuple] = []
+
+    def add_domain(self, name: str, state: str = "shutoff", vcpus: int = 1, memory_kb: int = 1048576,
+                   domain_uuid: Optional[str] = None):
+        self.domains[name] = {
+            'state': state, 'vcpus': vcpus, 'memory_kb': memory_kb, 'uuid': domain_uuid or str(uuid.uuid4()),
+            'counters': {'cpu_time_ns': 0, 'disk_read_bytes': 0, 'disk_write_bytes': 0,
+                         'net_rx_bytes': 0, 'net_tx_bytes': 0}
+        }
+
+    def _domain(self, name: str) -> dict:
+        if name not in self.domains:
+            raise DomainNotFound(f"Domaine introuvable: {name}")
+        return self.domains[name]
+
+    async def start(self, name: str):
+        self.calls.append(("start", name))
+        domain = self._domain(name)
+        if domain['state'] == "running":
+            raise RuntimeError("Le domaine est déjà actif")
+        domain['state'] = "running"
+
+    async def shutdown(self, name: str):
+        self.calls.append(("shutdown", name))
+        domain = self._domain(name)
+        if domain['state'] != "running":
+            raise RuntimeError("Le domaine n'est pas actif")
+        domain['state'] = "shutoff"
+
+    async def reboot(self, name: str):
+        self.calls.append(("reboot", name))
+        domain = self._domain(name)
+        if domain['state'] != "running":
+            raise RuntimeError("Le domaine n'est pas actif")
+
+    async def managed_save(self, name: str):
+        self.calls.append(("managed_save", name))
+        domain = self._domain(name)
+        if domain['state'] != "running":
+            raise RuntimeError("Le domaine n'est pas actif")
+        domain['state'] = "shutoff"
+
+    async def state(self, name: str) -> str:
+        return self._domain(name)['state']
+
+    async def info(self, name: str) -> dict:
+        domain = self._domain(name)
+        return {
+            'name': name,
+            'uuid': domain['uuid'],
+            'state': domain['state'],
+            'status': app_status(domain['state']),
+            'vcpus': domain['vcpus'],
+            'max_memory_kb': domain['memory_kb'],
+            'memory_kb': domain['memory_kb'],
+            'cpu_time_ns': 0,
+            'persistent': True,
+            'autostart': False,
+            'host': "fake"
+        }
+
+    async def list_states(self) -> Dict[str, str]:
+        return {name: domain['state'] for name, domain in self.domains.items()}
+
+    async def list_domains(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        return {name: (domain['state'], domain['uuid']) for name, domain in self.domains.items()}
+
+    async def bulk_stats(self) -> Dict[str, dict]:
+        """Compteurs synthétiques : chaque appel simule une activité constante des domaines actifs."""
+        stats = {}
+        for name, domain in self.domains.items():
+            counters = domain['counters']
+            if domain['state'] == "running":
+                counters['cpu_time_ns'] += 250_000_000 * domain['vcpus']
+                counters['disk_read_bytes'] += 4096
+                counters['disk_write_bytes'] += 8192
+                counters['net_rx_bytes'] += 1500
+                counters['net_tx_bytes'] += 3000
+            stats[name] = dict(
+                counters, state=domain['state'], vcpus=domain['vcpus'],
+                memory_kb=domain['memory_kb'], memory_used_kb=domain['memory_kb'] // 2
+            )
+        return stats
+
+    async def host_capacity(self) -> Dict[str, dict]:
+        return {host: dict(capacity) for host, capacity in self.hosts.items()}
+
+    async def destroy_domain(self, name: str):
+        self.calls.append(("destroy_domain", name))
+        self.domains.pop(name, None)
+
+    async def list_volumes(self, pool: str = STORAGE_POOL) -> List[str]:
+        return sorted(self.volumes)
+
+    async def delete_volume(self, name: str, pool: str = STORAGE_POOL):
+        self.calls.append(("delete_volume", name))
+        self.volumes.discard(name)
+
+    async def list_networks(self) -> List[str]:
+        return sorted(self.networks)
+
+    async def destroy_network(self, name: str):
+        self.calls.append(("destroy_network", name))
+        self.networks.discard(name)
+
+
+def create_virt_backend(name: str = VIRT_BACKEND) -> VirtBackend:
+    """Instancie le backend configuré, avec repli sur virsh si libvirt est indisponible."""
+    if name == "fake":
+        return FakeBackend()
+    if name == "libvirt":
+        if libvirt is not None:
+            return LibvirtBackend()
+        logger.warning("python-libvirt non installé, utilisation du backend virsh")
+    return VirshBackend()
+
+
+# Instance globale du backend de virtualisation
+virt_backend = create_virt_backend()
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import time
+import uuid
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import VM
+
+logger = logging.getLogger(__name__)
+
+# Filet de sécurité pour les changements faits par un autre worker ou hors de l'ORM
+VM_CACHE_TTL = float(os.getenv("VM_CACHE_TTL", "30"))
+
+
+class VMEndpoint:
+    """Ports et statut d'une VM, tels que nécessaires au proxy WebSocket."""
+
+    __slots__ = ('vm_id', 'lab_id', 'status', 'ssh_port', 'vnc_port', 'cached_at')
+
+    def __init__(self, vm_id: str, lab_id: Optional[str], status: Optional[str],
+                 ssh_port: Optional[int], vnc_port: Optional[int]):
+        self.vm_id = vm_id
+        self.lab_id = lab_id
+        self.status = status
+        self.ssh_port = ssh_port
+        self.vnc_port = vnc_port
+        self.cached_at = time.monotonic()
+
+    @classmethod
+    def from_vm(cls, vm: VM) -> "VMEndpoint":
+        return cls(
+            str(vm.id), str(vm.lab_id) if vm.lab_id else None,
+            vm.status, vm.ssh_port, vm.vnc_port
+        )
+
+
+class VMEndpointCache:
+    """
+    Cache VM -> ports/statut pour l'ouverture des WebSockets.
+    Les entrées sont mises à jour à chaque commit ORM modifiant une VM ; un défaut de cache
+    est résolu par une session courte, rendue au pool avant le relais.
+    """
+
+    def __init__(self, session_factory=SessionLocal, ttl: float = VM_CACHE_TTL):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self._entries: Dict[str, VMEndpoint] = {}
+
+    async def resolve(self, vm_id: str, refresh: bool = False) -> Optional[VMEndpoint]:
+        """Retourne les informations d'une VM, depuis le cache si elles sont fraîches."""
+        if not refresh:
+            entry = self._entries.get(vm_id)
+            if entry is not None and time.monotonic() - entry.cached_at < self.ttl:
+                return entry
+
+        entry = await asyncio.to_thread(self._load, vm_id)
+        if entry is None:
+            self._entries.pop(vm_id, None)
+        else:
+            self._entries[vm_id] = entry
+        return entry
+
+    def _load(self, vm_id: str) -> Optional[VMEndpoint]:
+        try:
+            vm_uuid = uuid.UUID(vm_id)
+        except ValueError:
+            return None
+
+        db = self.session_factory()
+        try:
+            vm = db.query(VM).filter(VM.id == vm_uuid).first()
+            return VMEndpoint.from_vm(vm) if vm else None
+        finally:
+            db.close()
+
+    def update(self, entries: Iterable[VMEndpoint]):
+        for entry in entries:
+            self._entries[entry.vm_id] = entry
+
+    def invalidate(self, vm_ids: Iterable[str]):
+        """Retire des VMs du cache (mises à jour en masse, hors du suivi de l'ORM)."""
+        for vm_id in vm_ids:
+            self._entries.pop(str(vm_id), None)
+
+    def invalidate_lab(self, lab_id: str):
+        lab_id = str(lab_id)
+        self.invalidate([vm_id for vm_id, entry in self._entries.items() if entry.lab_id == lab_id])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Instance globale du cache
+vm_cache = VMEndpointCache()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_vm_changes(session: Session, flush_context):
+    """Relève les VMs modifiées ; le cache n'est mis à jour qu'une fois la transaction validée."""
+    changes: List = session.info.setdefault("vm_cache_changes", [])
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, VM) and obj.id is not None:
+            changes.append(VMEndpoint.from_vm(obj))
+    for obj in session.deleted:
+        if isinstance(obj, VM):
+            changes.append(str(obj.id))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_vm_changes(session: Session):
+    for change in session.info.pop("vm_cache_changes", []):
+        if isinstance(change, VMEndpoint):
+            vm_cache.update([change])
+        else:
+            vm_cache.invalidate([change])
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_vm_changes(session: Session):
+    session.info.pop("vm_cache_changes", None)
@@ -1,134 +1,96 @@
 import asyncio
-import subprocess
+import os
+import logging
+from typing import List, Optional
+
 from models import VM
+from .virt_backend import VirtBackend, virt_backend, domain_name, app_status
+
+logger = logging.getLogger(__name__)
+
+# Nombre maximal d'opérations simultanées lors d'une action sur tout un lab
+LAB_POWER_CONCURRENCY = int(os.getenv("LAB_POWER_CONCURRENCY", "8"))
+
+# Action sur un lab -> (méthode du backend, statut en cas de succès)
+POWER_ACTIONS = {
+    "start": ("start", "running"),
+    "stop": ("shutdown", "stopped"),
+    "restart": ("reboot", "running"),
+    # Le démarrage d'un domaine suspendu par managed save restaure sa mémoire
+    "hibernate": ("managed_save", "hibernated"),
+    "resume": ("start", "running"),
+}
 
 
-async def start_vm(vm: VM) -> bool:
-    """Démarre une machine virtuelle en utilisant virsh."""
+async def start_vm(vm: VM, backend: Optional[VirtBackend] = None) -> bool:
+    """Démarre une machine virtuelle."""
+    vm_name = domain_name(vm)
     try:
-        vm_name = f"{vm.lab.name}_{vm.name}".replace(" ", "_").replace("-", "_")
-        
-        process = await asyncio.create_subprocess_exec(
-            "virsh", "start", vm_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode == 0:
-            return True
-        else:
-            print(f"Erreur lors du démarrage de la VM {vm_name}: {stderr.decode()}")
-            return False
-            
+        await (backend or virt_backend).start(vm_name)
+        return True
     except Exception as e:
-        print(f"Exception lors du démarrage de la VM: {str(e)}")
+        logger.error(f"Erreur lors du démarrage de la VM {vm_name}: {e}")
         return False
 
 
-async def stop_vm(vm: VM) -> bool:
-    """Arrête une machine virtuelle en utilisant virsh."""
+async def stop_vm(vm: VM, backend: Optional[VirtBackend] = None) -> bool:
+    """Arrête une machine virtuelle."""
+    vm_name = domain_name(vm)
     try:
-        vm_name = f"{vm.lab.name}_{vm.name}".replace(" ", "_").replace("-", "_")
-        
-        process = await asyncio.create_subprocess_exec(
-            "virsh", "shutdown", vm_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode == 0:
-            return True
-        else:
-            print(f"Erreur lors de l'arrêt de la VM {vm_name}: {stderr.decode()}")
-            return False
-            
+        await (backend or virt_backend).shutdown(vm_name)
+        return True
     except Exception as e:
-        print(f"Exception lors de l'arrêt de la VM: {str(e)}")
+        logger.error(f"Erreur lors de l'arrêt de la VM {vm_name}: {e}")
         return False
 
 
-async def restart_vm(vm: VM) -> bool:
-    """Redémarre une machine virtuelle en utilisant virsh."""
+async def restart_vm(vm: VM, backend: Optional[VirtBackend] = None) -> bool:
+    """Redémarre une machine virtuelle."""
+    vm_name = domain_name(vm)
     try:
-        vm_name = f"{vm.lab.name}_{vm.name}".replace(" ", "_").replace("-", "_")
-        
-        process = await asyncio.create_subprocess_exec(
-            "virsh", "reboot", vm_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode == 0:
-            return True
-        else:
-            print(f"Erreur lors du redémarrage de la VM {vm_name}: {stderr.decode()}")
-            return False
-            
+        await (backend or virt_backend).reboot(vm_name)
+        return True
     except Exception as e:
-        print(f"Exception lors du redémarrage de la VM: {str(e)}")
+        logger.error(f"Erreur lors du redémarrage de la VM {vm_name}: {e}")
         return False
 
 
-async def get_vm_status(vm: VM) -> str:
+async def get_vm_status(vm: VM, backend: Optional[VirtBackend] = None) -> str:
     """Récupère le statut d'une machine virtuelle."""
     try:
-        vm_name = f"{vm.lab.name}_{vm.name}".replace(" ", "_").replace("-", "_")
-        
-        process = await asyncio.create_subprocess_exec(
-            "virsh", "domstate", vm_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode == 0:
-            status = stdout.decode().strip()
-            # Mapper les statuts virsh aux statuts de l'application
-            if status == "running":
-                return "running"
-            elif status in ["shut off", "shutoff"]:
-                return "stopped"
-            else:
-                return "unknown"
-        else:
-            return "error"
-            
+        return app_status(await (backend or virt_backend).state(domain_name(vm)))
     except Exception as e:
-        print(f"Exception lors de la récupération du statut de la VM: {str(e)}")
+        logger.error(f"Exception lors de la récupération du statut de la VM: {e}")
         return "error"
 
 
-async def get_vm_info(vm: VM) -> dict:
+async def get_vm_info(vm: VM, backend: Optional[VirtBackend] = None) -> dict:
     """Récupère les informations détaillées d'une machine virtuelle."""
     try:
-        vm_name = f"{vm.lab.name}_{vm.name}".replace(" ", "_").replace("-", "_")
-        
-        process = await asyncio.create_subprocess_exec(
-            "virsh", "dominfo", vm_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode == 0:
-            info = {}
-            for line in stdout.decode().split('\n'):
-                if ':' in line:
-                    key, value = line.split(':', 1)
-                    info[key.strip()] = value.strip()
-            return info
-        else:
-            return {}
-            
+        return await (backend or virt_backend).info(domain_name(vm))
     except Exception as e:
-        print(f"Exception lors de la récupération des infos de la VM: {str(e)}")
+        logger.error(f"Exception lors de la récupération des infos de la VM: {e}")
         return {}
 
+
+async def power_lab_vms(vms: list, action: str, backend: Optional[VirtBackend] = None,
+                        concurrency: int = LAB_POWER_CONCURRENCY) -> List[dict]:
+    """
+    Applique une action d'alimentation à toutes les VMs d'un lab, en parallèle dans la
+    limite de `concurrency`. Retourne un résultat par VM, dans l'ordre reçu.
+    """
+    method_name, target_status = POWER_ACTIONS[action]
+    operation = getattr(backend or virt_backend, method_name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _apply(vm) -> dict:
+        result = {"vm_id": str(vm.id), "name": vm.name, "success": True, "status": target_status, "error": None}
+        async with semaphore:
+            try:
+                await operation(domain_name(vm))
+            except Exception as e:
+                logger.error(f"Échec de l'action {action} sur la VM {vm.name}: {e}")
+                result.update(success=False, status=vm.status, error=str(e))
+        return result
+
+    return await asyncio.gather(*(_apply(vm) for vm in vms))
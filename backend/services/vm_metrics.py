@@ -0,0 +1,252 @@
+import asyncio
+import bisect
+import os
+import time
+import logging
+from array import array
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from database import SessionLocal
+from models import VM
+from .virt_backend import VirtBackend, virt_backend, domain_name
+
+logger = logging.getLogger(__name__)
+
+# Intervalle d'échantillonnage en secondes (0 pour désactiver la collecte)
+VM_METRICS_INTERVAL = float(os.getenv("VM_METRICS_INTERVAL", "10"))
+# Nombre de points bruts conservés par VM (360 x 10 s = 1 h)
+VM_METRICS_RAW_POINTS = int(os.getenv("VM_METRICS_RAW_POINTS", "360"))
+# Agrégats par moyenne : (pas en secondes, nombre de points) -> 24 h à la minute, 7 j au quart d'heure
+VM_METRICS_ROLLUPS = ((60, 1440), (900, 672))
+# Rafraîchissement de la correspondance domaine -> VM/lab
+VM_METRICS_MAPPING_REFRESH = 60.0
+
+METRIC_NAMES = (
+    "cpu_percent", "memory_used_mb", "disk_read_bps", "disk_write_bps", "net_rx_bps", "net_tx_bps"
+)
+_RATE_COUNTERS = ("disk_read_bytes", "disk_write_bytes", "net_rx_bytes", "net_tx_bytes")
+
+
+class RingSeries:
+    """Série temporelle de taille fixe : un tableau par métrique, écrasé circulairement."""
+
+    __slots__ = ('step', 'capacity', 'timestamps', 'values', 'head', 'count')
+
+    def __init__(self, step: float, capacity: int):
+        self.step = step
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = [array('f', bytes(4 * capacity)) for _ in METRIC_NAMES]
+        self.head = 0
+        self.count = 0
+
+    @property
+    def span(self) -> float:
+        return self.step * self.capacity
+
+    def append(self, timestamp: float, sample: Sequence[float]):
+        i = self.head
+        self.timestamps[i] = timestamp
+        for values, value in zip(self.values, sample):
+            values[i] = value
+        self.head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _ordered(self, data: array) -> array:
+        first = (self.head - self.count) % self.capacity
+        if first + self.count <= self.capacity:
+            return data[first:first + self.count]
+        return data[first:] + data[:self.head]
+
+    def since(self, start: float) -> Tuple[List[float], List[List[float]]]:
+        """Points postérieurs à `start`, dans l'ordre chronologique."""
+        timestamps = self._ordered(self.timestamps)
+        offset = bisect.bisect_left(timestamps, start)
+        return (
+            timestamps[offset:].tolist(),
+            [[round(v, 3) for v in self._ordered(values)[offset:]] for values in self.values]
+        )
+
+
+class Rollup:
+    """Agrégation par moyenne des échantillons bruts dans des intervalles de `step` secondes."""
+
+    __slots__ = ('series', 'bucket', 'sums', 'samples')
+
+    def __init__(self, step: float, capacity: int):
+        self.series = RingSeries(step, capacity)
+        self.bucket: Optional[float] = None
+        self.sums = [0.0] * len(METRIC_NAMES)
+        self.samples = 0
+
+    def add(self, timestamp: float, sample: Sequence[float]):
+        bucket = timestamp - timestamp % self.series.step
+        if self.bucket is not None and bucket != self.bucket:
+            self.series.append(self.bucket, [total / self.samples for total in self.sums])
+            self.sums = [0.0] * len(METRIC_NAMES)
+            self.samples = 0
+        self.bucket = bucket
+        for i, value in enumerate(sample):
+            self.sums[i] += value
+        self.samples += 1
+
+
+class VMMetrics:
+    """Métriques d'une VM : série brute et agrégats, calculés à partir des compteurs cumulés."""
+
+    __slots__ = ('vm_id', 'lab_id', 'raw', 'rollups', '_previous')
+
+    def __init__(self, vm_id: str, lab_id: Optional[str], interval: float):
+        self.vm_id = vm_id
+        self.lab_id = lab_id
+        self.raw = RingSeries(interval, VM_METRICS_RAW_POINTS)
+        self.rollups = [Rollup(step, capacity) for step, capacity in VM_METRICS_ROLLUPS]
+        self._previous: Optional[Tuple[float, dict]] = None
+
+    def add_counters(self, timestamp: float, counters: dict):
+        """Ajoute un échantillon ; les débits sont calculés par rapport au précédent."""
+        if counters.get('state') != "running":
+            self._previous = None
+            return
+
+        previous, self._previous = self._previous, (timestamp, counters)
+        if previous is None:
+            return
+        elapsed = timestamp - previous[0]
+        before = previous[1]
+        # Compteurs remis à zéro (redémarrage du domaine) : on repart de cet échantillon
+        if elapsed <= 0 or counters['cpu_time_ns'] < before['cpu_time_ns']:
+            return
+
+        cpu_percent = (counters['cpu_time_ns'] - before['cpu_time_ns']) / (elapsed * 1e9 * counters['vcpus']) * 100
+        sample = [min(cpu_percent, 100.0), counters['memory_used_kb'] / 1024]
+        for name in _RATE_COUNTERS:
+            sample.append(max(counters[name] - before[name], 0) / elapsed)
+
+        self.raw.append(timestamp, sample)
+        for rollup in self.rollups:
+            rollup.add(timestamp, sample)
+
+    def series_for(self, window: float) -> RingSeries:
+        """Série la plus fine couvrant la fenêtre demandée."""
+        for series in [self.raw] + [rollup.series for rollup in self.rollups]:
+            if series.span >= window:
+                return series
+        return self.rollups[-1].series
+
+
+class VMMetricsCollector:
+    """
+    Collecte périodique des métriques de toutes les VMs via les statistiques groupées
+    de l'hyperviseur. Les séries restent en mémoire : leur lecture ne touche pas la base.
+    """
+
+    def __init__(self, backend: Optional[VirtBackend] = None, session_factory=SessionLocal,
+                 interval: float = VM_METRICS_INTERVAL):
+        self.backend = backend
+        self.session_factory = session_factory
+        self.interval = interval
+        self._metrics: Dict[str, VMMetrics] = {}
+        self._by_lab: Dict[str, Set[str]] = {}
+        self._domains: Dict[str, Tuple[str, str]] = {}
+        self._mapping_loaded_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.collect_once()
+            except Exception as e:
+                logger.error(f"Erreur de collecte des métriques des VMs: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def collect_once(self):
+        if time.monotonic() - self._mapping_loaded_at >= VM_METRICS_MAPPING_REFRESH:
+            self.set_mapping(await asyncio.to_thread(self._load_mapping))
+
+        stats = await (self.backend or virt_backend).bulk_stats()
+        timestamp = time.time()
+        for name, counters in stats.items():
+            target = self._domains.get(name)
+            if target is None:
+                continue
+            vm_id, lab_id = target
+            metrics = self._metrics.get(vm_id)
+            if metrics is None:
+                metrics = self._metrics[vm_id] = VMMetrics(vm_id, lab_id, self.interval)
+                self._by_lab.setdefault(lab_id, set()).add(vm_id)
+            metrics.add_counters(timestamp, counters)
+
+    def _load_mapping(self) -> Dict[str, Tuple[str, str]]:
+        db = self.session_factory()
+        try:
+            rows = db.query(VM.id, VM.lab_id, VM.domain_name, VM.name).all()
+            return {domain_name(row): (str(row.id), str(row.lab_id)) for row in rows}
+        finally:
+            db.close()
+
+    def set_mapping(self, domains: Dict[str, Tuple[str, str]]):
+        """Remplace la correspondance domaine -> (VM, lab) et oublie les VMs supprimées."""
+        self._domains = domains
+        self._mapping_loaded_at = time.monotonic()
+        known = {vm_id for vm_id, _ in domains.values()}
+        for vm_id in [vm_id for vm_id in self._metrics if vm_id not in known]:
+            metrics = self._metrics.pop(vm_id)
+            bucket = self._by_lab.get(metrics.lab_id)
+            if bucket is not None:
+                bucket.discard(vm_id)
+                if not bucket:
+                    del self._by_lab[metrics.lab_id]
+
+    def _series(self, metrics: Optional[VMMetrics], window: float) -> dict:
+        if metrics is None:
+            return {'resolution_seconds': self.interval, 'timestamps': [],
+                    'series': {name: [] for name in METRIC_NAMES}}
+        ring = metrics.series_for(window)
+        timestamps, values = ring.since(time.time() - window)
+        return {
+            'resolution_seconds': ring.step,
+            'timestamps': timestamps,
+            'series': dict(zip(METRIC_NAMES, values))
+        }
+
+    def vm_series(self, vm_id: str, window: float = 3600) -> dict:
+        """Séries d'une VM sur la fenêtre demandée (vides si aucune mesure)."""
+        return dict(self._series(self._metrics.get(vm_id), window), vm_id=vm_id, window_seconds=window)
+
+    def lab_cpu_peak(self, lab_id: str, window: float) -> Optional[float]:
+        """CPU le plus élevé parmi les VMs d'un lab sur la fenêtre, None sans mesure."""
+        start = time.time() - window
+        peaks = []
+        for vm_id in self._by_lab.get(lab_id, ()):
+            _, values = self._metrics[vm_id].series_for(window).since(start)
+            peaks.extend(values[0])
+        return max(peaks) if peaks else None
+
+    def lab_series(self, lab_id: str, window: float = 3600) -> dict:
+        """Séries de toutes les VMs d'un lab."""
+        return {
+            'lab_id': lab_id,
+            'window_seconds': window,
+            'vms': {
+                vm_id: self._series(self._metrics[vm_id], window)
+                for vm_id in sorted(self._by_lab.get(lab_id, ()))
+            }
+        }
+
+
+# Instance globale du collecteur
+vm_metrics_collector = VMMetricsCollector()
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam
+
+from database import SessionLocal
+from models import VM
+from .virt_backend import VirtBackend, virt_backend, domain_name, app_status
+from .vm_cache import vm_cache
+
+logger = logging.getLogger(__name__)
+
+# Intervalle de réconciliation en secondes (0 pour désactiver)
+VM_RECONCILE_INTERVAL = float(os.getenv("VM_RECONCILE_INTERVAL", "30"))
+
+# Statuts suivis : les VMs en cours de déploiement ou supprimées ne sont pas touchées
+RECONCILED_STATUSES = ("running", "stopped", "error", "unknown", "hibernated")
+
+# Mise à jour conditionnelle : ignorée si le statut a changé depuis la lecture
+_UPDATE_STATUS = VM.__table__.update().where(
+    VM.__table__.c.id == bindparam("vm_id"),
+    VM.__table__.c.status == bindparam("old_status")
+).values(status=bindparam("new_status"))
+
+# Identité du domaine libvirt (nom et UUID) d'une VM, corrigée d'après l'hyperviseur
+_UPDATE_DOMAIN = VM.__table__.update().where(
+    VM.__table__.c.id == bindparam("vm_id")
+).values(domain_name=bindparam("new_domain_name"), domain_uuid=bindparam("new_domain_uuid"))
+
+
+def resolve_domains(rows: List[Tuple], domains: Dict[str, Tuple[str, Optional[str]]]) -> Tuple[List[Tuple], List[dict]]:
+    """
+    Rapproche les VMs (id, nom de domaine, UUID, statut) des domaines (nom -> (état, UUID)).
+    L'UUID fait foi : un domaine renommé est retrouvé par son UUID, un domaine recréé sous
+    le même nom est reconnu à son nouvel UUID. Retourne les VMs (id, nom de domaine, statut)
+    à comparer aux états et les corrections d'identité à écrire.
+    """
+    names_by_uuid = {domain_uuid: name for name, (_, domain_uuid) in domains.items() if domain_uuid}
+    resolved = []
+    updates = []
+    for vm_id, name, domain_uuid, status in rows:
+        current_name = names_by_uuid.get(domain_uuid) if domain_uuid else None
+        if current_name is not None and current_name != name:
+            logger.warning(f"Domaine {name} renommé en {current_name} (UUID {domain_uuid})")
+            name = current_name
+        elif current_name is None and name in domains:
+            found_uuid = domains[name][1]
+            if found_uuid and found_uuid != domain_uuid:
+                if domain_uuid:
+                    logger.warning(f"Domaine {name} recréé : UUID {domain_uuid} remplacé par {found_uuid}")
+                domain_uuid = found_uuid
+            else:
+                resolved.append((vm_id, name, status))
+                continue
+        else:
+            resolved.append((vm_id, name, status))
+            continue
+        updates.append({"vm_id": vm_id, "new_domain_name": name, "new_domain_uuid": domain_uuid})
+        resolved.append((vm_id, name, status))
+    return resolved, updates
+
+
+def diff_states(rows: List[Tuple], states: Dict[str, str]) -> List[dict]:
+    """
+    Compare les VMs (id, nom de domaine, statut) aux états des domaines.
+    Les domaines absents et les états transitoires ne produisent pas de changement.
+    """
+    changes = []
+    for vm_id, domain, status in rows:
+        state = states.get(domain)
+        if state is None:
+            continue
+        new_status = app_status(state)
+        # Un domaine hiberné apparaît arrêté : seul son redémarrage hors de l'application est repris
+        if status == "hibernated" and new_status != "running":
+            continue
+        if new_status != "unknown" and new_status != status:
+            changes.append({"vm_id": vm_id, "old_status": status, "new_status": new_status})
+    return changes
+
+
+class VMReconciler:
+    """
+    Boucle de réconciliation du statut des VMs avec l'état réel des domaines.
+    Un cycle : un appel groupé par hyperviseur, une lecture des VMs suivies, et une
+    seule écriture groupée des statuts qui ont changé. Les domaines sont rapprochés des
+    VMs par leur UUID quand le backend le relève.
+    """
+
+    def __init__(self, backend: Optional[VirtBackend] = None, session_factory=SessionLocal,
+                 interval: float = VM_RECONCILE_INTERVAL):
+        self.backend = backend
+        self.session_factory = session_factory
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.updated = 0
+        self.last_run_at: Optional[float] = None
+        self.last_duration: Optional[float] = None
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile_once()
+            except Exception as e:
+                logger.error(f"Erreur de réconciliation des VMs: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def reconcile_once(self) -> List[dict]:
+        """Exécute un cycle et retourne les changements appliqués."""
+        started = time.monotonic()
+        domains = await (self.backend or virt_backend).list_domains()
+        changes, updates = await asyncio.to_thread(self._apply, domains)
+
+        if updates:
+            vm_cache.invalidate(str(update["vm_id"]) for update in updates)
+        if changes:
+            vm_cache.invalidate(str(change["vm_id"]) for change in changes)
+            logger.info(f"Réconciliation : {len(changes)} VM(s) mises à jour")
+
+        self.runs += 1
+        self.updated += len(changes)
+        self.last_run_at = time.time()
+        self.last_duration = time.monotonic() - started
+        return changes
+
+    def _apply(self, domains: Dict[str, Tuple[str, Optional[str]]]) -> Tuple[List[dict], List[dict]]:
+        db = self.session_factory()
+        try:
+            rows = db.query(VM.id, VM.status, VM.domain_name, VM.domain_uuid, VM.lab_id, VM.name).filter(
+                VM.status.in_(RECONCILED_STATUSES)
+            ).all()
+            resolved, updates = resolve_domains(
+                [(row.id, domain_name(row), row.domain_uuid, row.status) for row in rows], domains
+            )
+            states = {name: state for name, (state, _) in domains.items()}
+            changes = diff_states(resolved, states)
+            if updates:
+                db.connection().execute(_UPDATE_DOMAIN, updates)
+            if changes:
+                db.connection().execute(_UPDATE_STATUS, changes)
+            if updates or changes:
+                db.commit()
+            return changes, updates
+        finally:
+            db.close()
+
+    def get_stats(self) -> dict:
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'updated': self.updated,
+            'last_run_at': self.last_run_at,
+            'last_duration_ms': round(self.last_duration * 1000, 3) if self.last_duration is not None else None
+        }
+
+
+# Instance globale du réconciliateur
+vm_reconciler = VMReconciler()
@@ -1,39 +1,89 @@
 import asyncio
+import codecs
+import heapq
 import websockets
 import socket
 import threading
-from typing import Dict, Optional
+import time
+from typing import Dict, Optional, Tuple
 import uuid
 import logging
 
+from .connection_registry import ConnectionRecord, ConnectionRegistry
+from .registry_backend import create_registry_backend
+from .session_recorder import SessionRecorder
+from .compression import AdaptiveDeflate
+from .ssh_pool import ssh_transport_pool, SSH_PROXY_MODE
+
 logger = logging.getLogger(__name__)
 
+# Tailles de lecture adaptatives pour le relais SSH
+SSH_READ_MIN = 64 * 1024
+SSH_READ_MAX = 1024 * 1024
+
+# Relais VNC : regroupement des lectures en trames et files bornées (contre-pression)
+VNC_READ_SIZE = 64 * 1024
+VNC_FRAME_MAX = 256 * 1024
+VNC_COALESCE_DELAY = 0.005
+VNC_QUEUE_SIZE = 32
+
 
 class WebSocketProxyService:
     def __init__(self):
-        self.active_connections: Dict[str, Dict] = {}
+        self.registry = ConnectionRegistry()
+        # Partage des connexions entre workers (en mémoire par défaut)
+        self.backend = create_registry_backend()
+        # Dernière activité des connexions fermées depuis le dernier relevé, par lab
+        self._closed_lab_activity: Dict[str, float] = {}
+        # Octets relayés par les connexions fermées, par (type, sens) : les boucles de
+        # relais ne tiennent que les compteurs de leur connexion
+        self._closed_bytes: Dict[Tuple[str, str], int] = {}
     
-    async def handle_ssh_connection(self, websocket, vm_id: str, ssh_host: str, ssh_port: int):
-        """Gère une connexion SSH via WebSocket."""
+    async def start(self):
+        """Démarre la synchronisation du registre avec les autres workers."""
+        await self.backend.start(self.registry, self._close_local_connections_for_vm)
+    
+    async def stop(self):
+        """Arrête la synchronisation et retire les connexions publiées par ce worker."""
+        await self.backend.stop()
+    
+    async def handle_ssh_connection(self, websocket, vm_id: str, ssh_host: str, ssh_port: int,
+                                    text_mode: bool = False, lab_id: Optional[str] = None,
+                                    recorder: Optional[SessionRecorder] = None, compress: bool = False,
+                                    native: bool = False, cols: int = 80, rows: int = 24):
+        """
+        Gère une connexion SSH via WebSocket.
+        Le flux est relayé en binaire, sauf si le client demande du texte (text_mode).
+        Si un recorder est fourni, la sortie du terminal est enregistrée.
+        Avec compress, chaque message binaire est préfixé d'un octet indiquant s'il est compressé.
+        En mode native, le SSH est terminé par le backend : la session est un canal
+        ouvert sur le transport partagé du pool.
+        """
         connection_id = str(uuid.uuid4())
         
         try:
-            # Établir la connexion SSH
-            ssh_reader, ssh_writer = await asyncio.open_connection(ssh_host, ssh_port)
+            if native:
+                # Ouvrir un shell sur le transport SSH mutualisé de la VM
+                process = await ssh_transport_pool.open_shell(ssh_host, ssh_port, cols, rows)
+                ssh_reader, ssh_writer = process.stdout, process.stdin
+            else:
+                # Établir la connexion SSH (tampon assez grand pour les lectures adaptatives)
+                ssh_reader, ssh_writer = await asyncio.open_connection(
+                    ssh_host, ssh_port, limit=SSH_READ_MAX
+                )
             
             # Stocker la connexion
-            self.active_connections[connection_id] = {
-                'type': 'ssh',
-                'vm_id': vm_id,
-                'websocket': websocket,
-                'ssh_reader': ssh_reader,
-                'ssh_writer': ssh_writer
-            }
+            record = ConnectionRecord(
+                connection_id, 'ssh', vm_id, lab_id, websocket, ssh_reader, ssh_writer
+            )
+            if compress and not text_mode:
+                record.compressor = AdaptiveDeflate()
+            self.registry.add(record)
             
             # Créer les tâches pour transférer les données
             tasks = [
-                asyncio.create_task(self._websocket_to_ssh(websocket, ssh_writer, connection_id)),
-                asyncio.create_task(self._ssh_to_websocket(ssh_reader, websocket, connection_id))
+                asyncio.create_task(self._websocket_to_ssh(websocket, ssh_writer, record)),
+                asyncio.create_task(self._ssh_to_websocket(ssh_reader, websocket, record, text_mode, recorder))
             ]
             
             # Attendre qu'une des tâches se termine
@@ -45,132 +95,313 @@ class WebSocketProxyService:
             
         except Exception as e:
             logger.error(f"Erreur dans la connexion SSH {connection_id}: {e}")
-            await websocket.send(f"Erreur de connexion SSH: {str(e)}")
+            await websocket.send_text(f"Erreur de connexion SSH: {str(e)}")
         
         finally:
+            if recorder:
+                recorder.close()
             # Nettoyer la connexion
             await self._cleanup_connection(connection_id)
     
-    async def handle_vnc_connection(self, websocket, vm_id: str, vnc_host: str, vnc_port: int):
-        """Gère une connexion VNC via WebSocket."""
+    async def handle_vnc_connection(self, websocket, vm_id: str, vnc_host: str, vnc_port: int,
+                                    lab_id: Optional[str] = None, compress: bool = False):
+        """
+        Gère une connexion VNC via WebSocket.
+        Chaque sens passe par une file bornée : quand elle est pleine, la lecture en amont
+        est suspendue et la contre-pression TCP remonte jusqu'à l'émetteur.
+        """
         connection_id = str(uuid.uuid4())
         
         try:
             # Établir la connexion VNC
-            vnc_reader, vnc_writer = await asyncio.open_connection(vnc_host, vnc_port)
+            vnc_reader, vnc_writer = await asyncio.open_connection(
+                vnc_host, vnc_port, limit=VNC_FRAME_MAX
+            )
+            
+            to_client = asyncio.Queue(maxsize=VNC_QUEUE_SIZE)
+            to_vm = asyncio.Queue(maxsize=VNC_QUEUE_SIZE)
             
             # Stocker la connexion
-            self.active_connections[connection_id] = {
-                'type': 'vnc',
-                'vm_id': vm_id,
-                'websocket': websocket,
-                'vnc_reader': vnc_reader,
-                'vnc_writer': vnc_writer
-            }
+            record = ConnectionRecord(
+                connection_id, 'vnc', vm_id, lab_id, websocket, vnc_reader, vnc_writer
+            )
+            record.to_client_queue = to_client
+            record.to_vm_queue = to_vm
+            if compress:
+                record.compressor = AdaptiveDeflate()
+            self.registry.add(record)
             
-            # Créer les tâches pour transférer les données
-            tasks = [
-                asyncio.create_task(self._websocket_to_vnc(websocket, vnc_writer, connection_id)),
-                asyncio.create_task(self._vnc_to_websocket(vnc_reader, websocket, connection_id))
+            # Les lecteurs remplissent les files, les écrivains les vident
+            readers = [
+                asyncio.create_task(self._websocket_to_queue(websocket, to_vm, record)),
+                asyncio.create_task(self._vnc_to_queue(vnc_reader, to_client, record))
+            ]
+            writers = [
+                asyncio.create_task(self._queue_to_vnc(to_vm, vnc_writer, record)),
+                asyncio.create_task(self._queue_to_websocket(to_client, websocket, record))
             ]
             
-            # Attendre qu'une des tâches se termine
-            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            # Un écrivain se termine quand son sens est fermé (après avoir vidé sa file)
+            done, pending = await asyncio.wait(writers, return_when=asyncio.FIRST_COMPLETED)
             
             # Annuler les tâches restantes
-            for task in pending:
+            for task in readers + list(pending):
                 task.cancel()
         
         except Exception as e:
             logger.error(f"Erreur dans la connexion VNC {connection_id}: {e}")
-            await websocket.send(f"Erreur de connexion VNC: {str(e)}")
+            await websocket.send_text(f"Erreur de connexion VNC: {str(e)}")
         
         finally:
             # Nettoyer la connexion
             await self._cleanup_connection(connection_id)
     
-    async def _websocket_to_ssh(self, websocket, ssh_writer, connection_id: str):
+    async def _websocket_to_ssh(self, websocket, ssh_writer, record: ConnectionRecord):
         """Transfère les données du WebSocket vers SSH."""
         try:
-            async for message in websocket:
-                if isinstance(message, str):
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                
+                data = message.get("bytes")
+                if data is None:
                     # Commande ou données texte
-                    ssh_writer.write(message.encode('utf-8'))
-                else:
-                    # Données binaires
-                    ssh_writer.write(message)
+                    data = (message.get("text") or "").encode('utf-8')
+                
+                ssh_writer.write(data)
+                record.bytes_in += len(data)
+                record.last_activity = time.time()
                 await ssh_writer.drain()
         except Exception as e:
-            logger.error(f"Erreur WebSocket->SSH {connection_id}: {e}")
+            logger.error(f"Erreur WebSocket->SSH {record.connection_id}: {e}")
     
-    async def _ssh_to_websocket(self, ssh_reader, websocket, connection_id: str):
-        """Transfère les données de SSH vers le WebSocket."""
+    async def _ssh_to_websocket(self, ssh_reader, websocket, record: ConnectionRecord, text_mode: bool = False,
+                                recorder: Optional[SessionRecorder] = None):
+        """
+        Transfère les données de SSH vers le WebSocket.
+        La taille de lecture double tant que les lectures remplissent le tampon et
+        diminue quand le flux redevient interactif.
+        """
+        read_size = SSH_READ_MIN
+        # Décodeur incrémental : un caractère multi-octets peut être coupé entre deux lectures
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace') if text_mode else None
+        
         try:
             while True:
-                data = await ssh_reader.read(1024)
+                data = await ssh_reader.read(read_size)
                 if not data:
+                    if decoder:
+                        tail = decoder.decode(b'', final=True)
+                        if tail:
+                            await websocket.send_text(tail)
                     break
-                await websocket.send(data.decode('utf-8', errors='ignore'))
+                
+                if recorder:
+                    recorder.record_output(data)
+                
+                if decoder:
+                    text = decoder.decode(data)
+                    if text:
+                        await websocket.send_text(text)
+                elif record.compressor:
+                    await websocket.send_bytes(record.compressor.encode_prefixed(data))
+                else:
+                    await websocket.send_bytes(data)
+                record.bytes_out += len(data)
+                record.frames_out += 1
+                record.last_activity = time.time()
+                
+                if len(data) == read_size and read_size < SSH_READ_MAX:
+                    read_size *= 2
+                elif len(data) < read_size // 4 and read_size > SSH_READ_MIN:
+                    read_size //= 2
         except Exception as e:
-            logger.error(f"Erreur SSH->WebSocket {connection_id}: {e}")
+            logger.error(f"Erreur SSH->WebSocket {record.connection_id}: {e}")
     
-    async def _websocket_to_vnc(self, websocket, vnc_writer, connection_id: str):
-        """Transfère les données du WebSocket vers VNC."""
+    async def _websocket_to_queue(self, websocket, queue: asyncio.Queue, record: ConnectionRecord):
+        """Place les messages du WebSocket dans la file vers VNC."""
         try:
-            async for message in websocket:
-                if isinstance(message, bytes):
-                    vnc_writer.write(message)
-                else:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                
+                data = message.get("bytes")
+                if data is None:
                     # Convertir les messages texte en bytes pour VNC
-                    vnc_writer.write(message.encode('utf-8'))
+                    data = (message.get("text") or "").encode('utf-8')
+                
+                # Bloque si VNC n'absorbe pas assez vite : on cesse alors de lire le WebSocket
+                await queue.put(data)
+        except Exception as e:
+            logger.error(f"Erreur WebSocket->VNC {record.connection_id}: {e}")
+        
+        await queue.put(None)
+    
+    async def _queue_to_vnc(self, queue: asyncio.Queue, vnc_writer, record: ConnectionRecord):
+        """Transfère les données de la file vers VNC."""
+        try:
+            while True:
+                data = await queue.get()
+                if data is None:
+                    break
+                vnc_writer.write(data)
+                record.bytes_in += len(data)
+                record.last_activity = time.time()
                 await vnc_writer.drain()
         except Exception as e:
-            logger.error(f"Erreur WebSocket->VNC {connection_id}: {e}")
+            logger.error(f"Erreur WebSocket->VNC {record.connection_id}: {e}")
     
-    async def _vnc_to_websocket(self, vnc_reader, websocket, connection_id: str):
-        """Transfère les données de VNC vers le WebSocket."""
+    async def _vnc_to_queue(self, vnc_reader, queue: asyncio.Queue, record: ConnectionRecord):
+        """Place les données lues depuis VNC dans la file vers le WebSocket."""
         try:
             while True:
-                data = await vnc_reader.read(1024)
+                data = await vnc_reader.read(VNC_READ_SIZE)
                 if not data:
                     break
-                await websocket.send(data)
+                # Bloque si le navigateur est lent : on cesse alors de lire la socket VNC
+                await queue.put(data)
         except Exception as e:
-            logger.error(f"Erreur VNC->WebSocket {connection_id}: {e}")
+            logger.error(f"Erreur VNC->WebSocket {record.connection_id}: {e}")
+        
+        await queue.put(None)
+    
+    async def _queue_to_websocket(self, queue: asyncio.Queue, websocket, record: ConnectionRecord):
+        """
+        Transfère les données de la file vers le WebSocket.
+        Les lectures qui arrivent dans le délai VNC_COALESCE_DELAY sont regroupées
+        en une seule trame, jusqu'à atteindre VNC_FRAME_MAX octets.
+        """
+        loop = asyncio.get_running_loop()
+        
+        try:
+            closed = False
+            while not closed:
+                data = await queue.get()
+                if data is None:
+                    break
+                
+                chunks = [data]
+                size = len(data)
+                deadline = loop.time() + VNC_COALESCE_DELAY
+                
+                while size < VNC_FRAME_MAX:
+                    if queue.empty():
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            data = await asyncio.wait_for(queue.get(), remaining)
+                        except asyncio.TimeoutError:
+                            break
+                    else:
+                        data = queue.get_nowait()
+                    
+                    if data is None:
+                        closed = True
+                        break
+                    chunks.append(data)
+                    size += len(data)
+                
+                frame = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+                if record.compressor:
+                    frame = record.compressor.encode_prefixed(frame)
+                await websocket.send_bytes(frame)
+                record.bytes_out += size
+                record.frames_out += 1
+                record.last_activity = time.time()
+        except Exception as e:
+            logger.error(f"Erreur VNC->WebSocket {record.connection_id}: {e}")
     
     async def _cleanup_connection(self, connection_id: str):
         """Nettoie une connexion."""
-        if connection_id in self.active_connections:
-            conn = self.active_connections[connection_id]
-            
-            # Fermer les connexions SSH/VNC
-            if 'ssh_writer' in conn:
-                conn['ssh_writer'].close()
-                await conn['ssh_writer'].wait_closed()
-            
-            if 'vnc_writer' in conn:
-                conn['vnc_writer'].close()
-                await conn['vnc_writer'].wait_closed()
-            
-            # Supprimer de la liste des connexions actives
-            del self.active_connections[connection_id]
+        record = self.registry.remove(connection_id)
+        if record is not None:
+            if record.lab_id:
+                self._closed_lab_activity[record.lab_id] = max(
+                    record.last_activity, self._closed_lab_activity.get(record.lab_id, 0.0)
+                )
+            for direction, count in (("in", record.bytes_in), ("out", record.bytes_out)):
+                key = (record.type, direction)
+                self._closed_bytes[key] = self._closed_bytes.get(key, 0) + count
+            # Fermer la connexion SSH/VNC
+            record.writer.close()
+            await record.writer.wait_closed()
     
     def get_active_connections_for_vm(self, vm_id: str) -> list:
-        """Retourne les connexions actives pour une VM."""
-        return [
-            conn for conn in self.active_connections.values()
-            if conn.get('vm_id') == vm_id
-        ]
+        """Retourne les connexions actives de ce worker pour une VM."""
+        return self.registry.for_vm(vm_id)
+    
+    def get_active_connections_for_lab(self, lab_id: str) -> list:
+        """Retourne les connexions actives de ce worker pour un lab."""
+        return self.registry.for_lab(lab_id)
+    
+    def collect_lab_activity(self) -> Dict[str, float]:
+        """
+        Dernière activité par lab depuis le relevé précédent. Un lab ayant une connexion
+        ouverte, sur ce worker ou un autre, est considéré actif à l'instant présent.
+        """
+        now = time.time()
+        activity, self._closed_lab_activity = self._closed_lab_activity, {}
+        for record in self.registry.all():
+            if record.lab_id:
+                activity[record.lab_id] = now
+        for connection in self.backend.remote_all():
+            if connection['lab_id']:
+                activity[connection['lab_id']] = now
+        return activity
+    
+    def relayed_bytes(self) -> Dict[Tuple[str, str], int]:
+        """Octets relayés par ce worker depuis son démarrage, par (type, sens)."""
+        totals = dict(self._closed_bytes)
+        for record in self.registry.all():
+            for direction, count in (("in", record.bytes_in), ("out", record.bytes_out)):
+                key = (record.type, direction)
+                totals[key] = totals.get(key, 0) + count
+        return totals
+    
+    def _describe(self, record: ConnectionRecord, now: float) -> dict:
+        info = record.to_dict(now)
+        info['worker_id'] = self.backend.worker_id
+        return info
+    
+    def describe_connections_for_vm(self, vm_id: str) -> list:
+        """Connexions d'une VM sur l'ensemble des workers (instantané pour les autres workers)."""
+        now = time.time()
+        return [self._describe(record, now) for record in self.registry.for_vm(vm_id)] + \
+            self.backend.remote_for_vm(vm_id)
+    
+    def describe_connections_for_lab(self, lab_id: str) -> list:
+        """Connexions d'un lab sur l'ensemble des workers."""
+        now = time.time()
+        return [self._describe(record, now) for record in self.registry.for_lab(lab_id)] + \
+            self.backend.remote_for_lab(lab_id)
+    
+    def get_connections_overview(self, limit: int = 10) -> dict:
+        """Retourne les connexions les plus actives et les plus inactives du proxy."""
+        now = time.time()
+        local = [self._describe(record, now) for record in self.registry.busiest(limit)]
+        local_idle = [self._describe(record, now) for record in self.registry.idle(limit)]
+        remote = self.backend.remote_all()
+        workers = {self.backend.worker_id: len(self.registry)}
+        for connection in remote:
+            workers[connection['worker_id']] = workers.get(connection['worker_id'], 0) + 1
+        return {
+            'active_connections': len(self.registry) + len(remote),
+            'workers': workers,
+            'busiest': heapq.nlargest(limit, local + remote, key=lambda c: c['bytes_in'] + c['bytes_out']),
+            'idle': heapq.nlargest(limit, local_idle + remote, key=lambda c: c['idle_seconds'])
+        }
+    
+    async def _close_local_connections_for_vm(self, vm_id: str):
+        for record in self.registry.for_vm(vm_id):
+            await self._cleanup_connection(record.connection_id)
     
     async def close_all_connections_for_vm(self, vm_id: str):
-        """Ferme toutes les connexions pour une VM."""
-        connections_to_close = [
-            conn_id for conn_id, conn in self.active_connections.items()
-            if conn.get('vm_id') == vm_id
-        ]
-        
-        for conn_id in connections_to_close:
-            await self._cleanup_connection(conn_id)
+        """Ferme toutes les connexions pour une VM, y compris celles des autres workers."""
+        await self._close_local_connections_for_vm(vm_id)
+        self.backend.request_close_vm(vm_id)
 
 
 # Instance globale du service
@@ -1,17 +1,55 @@
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import sys
+import time
+import asyncssh
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import uuid
 
+# Budget de requêtes SQL vérifié en test : un N+1 fait échouer la requête
+os.environ.setdefault("QUERY_BUDGET_MODE", "raise")
+
 from main import app
-from database import get_db, Base
-from models import Lab, VM
+import database
+from database import get_db, Base, instrument_queries, track_queries, QueryBudgetExceeded
+from models import Lab, VM, DeploymentLog
+from services.connection_registry import ConnectionRecord, ConnectionRegistry
+from services.registry_backend import DatabaseRegistryBackend
+from services.vm_cache import vm_cache
+from services.hibernation import HibernationManager
+from services.compression import AdaptiveDeflate
+from services.ansible_farm import AnsibleFarm, ForkBudget
+from services.session_recorder import RecordingWriter, RecordingReader, list_recordings
+from services.multiplexer import MuxSession, decode_frame, encode_frame, FRAME_OPEN, FRAME_OPENED, FRAME_DATA, FRAME_RESIZE, FRAME_ERROR
+from services.websocket_service import WebSocketProxyService
+from services.ssh_pool import SSHTransportPool, SSHAuthenticationError
+from services.virt_backend import VirtBackend, FakeBackend, format_domain_name
+from services.vm_management import start_vm, stop_vm, get_vm_status, power_lab_vms
+from services.vm_reconciler import diff_states, VMReconciler
+from services.vm_metrics import RingSeries, VMMetrics, METRIC_NAMES
+from services.teardown import OrphanCollector, destroy_lab_resources
+from services.deployment import deploy_lab
+from services.capacity import CapacityLedger, CapacityError, capacity_ledger, host_limits
+from services.executors import CommandExecutor, FakeExecutor, SubprocessExecutor, CommandResult
+from services.ansible_service import AnsibleService
+from services.terraform_service import TerraformService
+from services.telemetry import MetricsRegistry
+from services.tracing import begin_trace, end_trace, span, record_span
+from services.profiler import SamplingProfiler, SlowRequestLog
+from models import HostCapacity, CapacityReservation, ProxyConnection, ProxyCloseCommand
+from benchmarks.common import percentile, summarize
 
 # Base de données de test en mémoire
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+instrument_queries(engine)
 
 # Override de la dépendance de base de données
 def override_get_db():
@@ -43,6 +81,14 @@ class TestAPI:
         response = client.get("/health")
         assert response.status_code == 200
         assert response.json() == {"status": "healthy"}
+    
+    def test_metrics_endpoint(self):
+        """Test de l'export des métriques au format Prometheus."""
+        client.get("/health")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        assert 'vlm_http_request_duration_seconds_count{method="GET",route="/health",status="200"}' in response.text
 
 
 class TestLabsAPI:
@@ -143,6 +189,20 @@ class TestLabsAPI:
         # Vérifier qu'il n'existe plus
         get_response = client.get(f"/api/v1/labs/{lab_id}")
         assert get_response.status_code == 404
+    
+    def test_retry_interrupted_deletion(self):
+        """Test de la reprise de la suppression d'un lab resté en état deleting."""
+        create_response = client.post("/api/v1/labs/", json={"name": "Test Lab", "vms": []})
+        lab_id = create_response.json()["id"]
+        db = TestingSessionLocal()
+        db.query(Lab).filter(Lab.id == uuid.UUID(lab_id)).update({"status": "deleting"})
+        db.commit()
+        db.close()
+        
+        response = client.delete(f"/api/v1/labs/{lab_id}")
+        assert response.status_code == 200
+        assert response.json()["message"] == "Suppression du lab relancée"
+        assert client.get(f"/api/v1/labs/{lab_id}").status_code == 404
 
 
 class TestVMsAPI:
@@ -245,6 +305,1220 @@ class TestValidation:
         assert response.status_code == 422
 
 
+class TestConnectionRegistry:
+    """Tests du registre des connexions du proxy WebSocket."""
+    
+    def _record(self, connection_id, vm_id, lab_id="lab-1"):
+        return ConnectionRecord(connection_id, "ssh", vm_id, lab_id, None, None, None)
+    
+    def test_indexes_by_vm_and_lab(self):
+        """Test des index par VM et par lab."""
+        registry = ConnectionRegistry()
+        registry.add(self._record("c1", "vm-1"))
+        registry.add(self._record("c2", "vm-1"))
+        registry.add(self._record("c3", "vm-2", lab_id="lab-2"))
+        
+        assert len(registry) == 3
+        assert {r.connection_id for r in registry.for_vm("vm-1")} == {"c1", "c2"}
+        assert [r.connection_id for r in registry.for_lab("lab-2")] == ["c3"]
+        
+        registry.remove("c1")
+        registry.remove("c2")
+        assert registry.for_vm("vm-1") == []
+        assert registry.for_lab("lab-1") == []
+        assert len(registry) == 1
+    
+    def test_busiest_and_idle(self):
+        """Test du classement des connexions par trafic et par inactivité."""
+        registry = ConnectionRegistry()
+        quiet = self._record("quiet", "vm-1")
+        busy = self._record("busy", "vm-2")
+        busy.bytes_out = 10_000
+        quiet.last_activity -= 600
+        registry.add(quiet)
+        registry.add(busy)
+        
+        assert registry.busiest(1)[0].connection_id == "busy"
+        assert registry.idle(1)[0].connection_id == "quiet"
+        assert busy.to_dict()["bytes_out"] == 10_000
+
+
+class TestRegistryBackend:
+    """Tests du registre de connexions partagé entre workers par la base."""
+    
+    def setup_method(self):
+        db = TestingSessionLocal()
+        db.query(ProxyConnection).delete()
+        db.query(ProxyCloseCommand).delete()
+        db.commit()
+        db.close()
+    
+    def _worker(self, worker_id, closed):
+        async def on_close_vm(vm_id):
+            closed.append(vm_id)
+        
+        backend = DatabaseRegistryBackend(TestingSessionLocal, worker_id)
+        # Cycles déclenchés par le test, sans la tâche de synchronisation périodique
+        backend._registry = ConnectionRegistry()
+        backend._on_close_vm = on_close_vm
+        return backend
+    
+    def test_two_worker_sync(self, monkeypatch):
+        """Test de la publication, des commandes de fermeture, de leur reprise après échec et de la purge."""
+        closed_a, closed_b = [], []
+        worker_a, worker_b = self._worker("worker-a", closed_a), self._worker("worker-b", closed_b)
+        record = ConnectionRecord("conn-1", "ssh", "vm-1", "lab-1", None, None, None)
+        worker_b._registry.add(record)
+        
+        async def scenario():
+            await worker_a.sync_once()
+            await worker_b.sync_once()
+            await worker_a.sync_once()
+            assert [c["worker_id"] for c in worker_a.remote_for_vm("vm-1")] == ["worker-b"]
+            assert len(worker_a.remote_for_lab("lab-1")) == 1
+            assert worker_b.remote_all() == []
+            
+            # Fermeture demandée sur A : exécutée par B, pas par A
+            worker_a.request_close_vm("vm-1")
+            await worker_a.sync_once()
+            await worker_b.sync_once()
+            assert closed_b == ["vm-1"] and closed_a == []
+            
+            # Cycle en échec : la commande reste en attente jusqu'au cycle suivant
+            worker_a.request_close_vm("vm-2")
+            def failing_sync(*args):
+                raise RuntimeError("base indisponible")
+            monkeypatch.setattr(worker_a, "_sync", failing_sync)
+            with pytest.raises(RuntimeError):
+                await worker_a.sync_once()
+            monkeypatch.undo()
+            assert worker_a._pending_commands == ["vm-2"]
+            await worker_a.sync_once()
+            await worker_b.sync_once()
+            assert closed_b == ["vm-1", "vm-2"]
+            
+            # Connexion fermée sur B, worker disparu sans se retirer : tous deux purgés
+            worker_b._registry.remove("conn-1")
+            db = TestingSessionLocal()
+            db.add(ProxyConnection(connection_id="conn-stale", worker_id="worker-c", type="vnc", vm_id="vm-3",
+                                   started_at=0, last_activity=0, heartbeat_at=time.time() - 3600))
+            db.commit()
+            db.close()
+            await worker_b.sync_once()
+            await worker_a.sync_once()
+            assert worker_a.remote_all() == []
+        
+        asyncio.run(scenario())
+        db = TestingSessionLocal()
+        assert db.query(ProxyConnection).count() == 0
+        db.close()
+
+
+class TestVMCache:
+    """Tests du cache VM -> ports tenu à jour par les événements de session."""
+    
+    def test_commit_and_rollback(self):
+        """Test de la mise à jour au commit, de l'abandon au rollback et du retrait à la suppression."""
+        db = TestingSessionLocal()
+        try:
+            lab = Lab(id=uuid.uuid4(), name="Cache", status="deployed")
+            vm = VM(id=uuid.uuid4(), lab_id=lab.id, name="web-1", vcpu=1, ram_mb=1024, disk_gb=10,
+                    os_image="ubuntu-22.04", status="running", ssh_port=22001, vnc_port=5901)
+            db.add_all([lab, vm])
+            db.commit()
+            vm_id = str(vm.id)
+            assert vm_cache._entries[vm_id].ssh_port == 22001
+            
+            # Modification annulée : le cache garde la valeur validée
+            vm.ssh_port = 22002
+            db.flush()
+            db.rollback()
+            assert vm_cache._entries[vm_id].ssh_port == 22001
+            
+            vm = db.get(VM, vm.id)
+            vm.ssh_port, vm.status = 22003, "stopped"
+            db.commit()
+            # Servi par le cache, sans session
+            entry = asyncio.run(vm_cache.resolve(vm_id))
+            assert (entry.ssh_port, entry.status) == (22003, "stopped")
+            
+            db.delete(vm)
+            db.delete(lab)
+            db.commit()
+            assert vm_id not in vm_cache._entries
+        finally:
+            db.close()
+
+
+class TestAdaptiveDeflate:
+    """Tests de la compression adaptative du proxy."""
+    
+    def test_compresses_repetitive_output(self):
+        """Test de la compression d'une sortie répétitive."""
+        import zlib
+        compressor = AdaptiveDeflate()
+        data = b"make[1]: Entering directory '/src'\n" * 500
+        
+        compressed, payload = compressor.encode(data)
+        assert compressed
+        assert zlib.decompress(payload, -zlib.MAX_WBITS) == data
+        assert compressor.saved_bytes > 0
+        assert compressor.enabled
+    
+    def test_disables_on_incompressible_data(self):
+        """Test de la désactivation sur des données incompressibles."""
+        import os
+        compressor = AdaptiveDeflate()
+        
+        compressed, payload = compressor.encode(os.urandom(64 * 1024))
+        assert not compressed
+        assert not compressor.enabled
+        
+        compressed, payload = compressor.encode(os.urandom(64 * 1024))
+        assert not compressed
+        assert compressor.to_dict()["messages_compressed"] == 0
+
+
+def process_alive(pid: int) -> bool:
+    """Processus existant et pas zombie : un orphelin tué peut attendre d'être récupéré par init."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+class TestAnsibleFarm:
+    """Tests de la ferme d'exécution Ansible."""
+    
+    def test_fork_budget(self):
+        """Test du plafond par lab, de l'attente sur le budget global et de la restitution."""
+        async def scenario():
+            budget = ForkBudget(total_forks=6, lab_forks=4)
+            lab_a, lab_b = uuid.uuid4(), uuid.uuid4()
+            assert await budget.acquire(lab_a, 10) == 4
+            assert await budget.acquire(lab_b, 2) == 2
+            
+            # Plafond du lab atteint, puis budget global épuisé : les demandes attendent
+            over_lab = asyncio.ensure_future(budget.acquire(lab_a, 1))
+            over_total = asyncio.ensure_future(budget.acquire(uuid.uuid4(), 1))
+            await asyncio.sleep(0.01)
+            assert not over_lab.done() and not over_total.done()
+            
+            await budget.release(lab_a, 4)
+            assert await asyncio.wait_for(over_lab, 1) == 1
+            assert await asyncio.wait_for(over_total, 1) == 1
+            await budget.release(lab_b, 2)
+            assert budget.available == 4
+            assert budget.in_use_by_lab[lab_a] == 1 and lab_b not in budget.in_use_by_lab
+        
+        asyncio.run(scenario())
+    
+    def test_cancelled_job_kills_process(self, tmp_path, monkeypatch):
+        """Test de l'arrêt du processus ansible-playbook d'un job annulé et de la restitution des forks."""
+        monkeypatch.setattr("services.ansible_farm.command_executor", SubprocessExecutor())
+        pid_file = tmp_path / "pid"
+        # Le processus lance un fils, comme ansible-playbook ses forks et leurs ssh
+        script = (
+            "import os, subprocess, sys, time\n"
+            "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])\n"
+            f"open({str(pid_file)!r}, 'w').write(f'{{os.getpid()}} {{child.pid}}')\n"
+            "time.sleep(60)\n"
+        )
+        
+        async def scenario():
+            farm = AnsibleFarm(workers=1, total_forks=2, lab_forks=2, niceness=0, base_dir=str(tmp_path))
+            job = asyncio.ensure_future(farm.submit(uuid.uuid4(), [sys.executable, "-c", script], str(tmp_path)))
+            while not pid_file.exists() or " " not in pid_file.read_text():
+                await asyncio.sleep(0.05)
+            pids = [int(pid) for pid in pid_file.read_text().split()]
+            job.cancel()
+            
+            for _ in range(100):
+                if not any(process_alive(pid) for pid in pids):
+                    break
+                await asyncio.sleep(0.05)
+            else:
+                raise AssertionError("processus du job annulé ou son fils toujours actif")
+            stats = farm.get_stats()
+            await farm.stop()
+            return stats
+        
+        stats = asyncio.run(scenario())
+        assert stats["running_jobs"] == 0
+        assert stats["available_forks"] == 2
+
+
+class TestSessionRecording:
+    """Tests du format des enregistrements de sessions."""
+    
+    def test_write_and_replay(self, tmp_path):
+        """Test de l'écriture en membres gzip indexés et de la relecture à partir d'un instant."""
+        writer = RecordingWriter(str(tmp_path))
+        # Écriture pilotée par le test, sans le thread d'écriture
+        writer._ensure_started = lambda: None
+        recorder = writer.start_recording("vm-1", "lab-1", 100, 30)
+        
+        # Un caractère UTF-8 coupé entre deux lectures, puis un membre gzip par événement
+        events = [(0.5, "début\r\n".encode()), (1.0, "é".encode()[:1]), (1.2, "é".encode()[1:] + b" suite"), (5.0, b"fin")]
+        for elapsed, data in events:
+            writer._handle(recorder, elapsed, data)
+            writer._files[recorder.recording_id].flush()
+        writer._handle(recorder, None, None)
+        
+        base_path = writer.base_path(recorder.recording_id)
+        with open(base_path + ".idx") as f:
+            assert [float(line.split()[0]) for line in f] == [0.0, 1.2, 5.0]
+        with open(base_path + ".cast.gz", "rb") as f:
+            assert gzip.decompress(f.read()).decode().count("\n") == 4
+        
+        reader = RecordingReader(str(tmp_path), recorder.recording_id)
+        lines = b"".join(reader.stream()).decode().splitlines()
+        assert json.loads(lines[0])["width"] == 100
+        assert [json.loads(line) for line in lines[1:]] == [
+            [0.5, "o", "début\r\n"], [1.2, "o", "é suite"], [5.0, "o", "fin"]
+        ]
+        
+        # Relecture à partir de 2 s : seul le membre indexé à 1,2 s est décompressé
+        lines = b"".join(reader.stream(2.0)).decode().splitlines()
+        assert [json.loads(line) for line in lines[1:]] == [[3.0, "o", "fin"]]
+        assert list_recordings(str(tmp_path), "vm-1")[0]["recording_id"] == recorder.recording_id
+
+
+class FakeMuxWebSocket:
+    """WebSocket simulé : trames du client dans une file, trames envoyées relues par type."""
+    
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.sent = asyncio.Queue()
+    
+    def push(self, frame: bytes):
+        self.incoming.put_nowait({"type": "websocket.receive", "bytes": frame})
+    
+    async def receive(self):
+        return await self.incoming.get()
+    
+    async def send_bytes(self, frame: bytes):
+        self.sent.put_nowait(decode_frame(frame))
+    
+    async def next_frame(self, frame_type: int):
+        while True:
+            sent_type, _, channel_id, payload = await asyncio.wait_for(self.sent.get(), 5)
+            if sent_type == frame_type:
+                return channel_id, payload
+
+
+class TestMultiplexer:
+    """Tests de la session multiplexée."""
+    
+    def test_slow_open_and_invalid_frames(self):
+        """Test d'une ouverture lente qui ne bloque pas les autres canaux et des trames invalides ignorées."""
+        async def echo(reader, writer):
+            writer.write(await reader.read(1024))
+            await writer.drain()
+        
+        async def scenario():
+            server = await asyncio.start_server(echo, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            resume = asyncio.Event()
+            
+            async def resolve_vm(vm_id, kind):
+                # VM en cours de sortie d'hibernation
+                if vm_id == "lente":
+                    await resume.wait()
+                return ("127.0.0.1", port, "lab-1"), None
+            
+            websocket = FakeMuxWebSocket()
+            proxy = WebSocketProxyService()
+            session = MuxSession(websocket, proxy, resolve_vm)
+            runner = asyncio.create_task(session.run())
+            websocket.push(encode_frame(FRAME_OPEN, 1, b'{"vm_id": "lente"}'))
+            websocket.push(encode_frame(FRAME_OPEN, 2, b"[]"))
+            websocket.push(encode_frame(FRAME_OPEN, 3, b'{"vm_id": "vm", "cols": "x"}'))
+            websocket.push(encode_frame(FRAME_OPEN, 4, b'{"vm_id": "rapide"}'))
+            
+            assert (await websocket.next_frame(FRAME_ERROR))[0] == 2
+            assert (await websocket.next_frame(FRAME_ERROR))[0] == 3
+            assert (await websocket.next_frame(FRAME_OPENED))[0] == 4
+            websocket.push(encode_frame(FRAME_RESIZE, 4, b"{invalide"))
+            websocket.push(encode_frame(FRAME_DATA, 4, b"ping"))
+            assert await websocket.next_frame(FRAME_DATA) == (4, b"ping")
+            assert 1 in session._opening
+            
+            resume.set()
+            assert (await websocket.next_frame(FRAME_OPENED))[0] == 1
+            websocket.incoming.put_nowait({"type": "websocket.disconnect"})
+            await asyncio.wait_for(runner, 5)
+            server.close()
+            return session, proxy
+        
+        session, proxy = asyncio.run(scenario())
+        assert session.channels == {} and session._opening == {}
+        assert proxy.registry.all() == []
+
+
+class FakeSSHServer:
+    """
+    Serveur SSH local (asyncssh) avec une clé client autorisée : la commande `true` réussit,
+    le shell rapporte la taille de son terminal puis renvoie ce qu'il reçoit.
+    """
+    
+    def __init__(self, tmp_path, monkeypatch):
+        self.host_key = asyncssh.generate_private_key("ssh-ed25519")
+        client_key = asyncssh.generate_private_key("ssh-ed25519")
+        self.authorized = asyncssh.import_authorized_keys(client_key.export_public_key().decode())
+        key_path = tmp_path / "id_ed25519"
+        client_key.write_private_key(str(key_path))
+        monkeypatch.setattr("services.ssh_pool.SSH_KEY_PATH", str(key_path))
+        monkeypatch.setattr("services.ssh_pool.SSH_USERNAME", "lab")
+        self.connections = []
+        self.server = None
+        self.port = None
+    
+    async def start(self):
+        server = self
+        
+        class Server(asyncssh.SSHServer):
+            def connection_made(self, connection):
+                server.connections.append(connection)
+        
+        self.server = await asyncssh.create_server(
+            Server, "127.0.0.1", 0, server_host_keys=[self.host_key],
+            authorized_client_keys=self.authorized, process_factory=self._process, line_editor=False
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+    
+    async def _process(self, process):
+        if process.command is not None:
+            process.exit(0 if process.command == "true" else 1)
+            return
+        cols, rows = process.term_size[:2]
+        process.stdout.write(f"size {cols}x{rows}\n")
+        while True:
+            try:
+                data = await process.stdin.read(1024)
+            except asyncssh.TerminalSizeChanged as change:
+                process.stdout.write(f"size {change.width}x{change.height}\n")
+                continue
+            if not data:
+                break
+            process.stdout.write(data)
+        process.exit(0)
+    
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class FakeProxyWebSocket(FakeMuxWebSocket):
+    """WebSocket simulé pour le proxy SSH direct : données brutes au lieu de trames."""
+    
+    async def send_bytes(self, data: bytes):
+        self.sent.put_nowait(data)
+    
+    async def send_text(self, text: str):
+        self.sent.put_nowait(text.encode())
+    
+    async def read_until(self, expected: bytes) -> bytes:
+        received = b""
+        while expected not in received:
+            received += await asyncio.wait_for(self.sent.get(), 5)
+        return received
+
+
+class TestSSHPool:
+    """Tests du pool de transports SSH (mode natif) contre un serveur asyncssh local."""
+    
+    def test_reuse_and_reconnect(self, tmp_path, monkeypatch):
+        """Test du partage d'un transport, de son remplacement après une coupure et des refus."""
+        ssh = FakeSSHServer(tmp_path, monkeypatch)
+        
+        async def scenario():
+            await ssh.start()
+            pool = SSHTransportPool()
+            assert await pool.is_ready("127.0.0.1", ssh.port)
+            assert (await pool.run("127.0.0.1", ssh.port, "false"))[0] == 1
+            process = await pool.open_shell("127.0.0.1", ssh.port, 100, 30)
+            assert await process.stdout.readline() == b"size 100x30\n"
+            transport = pool._transports[("127.0.0.1", ssh.port)]
+            # Une seule connexion pour les commandes et le shell
+            assert len(ssh.connections) == 1 and transport.channels == 1
+            process.stdin.write_eof()
+            await process.wait_closed()
+            await asyncio.sleep(0)
+            assert transport.channels == 0
+            
+            # Connexion coupée côté VM : le transport est remplacé au prochain usage
+            ssh.connections[0].close()
+            await transport.connection.wait_closed()
+            assert await pool.is_ready("127.0.0.1", ssh.port)
+            assert len(ssh.connections) == 2
+            
+            # VM injoignable : la sonde échoue et le transport fermé est retiré du pool
+            await ssh.stop()
+            ssh.connections[1].close()
+            await pool._transports[("127.0.0.1", ssh.port)].connection.wait_closed()
+            assert not await pool.is_ready("127.0.0.1", ssh.port)
+            assert pool._transports == {}
+            
+            # Clé refusée : erreur explicite plutôt que « pas encore prête »
+            await ssh.start()
+            other = asyncssh.generate_private_key("ssh-ed25519")
+            other.write_private_key(str(tmp_path / "other"))
+            monkeypatch.setattr("services.ssh_pool.SSH_KEY_PATH", str(tmp_path / "other"))
+            with pytest.raises(SSHAuthenticationError):
+                await pool.is_ready("127.0.0.1", ssh.port)
+            await pool.close_all()
+            await ssh.stop()
+        
+        asyncio.run(scenario())
+    
+    def test_idle_reaper(self, tmp_path, monkeypatch):
+        """Test de la fermeture des transports inactifs, pas de ceux qui portent un canal."""
+        ssh = FakeSSHServer(tmp_path, monkeypatch)
+        monkeypatch.setattr("services.ssh_pool.SSH_POOL_IDLE_TIMEOUT", 0.1)
+        
+        async def scenario():
+            await ssh.start()
+            pool = SSHTransportPool()
+            process = await pool.open_shell("127.0.0.1", ssh.port)
+            transport = pool._transports[("127.0.0.1", ssh.port)]
+            await asyncio.sleep(0.3)
+            assert not transport.connection.is_closed()
+            
+            process.stdin.write_eof()
+            await process.wait_closed()
+            await asyncio.sleep(0.3)
+            assert transport.connection.is_closed()
+            assert pool._transports == {}
+            await pool.close_all()
+            await ssh.stop()
+        
+        asyncio.run(scenario())
+    
+    def test_readiness_probe(self, tmp_path, monkeypatch):
+        """Test de la sonde de disponibilité : port en mode tcp, session authentifiée en mode natif."""
+        commands = []
+        
+        class RecordingExecutor(SubprocessExecutor):
+            async def run(self, command, **kwargs):
+                commands.append(command[0])
+                return CommandResult(0, "")
+        
+        ssh = FakeSSHServer(tmp_path, monkeypatch)
+        pool = SSHTransportPool()
+        monkeypatch.setattr("services.ansible_service.command_executor", RecordingExecutor())
+        monkeypatch.setattr("services.ansible_service.ssh_transport_pool", pool)
+        service = AnsibleService()
+        
+        async def scenario():
+            await ssh.start()
+            monkeypatch.setattr("services.ansible_service.SSH_PROXY_MODE", "tcp")
+            assert await service._ssh_ready(ssh.port)
+            assert commands == ["nc"] and pool._transports == {}
+            
+            # Clé absente : erreur explicite dès la première sonde
+            monkeypatch.setattr("services.ansible_service.SSH_PROXY_MODE", "native")
+            monkeypatch.setattr("services.ssh_pool.SSH_KEY_PATH", str(tmp_path / "absente"))
+            with pytest.raises(SSHAuthenticationError):
+                await service._ssh_ready(ssh.port)
+            assert commands == ["nc"]
+            await pool.close_all()
+            await ssh.stop()
+        
+        asyncio.run(scenario())
+    
+    def test_native_proxy_and_channel(self, tmp_path, monkeypatch):
+        """Test du mode natif du proxy direct et du multiplexeur, avec redimensionnement du PTY."""
+        ssh = FakeSSHServer(tmp_path, monkeypatch)
+        pool = SSHTransportPool()
+        monkeypatch.setattr("services.websocket_service.ssh_transport_pool", pool)
+        monkeypatch.setattr("services.multiplexer.ssh_transport_pool", pool)
+        
+        async def scenario():
+            await ssh.start()
+            proxy = WebSocketProxyService()
+            
+            # Proxy direct : shell ouvert à la taille demandée, données relayées
+            direct = FakeProxyWebSocket()
+            handler = asyncio.create_task(proxy.handle_ssh_connection(
+                direct, "vm-1", "127.0.0.1", ssh.port, native=True, cols=132, rows=43
+            ))
+            assert b"size 132x43" in await direct.read_until(b"\n")
+            direct.incoming.put_nowait({"type": "websocket.receive", "bytes": b"ping"})
+            assert b"ping" in await direct.read_until(b"ping")
+            
+            async def resolve_vm(vm_id, kind):
+                return ("127.0.0.1", ssh.port, "lab-1"), None
+            
+            # Canal multiplexé sur le même transport, redimensionné après l'ouverture
+            websocket = FakeMuxWebSocket()
+            session = MuxSession(websocket, proxy, resolve_vm)
+            runner = asyncio.create_task(session.run())
+            websocket.push(encode_frame(FRAME_OPEN, 1, b'{"vm_id": "vm-1", "mode": "native", "cols": 90, "rows": 20}'))
+            assert (await websocket.next_frame(FRAME_OPENED))[0] == 1
+            assert await websocket.next_frame(FRAME_DATA) == (1, b"size 90x20\n")
+            websocket.push(encode_frame(FRAME_RESIZE, 1, b'{"cols": 120, "rows": 40}'))
+            assert await websocket.next_frame(FRAME_DATA) == (1, b"size 120x40\n")
+            assert session.channels[1].process is not None
+            assert len(ssh.connections) == 1
+            assert pool._transports[("127.0.0.1", ssh.port)].channels == 2
+            
+            direct.incoming.put_nowait({"type": "websocket.disconnect"})
+            await asyncio.wait_for(handler, 5)
+            websocket.incoming.put_nowait({"type": "websocket.disconnect"})
+            await asyncio.wait_for(runner, 5)
+            assert proxy.registry.all() == []
+            await pool.close_all()
+            await ssh.stop()
+        
+        asyncio.run(scenario())
+
+
+class TestVMManagement:
+    """Tests des opérations sur les VMs avec le backend de virtualisation factice."""
+    
+    def test_power_operations(self):
+        """Test du démarrage et de l'arrêt d'une VM."""
+        backend = FakeBackend()
+        vm = VM(name="web-1", domain_name="lab_1234_web_1")
+        backend.add_domain("lab_1234_web_1")
+        
+        assert asyncio.run(start_vm(vm, backend))
+        assert asyncio.run(get_vm_status(vm, backend)) == "running"
+        assert asyncio.run(stop_vm(vm, backend))
+        assert asyncio.run(get_vm_status(vm, backend)) == "stopped"
+        assert backend.calls == [("start", "lab_1234_web_1"), ("shutdown", "lab_1234_web_1")]
+    
+    def test_unknown_domain(self):
+        """Test d'une opération sur un domaine inexistant."""
+        backend = FakeBackend()
+        vm = VM(name="absente", lab_id=uuid.uuid4())
+        
+        assert not asyncio.run(start_vm(vm, backend))
+        assert asyncio.run(get_vm_status(vm, backend)) == "error"
+    
+    def test_incomplete_backend(self):
+        """Test du refus d'instancier un backend qui n'implémente pas toute l'interface."""
+        class PartialBackend(VirtBackend):
+            async def start(self, name: str):
+                pass
+        
+        with pytest.raises(TypeError, match="shutdown"):
+            PartialBackend()
+    
+    def test_power_lab_vms(self):
+        """Test d'une action sur toutes les VMs d'un lab, avec un échec isolé."""
+        backend = FakeBackend()
+        lab_id = uuid.uuid4()
+        vms = [VM(id=uuid.uuid4(), lab_id=lab_id, name=f"vm-{i}", status="stopped") for i in range(5)]
+        for vm in vms[:4]:
+            backend.add_domain(format_domain_name(lab_id, vm.name))
+        
+        results = asyncio.run(power_lab_vms(vms, "start", backend, concurrency=2))
+        assert [r["success"] for r in results] == [True, True, True, True, False]
+        assert results[0]["status"] == "running"
+        assert results[4]["status"] == "stopped"
+        assert results[4]["error"]
+    
+    def test_lab_power_requires_deployed(self):
+        """Test du refus des actions d'alimentation sur un lab non déployé ou hiberné."""
+        db = TestingSessionLocal()
+        lab_id = uuid.uuid4()
+        db.add(Lab(id=lab_id, name=f"power-{lab_id}", status="hibernated"))
+        db.commit()
+        try:
+            response = client.post(f"/api/v1/labs/{lab_id}/start")
+            assert response.status_code == 400
+            assert "/resume" in response.json()["detail"]
+            
+            for status in ("deploying", "deleting", "error"):
+                db.query(Lab).filter(Lab.id == lab_id).update({Lab.status: status})
+                db.commit()
+                assert client.post(f"/api/v1/labs/{lab_id}/restart").status_code == 400
+            
+            db.query(Lab).filter(Lab.id == lab_id).update({Lab.status: "deployed"})
+            db.commit()
+            response = client.post(f"/api/v1/labs/{lab_id}/stop")
+            assert response.status_code == 200
+            assert response.json()["succeeded"] == 0
+        finally:
+            db.query(Lab).filter(Lab.id == lab_id).delete()
+            db.commit()
+            db.close()
+    
+    def test_reconciliation_diff(self):
+        """Test du calcul des statuts à corriger par la réconciliation."""
+        rows = [
+            ("id-1", "lab_web_1", "running"),
+            ("id-2", "lab_web_2", "running"),
+            ("id-3", "lab_db_1", "stopped"),
+            ("id-4", "lab_absente", "running"),
+        ]
+        states = {"lab_web_1": "running", "lab_web_2": "shutoff", "lab_db_1": "paused"}
+        
+        assert diff_states(rows, states) == [
+            {"vm_id": "id-2", "old_status": "running", "new_status": "stopped"}
+        ]
+    
+    def test_reconciliation_domain_uuid(self):
+        """Test du rapprochement par UUID d'un domaine renommé ou recréé."""
+        backend = FakeBackend()
+        backend.add_domain("lab_web_renamed", "shutoff", domain_uuid="uuid-web")
+        backend.add_domain("lab_db", "running", domain_uuid="uuid-db-new")
+        lab_id = uuid.uuid4()
+        web_id, db_id = uuid.uuid4(), uuid.uuid4()
+        db = TestingSessionLocal()
+        db.add_all([
+            Lab(id=lab_id, name=f"lab-{lab_id}", status="deployed"),
+            VM(id=web_id, lab_id=lab_id, name="web", vcpu=1, ram_mb=512, disk_gb=10, os_image="ubuntu-22.04",
+               status="running", domain_name="lab_web", domain_uuid="uuid-web"),
+            VM(id=db_id, lab_id=lab_id, name="db", vcpu=1, ram_mb=512, disk_gb=10, os_image="ubuntu-22.04",
+               status="stopped", domain_name="lab_db", domain_uuid="uuid-db-old"),
+        ])
+        db.commit()
+        try:
+            reconciler = VMReconciler(backend=backend, session_factory=TestingSessionLocal)
+            changes = asyncio.run(reconciler.reconcile_once())
+            
+            # L'état du domaine renommé est retrouvé par son UUID et son nom corrigé
+            assert sorted((c["vm_id"], c["new_status"]) for c in changes) == sorted(
+                [(web_id, "stopped"), (db_id, "running")]
+            )
+            db.expire_all()
+            web = db.query(VM).filter(VM.id == web_id).one()
+            assert (web.domain_name, web.domain_uuid, web.status) == ("lab_web_renamed", "uuid-web", "stopped")
+            # Le domaine recréé sous le même nom est adopté avec son nouvel UUID
+            vm_db = db.query(VM).filter(VM.id == db_id).one()
+            assert (vm_db.domain_name, vm_db.domain_uuid, vm_db.status) == ("lab_db", "uuid-db-new", "running")
+            
+            # Un second cycle ne corrige plus rien
+            assert asyncio.run(reconciler.reconcile_once()) == []
+        finally:
+            db.query(VM).filter(VM.lab_id == lab_id).delete()
+            db.query(Lab).filter(Lab.id == lab_id).delete()
+            db.commit()
+            db.close()
+    
+    def test_hibernated_vms(self):
+        """Test de l'hibernation par managed save et de la réconciliation des VMs hibernées."""
+        backend = FakeBackend()
+        backend.add_domain("lab_web_1", "running")
+        vm = type("Row", (), {"id": "id-1", "name": "web-1", "status": "running", "domain_name": "lab_web_1"})
+        
+        results = asyncio.run(power_lab_vms([vm], "hibernate", backend))
+        assert results[0]["status"] == "hibernated"
+        assert backend.domains["lab_web_1"]["state"] == "shutoff"
+        
+        # Un domaine hiberné reste hiberné ; redémarré hors de l'application, il redevient actif
+        rows = [("id-1", "lab_web_1", "hibernated"), ("id-2", "lab_web_2", "hibernated")]
+        states = {"lab_web_1": "shutoff", "lab_web_2": "running"}
+        assert diff_states(rows, states) == [
+            {"vm_id": "id-2", "old_status": "hibernated", "new_status": "running"}
+        ]
+
+
+class TestHibernation:
+    """Tests de la détection des labs inactifs et de leur reprise."""
+    
+    def setup_method(self):
+        db = TestingSessionLocal()
+        db.query(CapacityReservation).delete()
+        db.query(HostCapacity).delete()
+        db.query(VM).delete()
+        db.query(Lab).delete()
+        db.commit()
+        db.close()
+    
+    teardown_method = setup_method
+    
+    def _lab(self, backend, last_activity=None, idle_minutes=10, cpu_threshold=None, status="deployed"):
+        lab_id = uuid.uuid4()
+        domain = format_domain_name(lab_id, "web-1")
+        backend.add_domain(domain, "running" if status == "deployed" else "shutoff")
+        db = TestingSessionLocal()
+        db.add_all([
+            Lab(id=lab_id, name=f"lab-{lab_id}", status=status, last_activity_at=last_activity,
+                hibernate_after_minutes=idle_minutes, hibernate_cpu_threshold=cpu_threshold),
+            VM(lab_id=lab_id, name="web-1", vcpu=1, ram_mb=1024, disk_gb=10, os_image="ubuntu-22.04",
+               status="running" if status == "deployed" else status, domain_name=domain)
+        ])
+        db.commit()
+        db.close()
+        return str(lab_id)
+    
+    def test_idle_detection(self, monkeypatch):
+        """Test des seuils d'inactivité et de CPU, de la politique par lab et du premier relevé."""
+        backend = FakeBackend()
+        old = time.time() - 3600
+        idle = self._lab(backend, last_activity=old)
+        busy = self._lab(backend, last_activity=old, cpu_threshold=20)
+        recent = self._lab(backend, last_activity=time.time() - 60)
+        never = self._lab(backend, last_activity=old, idle_minutes=0)
+        unseen = self._lab(backend)
+        peaks = {busy: 35.0, idle: 2.0}
+        monkeypatch.setattr("services.hibernation.vm_metrics_collector.lab_cpu_peak",
+                            lambda lab_id, window: peaks.get(lab_id))
+        manager = HibernationManager(backend=backend, session_factory=TestingSessionLocal, interval=0)
+        
+        assert asyncio.run(manager.check_once()) == [idle]
+        # Sans activité enregistrée, le délai court depuis le premier relevé de ce processus
+        assert unseen in manager._first_seen
+        manager._first_seen[unseen] = old
+        assert asyncio.run(manager.check_once()) == [unseen]
+        assert asyncio.run(manager.check_once()) == []
+        assert unseen not in manager._first_seen and idle not in manager._first_seen
+        
+        db = TestingSessionLocal()
+        statuses = {str(lab.id): lab.status for lab in db.query(Lab)}
+        db.close()
+        assert statuses == {idle: "hibernated", busy: "deployed", recent: "deployed",
+                            never: "deployed", unseen: "hibernated"}
+    
+    def test_concurrent_resume(self):
+        """Test des reprises simultanées d'un lab, qui partagent une seule restauration."""
+        backend = FakeBackend()
+        lab_id = self._lab(backend, status="hibernated")
+        manager = HibernationManager(backend=backend, session_factory=TestingSessionLocal, interval=0)
+        
+        async def scenario():
+            return await asyncio.gather(*(manager.resume_lab(lab_id) for _ in range(3)))
+        
+        results = asyncio.run(scenario())
+        assert [result["resumed"] for result in results] == [True, False, False]
+        assert [call for call in backend.calls if call[0] == "start"] == [("start", format_domain_name(lab_id, "web-1"))]
+        assert manager.stats["resumed"] == 1
+        
+        # Un lab hiberné n'est pas redéployé par-dessus ses domaines sauvegardés
+        other = self._lab(backend, status="hibernated")
+        response = client.post(f"/api/v1/labs/{other}/deploy")
+        assert response.status_code == 400
+    
+    def test_capacity_released_while_hibernated(self, monkeypatch):
+        """Test de la RAM rendue au registre à l'hibernation et réservée à nouveau à la reprise."""
+        drained = []
+        
+        async def fake_drain():
+            drained.append(True)
+        
+        monkeypatch.setattr("services.hibernation.deploy_queued_labs", fake_drain)
+        backend = FakeBackend()
+        lab_id = self._lab(backend)
+        db = TestingSessionLocal()
+        # Hôte de 4096 MB allouables
+        db.add(HostCapacity(host="h1", vcpu=4, ram_mb=6144, disk_gb=100))
+        db.commit()
+        assert capacity_ledger.admit(db, uuid.UUID(lab_id)) == ("reserved", "h1")
+        manager = HibernationManager(backend=backend, session_factory=TestingSessionLocal, interval=0)
+        
+        def reserved_ram():
+            db.expire_all()
+            return db.query(CapacityReservation.ram_mb).filter(
+                CapacityReservation.lab_id == uuid.UUID(lab_id)).scalar()
+        
+        try:
+            assert asyncio.run(manager.hibernate_lab(lab_id))["hibernated"]
+            assert reserved_ram() == 0 and drained == [True]
+            
+            # Un autre lab occupe la RAM libérée : la reprise est refusée, le lab reste hiberné
+            other = uuid.uuid4()
+            db.add(CapacityReservation(lab_id=other, host="h1", state="reserved", requested_at=time.time(),
+                                       vcpu=1, ram_mb=3584, disk_gb=10))
+            db.commit()
+            with pytest.raises(CapacityError):
+                asyncio.run(manager.resume_lab(lab_id))
+            assert reserved_ram() == 0
+            assert not [call for call in backend.calls if call[0] == "start"]
+            
+            capacity_ledger.release(db, other)
+            db.commit()
+            assert asyncio.run(manager.resume_lab(lab_id))["resumed"]
+            assert reserved_ram() == 1024
+        finally:
+            db.close()
+
+
+class TestTeardown:
+    """Tests du démontage des labs et du ramasse-miettes."""
+    
+    def _backend_with_lab(self, lab_id):
+        backend = FakeBackend()
+        domain = format_domain_name(lab_id, "web-1")
+        backend.add_domain(domain, "running")
+        backend.volumes |= {f"{domain}_base.qcow2", f"{domain}_disk.qcow2", "other.qcow2"}
+        backend.networks |= {f"lab_{str(lab_id).replace('-', '_')}", "default"}
+        return backend
+    
+    def test_destroy_lab_resources(self, tmp_path, monkeypatch):
+        """Test de la destruction des seules ressources du lab."""
+        monkeypatch.setattr("services.teardown.WORKSPACE_ROOT", str(tmp_path))
+        lab_id = uuid.uuid4()
+        backend = self._backend_with_lab(lab_id)
+        
+        assert asyncio.run(destroy_lab_resources(lab_id, backend)) == []
+        assert backend.domains == {}
+        assert backend.volumes == {"other.qcow2"}
+        assert backend.networks == {"default"}
+    
+    def test_orphan_collection(self, tmp_path, monkeypatch):
+        """Test du nettoyage des ressources d'un lab absent de la base."""
+        # Répertoires de travail cherchés dans un dossier du test, pas dans le vrai /tmp
+        monkeypatch.setattr("services.teardown.WORKSPACE_ROOT", str(tmp_path))
+        known, orphan = uuid.uuid4(), uuid.uuid4()
+        backend = self._backend_with_lab(orphan)
+        backend.add_domain(format_domain_name(known, "db"), "running")
+        workspace = tmp_path / f"terraform_lab_{orphan}"
+        workspace.mkdir()
+        os.utime(workspace, (time.time() - 3600, time.time() - 3600))
+        collector = OrphanCollector(backend=backend, interval=0)
+        collector._known_lab_ids = lambda: {str(known)}
+        
+        result = asyncio.run(collector.collect_once())
+        assert result["cleaned"] == [str(orphan)]
+        assert list(backend.domains) == [format_domain_name(known, "db")]
+        assert not workspace.exists()
+
+
+class TestCapacity:
+    """Tests du placement des labs selon la capacité des hôtes."""
+    
+    def test_limits_and_placement(self):
+        """Test des limites avec surallocation et du choix de l'hôte."""
+        host = HostCapacity(host="h1", vcpu=4, ram_mb=10240, disk_gb=100)
+        limits = host_limits(host)
+        assert limits["vcpu"] > host.vcpu
+        assert limits["ram_mb"] <= host.ram_mb
+        
+        demand = {"vcpu": 2, "ram_mb": 4096, "disk_gb": 20}
+        headroom = {
+            "h1": {"vcpu": 8, "ram_mb": 6000, "disk_gb": 50},
+            "h2": {"vcpu": 8, "ram_mb": 20000, "disk_gb": 10},
+            "h3": {"vcpu": 8, "ram_mb": 9000, "disk_gb": 50},
+        }
+        assert CapacityLedger._place(demand, headroom) == "h3"
+        assert CapacityLedger._place(dict(demand, vcpu=16), headroom) is None
+    
+    def setup_method(self):
+        self.teardown_method()
+        db = TestingSessionLocal()
+        # Hôte de 4096 MB allouables (2048 MB réservés au système)
+        db.add(HostCapacity(host="h1", vcpu=4, ram_mb=6144, disk_gb=100))
+        db.commit()
+        db.close()
+    
+    def teardown_method(self):
+        db = TestingSessionLocal()
+        db.query(CapacityReservation).delete()
+        db.query(HostCapacity).delete()
+        db.query(VM).delete()
+        db.query(Lab).delete()
+        db.commit()
+        db.close()
+    
+    def _lab(self, ram_mb):
+        lab_id = uuid.uuid4()
+        db = TestingSessionLocal()
+        db.add_all([Lab(id=lab_id, name=f"lab-{lab_id}", status="created"),
+                    VM(lab_id=lab_id, name="vm", vcpu=1, ram_mb=ram_mb, disk_gb=10,
+                       os_image="ubuntu-22.04", status="pending")])
+        db.commit()
+        db.close()
+        return lab_id
+    
+    def _admit(self, ledger, lab_id):
+        db = TestingSessionLocal()
+        try:
+            return ledger.admit(db, lab_id)
+        finally:
+            db.close()
+    
+    def test_fifo_queue_and_drain(self):
+        """Test de la file d'attente servie dans l'ordre d'arrivée après libération des ressources."""
+        ledger = CapacityLedger(session_factory=TestingSessionLocal, mode="queue")
+        big, medium, small = self._lab(3072), self._lab(2048), self._lab(512)
+        assert self._admit(ledger, big) == ("reserved", "h1")
+        assert self._admit(ledger, medium) == ("queued", None)
+        # Le petit lab tiendrait, mais ne double pas le lab déjà en attente
+        assert self._admit(ledger, small) == ("queued", None)
+        assert ledger.drain_queue() == []
+        
+        db = TestingSessionLocal()
+        ledger.release(db, big)
+        db.commit()
+        assert ledger.drain_queue() == [medium, small]
+        assert {lab.status for lab in db.query(Lab).filter(Lab.id.in_([medium, small]))} == {"deploying"}
+        assert ledger.snapshot(db)["hosts"][0]["headroom"]["ram_mb"] == 4096 - 2048 - 512
+        db.close()
+    
+    def test_failed_deploy_releases_reservation(self, monkeypatch):
+        """Test de la réservation rendue quand le déploiement échoue, puis du drain de la file."""
+        class FailingTerraform:
+            async def deploy_lab(self, lab, db, host=None):
+                return False
+        
+        drained = []
+        
+        async def fake_drain():
+            drained.append(True)
+        
+        monkeypatch.setattr("services.deployment.TerraformService", FailingTerraform)
+        monkeypatch.setattr("services.deployment.deploy_queued_labs", fake_drain)
+        ledger = CapacityLedger(session_factory=TestingSessionLocal, mode="queue")
+        monkeypatch.setattr("services.deployment.capacity_ledger", ledger)
+        lab_id = self._lab(3072)
+        assert self._admit(ledger, lab_id) == ("reserved", "h1")
+        
+        db = TestingSessionLocal()
+        try:
+            asyncio.run(deploy_lab(lab_id, db))
+            assert db.query(Lab).filter(Lab.id == lab_id).one().status == "error"
+            assert db.query(CapacityReservation).filter(CapacityReservation.lab_id == lab_id).count() == 0
+            assert drained == [True]
+        finally:
+            db.close()
+    
+    def test_reject_mode(self, monkeypatch):
+        """Test du refus immédiat (409) en mode reject et d'un lab trop grand pour tout hôte."""
+        ledger = CapacityLedger(session_factory=TestingSessionLocal, mode="reject")
+        assert self._admit(ledger, self._lab(3072)) == ("reserved", "h1")
+        with pytest.raises(CapacityError):
+            self._admit(ledger, self._lab(2048))
+        
+        monkeypatch.setattr(capacity_ledger, "mode", "reject")
+        response = client.post(f"/api/v1/labs/{self._lab(2048)}/deploy")
+        assert response.status_code == 409
+        assert "Capacité insuffisante" in response.json()["detail"]
+        response = client.post(f"/api/v1/labs/{self._lab(8192)}/deploy")
+        assert response.status_code == 409
+        assert "dépasse la capacité" in response.json()["detail"]
+
+
+class TestFakeExecutor:
+    """Tests de la chaîne d'outils simulée."""
+    
+    def test_terraform_outputs_and_domains(self, tmp_path):
+        """Test des sorties Terraform déduites du main.tf et des domaines créés."""
+        domain = format_domain_name(uuid.uuid4(), "web-1")
+        (tmp_path / "main.tf").write_text(f'output "{domain}_domain" {{\n}}\n')
+        backend = FakeBackend()
+        executor = FakeExecutor(time_scale=0, failure_rate=0, backend=backend)
+        
+        assert asyncio.run(executor.run(["terraform", "apply"], cwd=str(tmp_path))).returncode == 0
+        assert backend.domains[domain]["state"] == "running"
+        result = asyncio.run(executor.run(["terraform", "output", "-json"], cwd=str(tmp_path)))
+        assert json.loads(result.stdout)[f"{domain}_domain"]["value"]["name"] == domain
+        assert len(executor.timings["terraform apply"]) == 1
+    
+    def test_terraform_ssh_ports(self, monkeypatch):
+        """Test des ports SSH : ceux rendus dans cloud-init sont ceux enregistrés sur les VMs."""
+        monkeypatch.setattr("services.terraform_service.command_executor",
+                            FakeExecutor(time_scale=0, failure_rate=0, backend=FakeBackend()))
+        db = TestingSessionLocal()
+        try:
+            other = Lab(name=f"ports-a-{uuid.uuid4()}", status="deployed")
+            lab = Lab(name=f"ports-b-{uuid.uuid4()}", status="deploying")
+            db.add_all([other, lab])
+            db.flush()
+            db.add(VM(lab_id=other.id, name="a", vcpu=1, ram_mb=512, disk_gb=10,
+                      os_image="ubuntu-22.04", status="running", ssh_port=22000))
+            for name in ("b1", "b2"):
+                db.add(VM(lab_id=lab.id, name=name, vcpu=1, ram_mb=512, disk_gb=10,
+                          os_image="ubuntu-22.04", status="pending"))
+            db.commit()
+            
+            assert asyncio.run(TerraformService().deploy_lab(lab, db))
+            ports = sorted(vm.ssh_port for vm in lab.vms)
+            assert ports == [22001, 22002]
+            with open(f"/tmp/terraform_lab_{lab.id}/main.tf") as f:
+                rendered = sorted(int(line.split("=")[1]) for line in f if "ssh_port =" in line)
+            assert rendered == ports
+        finally:
+            shutil.rmtree(f"/tmp/terraform_lab_{lab.id}", ignore_errors=True)
+            db.query(VM).filter(VM.lab_id.in_([other.id, lab.id])).delete(synchronize_session=False)
+            db.query(DeploymentLog).filter(DeploymentLog.lab_id == lab.id).delete(synchronize_session=False)
+            db.query(Lab).filter(Lab.id.in_([other.id, lab.id])).delete(synchronize_session=False)
+            db.commit()
+            db.close()
+    
+    def test_failures(self):
+        """Test des échecs simulés : code de retour non nul et erreur séparée sur demande."""
+        executor = FakeExecutor(time_scale=0, failure_rate=1)
+        result = asyncio.run(executor.run(["virsh", "start", "vm"], merge_stderr=False))
+        assert result.returncode == 1
+        assert "échec simulé" in result.stderr
+        assert executor.stats["failures"] == 1
+    
+    def test_incomplete_executor(self):
+        """Test du refus d'instancier un exécuteur sans méthode run."""
+        class NamedExecutor(CommandExecutor):
+            name = "named"
+        
+        with pytest.raises(TypeError, match="run"):
+            NamedExecutor()
+
+
+class TestTelemetry:
+    """Tests du registre de métriques."""
+    
+    def test_histogram_rendering(self):
+        """Test des bornes cumulées, de la somme et du nombre d'observations."""
+        registry = MetricsRegistry()
+        histogram = registry.histogram("t_seconds", "Durée.", ("stage",), buckets=(0.1, 1.0))
+        counter = registry.counter("t_total", "Total.", ("kind",))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, stage="apply")
+        counter.inc(3, kind='a"b')
+        
+        text = registry.render()
+        assert 't_seconds_bucket{stage="apply",le="0.1"} 1' in text
+        assert 't_seconds_bucket{stage="apply",le="1"} 2' in text
+        assert 't_seconds_bucket{stage="apply",le="+Inf"} 3' in text
+        assert 't_seconds_count{stage="apply"} 3' in text
+        assert 't_total{kind="a\\"b"} 3' in text
+        assert "# TYPE t_seconds histogram" in text
+
+
+class TestTracing:
+    """Tests de la chronologie des déploiements."""
+    
+    def test_span_hierarchy(self):
+        """Test des spans imbriqués, des étapes reconstituées et du statut en cas d'erreur."""
+        lab_id = uuid.uuid4()
+        trace = begin_trace(lab_id, host="hv1")
+        with span("terraform"):
+            record_span("wait_for_lease", 10.0, 12.5, vm="vm-0")
+        with pytest.raises(RuntimeError):
+            with span("ansible"):
+                raise RuntimeError("échec")
+        end_trace(trace, "error")
+        
+        # Hors déploiement tracé, les spans ne font rien
+        with span("orphelin") as current:
+            assert current is None
+        
+        rows = trace.rows()
+        assert [(row['seq'], row['parent_seq'], row['name']) for row in rows] == [
+            (0, None, "deploy"), (1, 0, "terraform"), (2, 1, "wait_for_lease"), (3, 0, "ansible")
+        ]
+        assert rows[2]['duration'] == 2.5 and rows[2]['vm_name'] == "vm-0"
+        assert rows[3]['status'] == "error" and rows[0]['status'] == "error"
+        assert json.loads(rows[0]['attributes']) == {'host': "hv1"}
+
+
+class TestProfiler:
+    """Tests du profileur échantillonneur et des requêtes lentes."""
+    
+    def test_collapsed_stacks(self):
+        """Test de l'échantillonnage d'une fonction active sur le thread principal."""
+        def busy_loop():
+            deadline = time.monotonic() + 0.3
+            while time.monotonic() < deadline:
+                sum(range(1000))
+        
+        profiler = SamplingProfiler()
+        assert profiler.start(seconds=5, interval_ms=5)
+        assert not profiler.start()
+        busy_loop()
+        profiler.stop()
+        
+        assert profiler.samples > 0
+        assert "MainThread;" in profiler.collapsed()
+        # Le classement peut être tronqué par les cadres du lanceur de tests : chercher dans les piles
+        assert "busy_loop" in profiler.collapsed()
+    
+    def test_ranking_tie_break(self):
+        """Test du départage des fonctions à égalité : la plus profonde d'abord, puis par nom."""
+        profiler = SamplingProfiler()
+        profiler.samples = 4
+        profiler.stacks = {"MainThread;main;handler;query": 3, "MainThread;main;b;a": 1}
+        
+        status = profiler.status()
+        assert [line["frame"] for line in status["top_total"]] == ["main", "query", "handler", "a", "b"]
+        assert [line["frame"] for line in status["top_self"]] == ["query", "a"]
+        assert [line["frame"] for line in profiler.status(top=2)["top_total"]] == ["main", "query"]
+    
+    def test_slow_request_ring_buffer(self):
+        """Test de l'éviction des plus anciennes requêtes lentes."""
+        log = SlowRequestLog(size=2, threshold_ms=100)
+        for path in ("/a", "/b", "/c"):
+            log.add("GET", path, path, 200, time.time(), 0.5, [], database.QueryStats())
+        
+        requests = log.list()
+        assert [request["path"] for request in requests] == ["/c", "/b"]
+        assert log.get(requests[0]["id"])["statements"] == []
+        assert log.get(1) is None
+
+
+class TestQueryStats:
+    """Tests du suivi des requêtes SQL par requête HTTP."""
+    
+    def test_budget_guard(self, monkeypatch):
+        """Test du comptage, du partage entre blocs imbriqués et du budget en mode raise."""
+        monkeypatch.setattr(database, "QUERY_BUDGET_MODE", "raise")
+        db = TestingSessionLocal()
+        try:
+            with track_queries("GET /labs", budget=3) as stats:
+                with track_queries() as nested:
+                    assert nested is stats
+                    db.query(Lab).all()
+                with pytest.raises(QueryBudgetExceeded):
+                    for _ in range(3):
+                        db.query(VM).all()
+            assert stats.count == 4
+            assert stats.most_repeated()[1] == 3
+            assert len(stats.slowest_statements()) == 4
+            
+            # Hors requête suivie, rien n'est compté
+            db.query(Lab).all()
+            assert stats.count == 4
+        finally:
+            db.close()
+
+
+class TestBenchmarkStats:
+    """Tests des statistiques des benchmarks."""
+    
+    def test_percentiles(self):
+        """Test des percentiles par interpolation et du résumé par requête."""
+        assert percentile([1, 2, 3, 4, 5], 50) == 3
+        assert percentile([1, 2, 3, 4], 50) == 2.5
+        assert percentile([], 99) == 0.0
+        
+        summary = summarize([0.001, 0.002, 0.003], queries=[1, 1, 4])
+        assert summary["p50_ms"] == 2.0
+        assert summary["queries_mean"] == 2.0
+        assert summary["queries_max"] == 4
+
+
+class TestVMMetrics:
+    """Tests des séries de métriques en mémoire."""
+    
+    def test_ring_series_wraps(self):
+        """Test de l'écrasement circulaire et de l'ordre chronologique."""
+        ring = RingSeries(10, 4)
+        for i in range(6):
+            ring.append(100 + i * 10, [float(i)] * len(METRIC_NAMES))
+        
+        timestamps, values = ring.since(0)
+        assert timestamps == [120, 130, 140, 150]
+        assert values[0] == [2.0, 3.0, 4.0, 5.0]
+        assert ring.since(135)[0] == [140, 150]
+    
+    def test_rates_from_counters(self):
+        """Test du calcul des débits et du CPU à partir des compteurs cumulés."""
+        metrics = VMMetrics("vm-1", "lab-1", 10)
+        counters = {'state': "running", 'cpu_time_ns': 0, 'vcpus': 2, 'memory_used_kb': 2048,
+                    'disk_read_bytes': 0, 'disk_write_bytes': 0, 'net_rx_bytes': 0, 'net_tx_bytes': 0}
+        metrics.add_counters(1000, counters)
+        metrics.add_counters(1010, dict(counters, cpu_time_ns=10_000_000_000, net_rx_bytes=5000))
+        
+        timestamps, values = metrics.raw.since(0)
+        assert timestamps == [1010]
+        assert values[METRIC_NAMES.index("cpu_percent")] == [50.0]
+        assert values[METRIC_NAMES.index("net_rx_bps")] == [500.0]
+        assert values[METRIC_NAMES.index("memory_used_mb")] == [2.0]
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
 
@@ -3,11 +3,12 @@ import { Terminal } from 'xterm'
 import { FitAddon } from '@xterm/addon-fit'
 import { WebLinksAddon } from '@xterm/addon-web-links'
 import 'xterm/css/xterm.css'
+import muxConnection from '../services/mux'
 
 const SSHTerminal = ({ vmId, onConnectionStatus }) => {
   const terminalRef = useRef(null)
   const terminal = useRef(null)
-  const websocket = useRef(null)
+  const channel = useRef(null)
   const fitAddon = useRef(null)
   const [isConnected, setIsConnected] = useState(false)
   const [connectionError, setConnectionError] = useState(null)
@@ -53,8 +54,18 @@ const SSHTerminal = ({ vmId, onConnectionStatus }) => {
     terminal.current.open(terminalRef.current)
     fitAddon.current.fit()
 
-    // Établir la connexion WebSocket
-    connectWebSocket()
+    // Gérer les entrées du terminal
+    terminal.current.onData((data) => {
+      channel.current?.send(data)
+    })
+
+    // Transmettre la taille du terminal au serveur
+    terminal.current.onResize(({ cols, rows }) => {
+      channel.current?.resize(cols, rows)
+    })
+
+    // Ouvrir le canal SSH sur la connexion multiplexée
+    connectChannel()
 
     // Gérer le redimensionnement
     const handleResize = () => {
@@ -67,8 +78,8 @@ const SSHTerminal = ({ vmId, onConnectionStatus }) => {
 
     return () => {
       window.removeEventListener('resize', handleResize)
-      if (websocket.current) {
-        websocket.current.close()
+      if (channel.current) {
+        channel.current.close()
       }
       if (terminal.current) {
         terminal.current.dispose()
@@ -76,51 +87,42 @@ const SSHTerminal = ({ vmId, onConnectionStatus }) => {
     }
   }, [vmId])
 
-  const connectWebSocket = () => {
-    const wsUrl = `ws://localhost:8000/api/v1/ws/ssh/${vmId}`
-    
+  const connectChannel = () => {
     try {
-      websocket.current = new WebSocket(wsUrl)
-
-      websocket.current.onopen = () => {
-        setIsConnected(true)
-        setConnectionError(null)
-        onConnectionStatus?.(true)
-        
-        terminal.current.writeln('Connexion SSH établie...')
-        terminal.current.writeln('Appuyez sur Entrée pour commencer.')
-        
-        // Gérer les entrées du terminal
-        terminal.current.onData((data) => {
-          if (websocket.current && websocket.current.readyState === WebSocket.OPEN) {
-            websocket.current.send(data)
+      const { cols, rows } = terminal.current
+      channel.current = muxConnection.openChannel(vmId, 'ssh', { cols, rows, compress: 'deflate' }, {
+        onOpen: () => {
+          setIsConnected(true)
+          setConnectionError(null)
+          onConnectionStatus?.(true)
+
+          terminal.current.writeln('Connexion SSH établie...')
+          terminal.current.writeln('Appuyez sur Entrée pour commencer.')
+        },
+
+        onData: (data) => {
+          // Rendre le crédit au serveur une fois les données affichées par xterm
+          terminal.current?.write(data, () => channel.current?.ack(data.length))
+        },
+
+        onClose: (code) => {
+          setIsConnected(false)
+          onConnectionStatus?.(false)
+
+          if (code !== 1000) {
+            const error = `Connexion fermée (code: ${code})`
+            setConnectionError(error)
+            terminal.current?.writeln(`\r\n${error}`)
           }
-        })
-      }
+        },
 
-      websocket.current.onmessage = (event) => {
-        if (terminal.current) {
-          terminal.current.write(event.data)
-        }
-      }
-
-      websocket.current.onclose = (event) => {
-        setIsConnected(false)
-        onConnectionStatus?.(false)
-        
-        if (event.code !== 1000) {
-          const error = `Connexion fermée (code: ${event.code})`
-          setConnectionError(error)
-          terminal.current?.writeln(`\r\n${error}`)
-        }
-      }
-
-      websocket.current.onerror = (error) => {
-        const errorMsg = 'Erreur de connexion WebSocket'
-        setConnectionError(errorMsg)
-        onConnectionStatus?.(false)
-        terminal.current?.writeln(`\r\n${errorMsg}`)
-      }
+        onError: (message) => {
+          const errorMsg = message || 'Erreur de connexion WebSocket'
+          setConnectionError(errorMsg)
+          onConnectionStatus?.(false)
+          terminal.current?.writeln(`\r\n${errorMsg}`)
+        },
+      })
 
     } catch (error) {
       const errorMsg = `Erreur lors de la connexion: ${error.message}`
@@ -131,12 +133,12 @@ const SSHTerminal = ({ vmId, onConnectionStatus }) => {
   }
 
   const reconnect = () => {
-    if (websocket.current) {
-      websocket.current.close()
+    if (channel.current) {
+      channel.current.close()
     }
     setConnectionError(null)
     terminal.current?.clear()
-    connectWebSocket()
+    connectChannel()
   }
 
   return (
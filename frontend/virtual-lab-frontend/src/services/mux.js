@@ -0,0 +1,227 @@
+// Client du WebSocket multiplexé : plusieurs terminaux SSH/VNC sur une seule connexion
+
+const WS_BASE_URL = import.meta.env.VITE_WS_URL || 'ws://localhost:8000/api/v1'
+
+// En-tête de trame : type (u8), drapeaux (u8), canal (u16), big-endian
+const HEADER_SIZE = 4
+
+export const FRAME = {
+  DATA: 0x00,
+  OPEN: 0x01,
+  OPENED: 0x02,
+  CLOSE: 0x03,
+  RESIZE: 0x04,
+  WINDOW: 0x05,
+  ERROR: 0x06,
+}
+
+// Drapeau : charge utile compressée en deflate brut (message autonome)
+const FLAG_DEFLATE = 0x01
+
+const encoder = new TextEncoder()
+const decoder = new TextDecoder()
+
+const encodeFrame = (type, channelId, payload = new Uint8Array(0)) => {
+  const frame = new Uint8Array(HEADER_SIZE + payload.length)
+  const view = new DataView(frame.buffer)
+  view.setUint8(0, type)
+  view.setUint8(1, 0)
+  view.setUint16(2, channelId)
+  frame.set(payload, HEADER_SIZE)
+  return frame
+}
+
+const encodeWindow = (bytes) => {
+  const payload = new Uint8Array(4)
+  new DataView(payload.buffer).setUint32(0, bytes)
+  return payload
+}
+
+const inflate = async (payload) => {
+  const stream = new Blob([payload]).stream().pipeThrough(new DecompressionStream('deflate-raw'))
+  return new Uint8Array(await new Response(stream).arrayBuffer())
+}
+
+class MuxChannel {
+  constructor(connection, id, handlers) {
+    this.connection = connection
+    this.id = id
+    this.handlers = handlers
+    // Crédit d'envoi accordé par le serveur, et données en attente de crédit
+    this.sendCredit = 0
+    this.pending = []
+    this.isOpen = false
+    this.inbound = Promise.resolve()
+  }
+
+  // La décompression est asynchrone : la chaîne de promesses préserve l'ordre des données
+  deliver(flags, payload) {
+    this.inbound = this.inbound.then(async () => {
+      const data = flags & FLAG_DEFLATE ? await inflate(payload) : payload
+      this.handlers.onData?.(data)
+    })
+  }
+
+  send(data) {
+    const bytes = typeof data === 'string' ? encoder.encode(data) : data
+    this.pending.push(bytes)
+    this.flush()
+  }
+
+  flush() {
+    while (this.isOpen && this.pending.length > 0 && this.sendCredit > 0) {
+      let chunk = this.pending[0]
+      if (chunk.length > this.sendCredit) {
+        this.pending[0] = chunk.subarray(this.sendCredit)
+        chunk = chunk.subarray(0, this.sendCredit)
+      } else {
+        this.pending.shift()
+      }
+      this.sendCredit -= chunk.length
+      this.connection.sendFrame(FRAME.DATA, this.id, chunk)
+    }
+  }
+
+  // Rend au serveur le crédit correspondant aux données consommées
+  ack(bytes) {
+    if (this.isOpen && bytes > 0) {
+      this.connection.sendFrame(FRAME.WINDOW, this.id, encodeWindow(bytes))
+    }
+  }
+
+  resize(cols, rows) {
+    this.connection.sendFrame(FRAME.RESIZE, this.id, encoder.encode(JSON.stringify({ cols, rows })))
+  }
+
+  close() {
+    if (this.isOpen) {
+      this.connection.sendFrame(FRAME.CLOSE, this.id)
+    }
+    this.connection.release(this)
+  }
+}
+
+class MuxConnection {
+  constructor(url) {
+    this.url = url
+    this.websocket = null
+    this.channels = new Map()
+    this.nextChannelId = 1
+    this.queue = []
+  }
+
+  connect() {
+    if (this.websocket && this.websocket.readyState <= WebSocket.OPEN) return
+
+    // Les événements d'un WebSocket remplacé (encore en cours de fermeture) sont ignorés :
+    // ils fermeraient les canaux de la nouvelle connexion
+    const websocket = new WebSocket(this.url)
+    websocket.binaryType = 'arraybuffer'
+    this.websocket = websocket
+    const isCurrent = () => this.websocket === websocket
+
+    websocket.onopen = () => {
+      if (!isCurrent()) return
+      this.queue.forEach((frame) => websocket.send(frame))
+      this.queue = []
+    }
+
+    websocket.onmessage = (event) => {
+      if (isCurrent()) this.handleFrame(new Uint8Array(event.data))
+    }
+
+    websocket.onclose = (event) => {
+      if (!isCurrent()) return
+      this.channels.forEach((channel) => {
+        channel.isOpen = false
+        channel.handlers.onClose?.(event.code)
+      })
+      this.channels.clear()
+      this.websocket = null
+    }
+
+    websocket.onerror = () => {
+      if (!isCurrent()) return
+      this.channels.forEach((channel) => channel.handlers.onError?.('Erreur de connexion WebSocket'))
+    }
+  }
+
+  openChannel(vmId, kind, { cols = 80, rows = 24, compress = null } = {}, handlers = {}) {
+    this.connect()
+    const id = this.nextChannelId
+    this.nextChannelId = (this.nextChannelId % 0xffff) + 1
+
+    const channel = new MuxChannel(this, id, handlers)
+    this.channels.set(id, channel)
+    this.sendFrame(FRAME.OPEN, id, encoder.encode(JSON.stringify({ vm_id: vmId, kind, cols, rows, compress })))
+    return channel
+  }
+
+  sendFrame(type, channelId, payload) {
+    const frame = encodeFrame(type, channelId, payload)
+    if (this.websocket && this.websocket.readyState === WebSocket.OPEN) {
+      this.websocket.send(frame)
+    } else {
+      this.queue.push(frame)
+    }
+  }
+
+  release(channel) {
+    this.channels.delete(channel.id)
+    // Fermer le WebSocket quand plus aucun canal ne l'utilise
+    if (this.channels.size === 0 && this.websocket) {
+      this.websocket.close(1000)
+      // Le prochain canal ouvre une nouvelle connexion ; les trames en attente sont perdues avec l'ancienne
+      this.websocket = null
+      this.queue = []
+    }
+  }
+
+  handleFrame(frame) {
+    if (frame.length < HEADER_SIZE) return
+
+    const view = new DataView(frame.buffer, frame.byteOffset, frame.byteLength)
+    const type = view.getUint8(0)
+    const flags = view.getUint8(1)
+    const channelId = view.getUint16(2)
+    const payload = frame.subarray(HEADER_SIZE)
+    const channel = this.channels.get(channelId)
+    if (!channel) return
+
+    switch (type) {
+      case FRAME.DATA:
+        channel.deliver(flags, payload)
+        break
+      case FRAME.OPENED:
+        channel.isOpen = true
+        channel.sendCredit = new DataView(payload.buffer, payload.byteOffset).getUint32(0)
+        channel.handlers.onOpen?.()
+        channel.flush()
+        break
+      case FRAME.WINDOW:
+        channel.sendCredit += new DataView(payload.buffer, payload.byteOffset).getUint32(0)
+        channel.flush()
+        break
+      case FRAME.ERROR:
+        channel.handlers.onError?.(JSON.parse(decoder.decode(payload)).message)
+        // Échec de l'ouverture : le canal n'existe pas côté serveur
+        if (!channel.isOpen) {
+          this.channels.delete(channelId)
+          channel.handlers.onClose?.(1011)
+        }
+        break
+      case FRAME.CLOSE:
+        channel.isOpen = false
+        this.channels.delete(channelId)
+        channel.handlers.onClose?.(1000)
+        break
+      default:
+        break
+    }
+  }
+}
+
+// Connexion partagée par tous les terminaux de l'onglet
+export const muxConnection = new MuxConnection(`${WS_BASE_URL}/ws/mux`)
+
+export default muxConnection